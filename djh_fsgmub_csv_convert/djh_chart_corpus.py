@@ -0,0 +1,118 @@
+"""
+MIT License
+
+Copyright (c) 2019 shockdude
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# DJ Hero Chart Corpus Builder v0.1
+# Reads every FSGMUB/XMK chart in a song folder tree into one .npz corpus,
+# and prints note statistics for a whole library from it
+# Needs numpy
+
+import os, sys
+
+from djh_fsgmub_csv_convert import FLAG_NAMES, FLAG_TYPES
+try:
+	import fsgmub_corpus
+except ImportError:
+	# numpy isn't installed
+	fsgmub_corpus = None
+
+COMMAND_BUILD = "build"
+COMMAND_STATS = "stats"
+DEFAULT_CORPUS = "charts.npz"
+
+def usage():
+	print("Usage: {} {} songs_folder [corpus.npz]".format(sys.argv[0], COMMAND_BUILD))
+	print("       {} {} corpus.npz [difficulty]".format(sys.argv[0], COMMAND_STATS))
+	print("{} reads every .fsgmub/.xmk under songs_folder into the corpus (default {}).".format(COMMAND_BUILD, DEFAULT_CORPUS))
+	print("If the corpus already exists, charts that haven't changed are reused instead of read again.")
+	print("{} counts every note type in the corpus, or only in charts of one difficulty, e.g. DJ_Expert".format(COMMAND_STATS))
+	sys.exit(1)
+
+def type_name(note_type):
+	if note_type in FLAG_TYPES:
+		return FLAG_NAMES[FLAG_TYPES.index(note_type)]
+	return str(note_type)
+
+def build_main(songs_dir, corpus_filename):
+	if not os.path.isdir(songs_dir):
+		print("Error: {} is not a folder".format(songs_dir))
+		usage()
+	
+	old_corpus = None
+	if os.path.isfile(corpus_filename):
+		try:
+			old_corpus = fsgmub_corpus.load_corpus(corpus_filename)
+		except (OSError, ValueError, KeyError, fsgmub_corpus.CorpusError) as e:
+			print("Note: rebuilding {} from scratch, {}".format(corpus_filename, e))
+	
+	corpus = fsgmub_corpus.build_corpus(songs_dir, old_corpus)
+	corpus.save(corpus_filename)
+	print("Wrote {} charts with {} entries to {}".format(len(corpus), corpus.num_entries(), corpus_filename))
+
+def stats_main(corpus_filename, difficulty):
+	try:
+		corpus = fsgmub_corpus.load_corpus(corpus_filename)
+	except (OSError, ValueError, KeyError, fsgmub_corpus.CorpusError) as e:
+		print("Error: failed to load corpus {}".format(corpus_filename))
+		print(e)
+		usage()
+	
+	charts = None
+	if difficulty is not None:
+		charts = corpus.select(difficulty=difficulty)
+		if len(charts) == 0:
+			print("Error: no {} charts in {}".format(difficulty, corpus_filename))
+			usage()
+		print("{} {} charts".format(len(charts), difficulty))
+	else:
+		print("{} charts, {} songs".format(len(corpus), len(set(corpus.songs.tolist()))))
+	
+	note_types, counts, chart_counts = corpus.type_counts(charts)
+	print("{:<16}{:>10}{:>8}".format("NoteType", "Entries", "Charts"))
+	for note_type, count, chart_count in zip(note_types.tolist(), counts.tolist(), chart_counts.tolist()):
+		print("{:<16}{:>10}{:>8}".format(type_name(note_type), count, chart_count))
+
+def main():
+	if len(sys.argv) < 3:
+		usage()
+	if fsgmub_corpus is None:
+		print("Error: the chart corpus needs numpy, install it with: pip install numpy")
+		usage()
+	
+	command = sys.argv[1]
+	if command == COMMAND_BUILD:
+		corpus_filename = DEFAULT_CORPUS
+		if len(sys.argv) > 3:
+			corpus_filename = sys.argv[3]
+		build_main(sys.argv[2], corpus_filename)
+	elif command == COMMAND_STATS:
+		difficulty = None
+		if len(sys.argv) > 3:
+			difficulty = sys.argv[3]
+		stats_main(sys.argv[2], difficulty)
+	else:
+		print("Error: unknown command {}".format(command))
+		usage()
+
+if __name__ == "__main__":
+	main()
@@ -22,7 +22,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-# DJ Hero FSGMUB/CSV Converter v0.41
+# DJ Hero FSGMUB/CSV Converter v0.44
 # Convert FSGMUB/XMK to CSV, and CSV to FSGMUB (can be renamed to XMK)
 # Credit to pikminguts92 from ScoreHero for documenting the FSGMUB format
 # https://www.scorehero.com/forum/viewtopic.php?p=1827382#1827382
@@ -50,8 +50,12 @@ INT32 - Text Pointer (Usually 0)
 
 import csv
 import os, sys
-import struct
-import binascii
+import io
+from array import array
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+
+import fsgmub_chart
 
 FSGMUB_EXTENSION = ".fsgmub"
 XMK_EXTENSION = ".xmk"
@@ -61,6 +65,11 @@ HEADER_SIZE = 16
 ENTRY_SIZE = 16
 ALIGN_SIZE = 32
 
+# folder mode: convert every chart (or CSV) in a folder tree
+JOBS_FLAG = "-j"
+FORCE_FLAG = "--force"
+FROM_CSV_FLAG = "--from-csv"
+
 FLAG_NAMES = ("AUTHOR", "SECTION", "CHART_BPM", "BEAT_LENGTH", "MARKUP_EVENT", "CHART_BEGIN", "FX_FILTER", "FX_BEATROLL", "FX_BITREDUCE", "FX_WAHWAH", "FX_RINGMOD", "FX_STUTTER", "FX_FLANGER", "FX_ROBOT", "FX_ADV_BEATROLL", "FX_DELAY", "LYRIC_PAGE", "LYRIC_GREEN", "LYRIC_BLUE")
 FLAG_TYPES = (0x0AFFFFFF,0x09FFFFFF,0x0B000002,0x0B000001,0x0B000000,0xFFFFFFFF,0x05FFFFFF,0x06000000,0x06000001,0x06000002,0x06000003,0x06000004,0x06000005,0x06000006,0x06000007,0x06000009,0x1101,0x1103,0x1104)
 LYRIC = 0x1000
@@ -72,6 +81,9 @@ if len(FLAG_NAMES) != len(FLAG_TYPES):
 	print("Error: mismatched number of flag names & flag types")
 	sys.exit(1)
 
+# flag name -> index into FLAG_NAMES/FLAG_TYPES
+FLAG_NAME_INDEX = {flag_name: flag_i for flag_i, flag_name in enumerate(FLAG_NAMES)}
+
 FLAG_AUTHOR = 0
 FLAG_SECTION = 1
 FLAG_CHART_BPM = 2
@@ -82,151 +94,209 @@ FLAG_CHART_BEGIN = 5
 def usage():
 	print("Usage: {} [inputfile]".format(sys.argv[0]))
 	print("Converts DJ Hero 1 FSGMUB to CSV or CSV to FSGMUB")
+	print("Folder Usage: {} [{} jobs] [{}] [{}] [folder]".format(sys.argv[0], JOBS_FLAG, FORCE_FLAG, FROM_CSV_FLAG))
+	print("Converts every FSGMUB/XMK in the folder and its subfolders to CSV, or every CSV to FSGMUB with {}".format(FROM_CSV_FLAG))
+	print("Files whose output is newer than the input are skipped, unless {} is used".format(FORCE_FLAG))
 	sys.exit(1)
 
 def fsgmub_to_csv(fsgmub_filename):
 	fsgmub_name, fsgmub_ext = os.path.splitext(fsgmub_filename)
 	csv_filename = fsgmub_name + CSV_EXTENSION
 
-	with open(fsgmub_filename, "rb") as fsgmub_file:
-		with open(csv_filename, "w", newline='') as csv_file:
-			csv_writer = csv.writer(csv_file)
-			
-			# fsgmub header
-			# version, hash, length
-			fsgmub_data = struct.unpack(">IIII", fsgmub_file.read(16))
-			print("Version: {}".format(fsgmub_data[0]))
-			print("Hash: {:x}".format(fsgmub_data[1]))
-			print("Length: {}".format(fsgmub_data[2]))
-			print("String data length: {}".format(fsgmub_data[3]))
-			string_length = fsgmub_data[3] - 1
-			fsgmub_length = fsgmub_data[2]
-			fsgmub_strings = None
-			
-			if string_length > 0:
-				fsgmub_file.seek(ENTRY_SIZE*fsgmub_length+HEADER_SIZE)
-				fsgmub_strings = fsgmub_file.read(string_length)
-				fsgmub_file.seek(HEADER_SIZE)
-			
-			for i in range(fsgmub_length):
-				# note position, note_type, note_length, other
-				position, note_type, note_length = struct.unpack(">fIf", fsgmub_file.read(12))
-				other_data = fsgmub_file.read(4)
-				try:
-					flag_i = FLAG_TYPES.index(note_type)
-				except ValueError:
-					flag_i = -1
-				if flag_i >= 0:
-					note_type = FLAG_NAMES[flag_i]
-					if flag_i == FLAG_AUTHOR or flag_i == FLAG_SECTION or flag_i == FLAG_MARKUPEVENT:
-						str_index = struct.unpack(">I",other_data)[0] - ENTRY_SIZE*fsgmub_length
-						other_data = fsgmub_strings[str_index:].split(b"\x00",1)[0].decode("utf-8")
-					elif flag_i == FLAG_CHART_BPM:
-						other_data = struct.unpack(">f",other_data)[0]
-					else:
-						other_data = struct.unpack(">I",other_data)[0]
-				elif note_type & LYRIC_MASK == LYRIC:
-					note_type = "{}{}".format(LYRIC_PREFIX, note_type & LYRIC_PITCH_MASK)
-					str_index = struct.unpack(">I",other_data)[0] - ENTRY_SIZE*fsgmub_length
-					other_data = fsgmub_strings[str_index:].split(b"\x00",1)[0].decode("utf-8")
-				else:
-					other_data = struct.unpack(">I",other_data)[0]
-				fsgmub_data = (position, note_type, note_length, other_data)
-				csv_writer.writerow(fsgmub_data)
+	chart = fsgmub_chart.load_fsgmub(fsgmub_filename)
+	print("Version: {}".format(chart.version))
+	print("Hash: {:x}".format(chart.hash))
+	print("Length: {}".format(chart.num_entries))
+	print("String data length: {}".format(chart.string_size))
+
+	# note position, note_type, note_length, other
+	positions = chart.positions.tolist()
+	note_types = chart.types.tolist()
+	note_lengths = chart.lengths.tolist()
+	raw_data = chart.data.tolist()
+	other_data = list(raw_data)
+
+	# only flags and lyrics need special handling, everything else is written as-is
+	flag_rows = chart.find_types(FLAG_TYPES)
+	flagged = set()
+	for i, flag_i in flag_rows:
+		flagged.add(i)
+		note_types[i] = FLAG_NAMES[flag_i]
+		if flag_i == FLAG_AUTHOR or flag_i == FLAG_SECTION or flag_i == FLAG_MARKUPEVENT:
+			other_data[i] = chart.string_at(raw_data[i])
+		elif flag_i == FLAG_CHART_BPM:
+			other_data[i] = float(chart.data_floats[i])
+	for i in chart.find_masked(LYRIC_MASK, LYRIC):
+		if i in flagged:
+			continue
+		note_types[i] = "{}{}".format(LYRIC_PREFIX, note_types[i] & LYRIC_PITCH_MASK)
+		other_data[i] = chart.string_at(raw_data[i])
+
+	with open(csv_filename, "w", newline='') as csv_file:
+		csv_writer = csv.writer(csv_file)
+		csv_writer.writerows(zip(positions, note_types, note_lengths, other_data))
 	
 def csv_to_fsgmub(csv_filename):
 	csv_name, csv_ext = os.path.splitext(csv_filename)
 	fsgmub_filename = csv_name + FSGMUB_EXTENSION
 
-	fsgmub_length = 0
-	output_array = []
+	# entry columns, filled in one pass over the csv
+	positions = array("f")
+	note_types = array("I")
+	note_lengths = array("f")
+	other_data = array("I")
+	# text pointers start from the first entry, so they're fixed up once the number of entries is known
+	string_rows = []
 	string_blob = bytearray()
-	string_blob_size = 0
 		
-	with open(csv_filename, "r", newline='') as csv_file:
-		for line in csv_file:
-			fsgmub_length += 1
-
 	with open(csv_filename, "r", newline='') as csv_file:
 		csv_reader = csv.reader(csv_file)
 		for row in csv_reader:
 			note_type = None
-			other_data = None
-			pack_str = None
+			other = None
 			nt_upper = row[1].strip().upper()
-			try:
-				flag_i = FLAG_NAMES.index(nt_upper)
-			except ValueError:
-				flag_i = -1
+			flag_i = FLAG_NAME_INDEX.get(nt_upper, -1)
 			if flag_i >= 0:
 				note_type = FLAG_TYPES[flag_i]
 				if flag_i == FLAG_AUTHOR or flag_i == FLAG_SECTION or flag_i == FLAG_MARKUPEVENT:
-					string_index = string_blob_size + ENTRY_SIZE*fsgmub_length
-					new_blob = row[3].encode("utf-8") + b"\x00"
-					string_blob += new_blob
-					string_blob_size += len(new_blob)
-					other_data = string_index
-					pack_str = ">fIfI"
+					string_rows.append(len(note_types))
+					other = len(string_blob)
+					string_blob += row[3].encode("utf-8") + b"\x00"
 				elif flag_i == FLAG_CHART_BPM:
-					pack_str = ">fIff"
-					other_data = float(row[3])
+					other = fsgmub_chart.float_word(float(row[3]))
 				else:
-					pack_str = ">fIfI"
-					other_data = int(row[3])
+					other = int(row[3])
 			elif nt_upper[0:len(LYRIC_PREFIX)] == LYRIC_PREFIX:
 				note_type = LYRIC + int(nt_upper[len(LYRIC_PREFIX):])
-				string_index = string_blob_size + ENTRY_SIZE*fsgmub_length
-				new_blob = row[3].encode("utf-8") + b"\x00"
-				string_blob += new_blob
-				string_blob_size += len(new_blob)
-				other_data = string_index
-				pack_str = ">fIfI"
+				string_rows.append(len(note_types))
+				other = len(string_blob)
+				string_blob += row[3].encode("utf-8") + b"\x00"
 			else:
-				pack_str = ">fIfI"
 				if note_type == None:
 					note_type = int(row[1])
-				other_data = int(row[3])
-			output_array.append(struct.pack(pack_str,
-											float(row[0]),
-											note_type,
-											float(row[2]),
-											other_data))
+				other = int(row[3])
+			positions.append(float(row[0]))
+			note_types.append(note_type)
+			note_lengths.append(float(row[2]))
+			other_data.append(other)
 
+	string_start = ENTRY_SIZE*len(note_types)
+	for i in string_rows:
+		other_data[i] += string_start
 	
+	# version (2), crc, chart length, string blob size, entries, strings, padding
+	fsgmub_data = fsgmub_chart.pack_fsgmub(2, positions, note_types, note_lengths, other_data, string_blob)
 	with open(fsgmub_filename, "wb") as fsgmub_file:
-		# compute crc
-		# chart length, string blob size (0), chart lines
-		size_bin = struct.pack(">II", fsgmub_length, string_blob_size)
-		crc = binascii.crc32(size_bin)
-		for line in output_array:
-			# note position, note type, note length, text pointer
-			crc = binascii.crc32(line, crc)
-		if string_blob_size > 0:
-			crc = binascii.crc32(string_blob, crc)
-		
-		# fsgmub header
-		# version (2), crc, chart length, string blob size
-		fsgmub_file.write(struct.pack(">II", 2, crc))
-		fsgmub_file.write(size_bin)
-		
-		for line in output_array:
-			# note position, note type, note length, text pointer
-			fsgmub_file.write(line)
-										
-		if string_blob_size > 0:
-			fsgmub_file.write(string_blob)
-		
-		# ensure the chart filesize is a multiple of 32 for some reason
-		file_size = HEADER_SIZE + fsgmub_length*ENTRY_SIZE + string_blob_size
-		size_offset = file_size % ALIGN_SIZE
-		if size_offset != 0:
-			fsgmub_file.write(b"\x00"*(ALIGN_SIZE - size_offset))
+		fsgmub_file.write(fsgmub_data)
+
+def output_filename(input_filename):
+	input_name, input_ext = os.path.splitext(input_filename)
+	if input_ext.lower() == CSV_EXTENSION:
+		return input_name + FSGMUB_EXTENSION
+	return input_name + CSV_EXTENSION
+
+def convert_job(input_filename):
+	# runs in a worker process, returns (success, messages)
+	messages = io.StringIO()
+	try:
+		with redirect_stdout(messages):
+			if os.path.splitext(input_filename)[1].lower() == CSV_EXTENSION:
+				csv_to_fsgmub(input_filename)
+			else:
+				fsgmub_to_csv(input_filename)
+	except Exception as e:
+		messages.write("Error: {}\n".format(e))
+		return False, messages.getvalue()
+	return True, messages.getvalue()
+
+def find_inputs(input_dir, from_csv):
+	if from_csv:
+		input_exts = (CSV_EXTENSION,)
+	else:
+		input_exts = (FSGMUB_EXTENSION, XMK_EXTENSION)
+	input_filenames = []
+	for root, dirs, files in os.walk(input_dir):
+		dirs.sort()
+		for filename in sorted(files):
+			if os.path.splitext(filename)[1].lower() in input_exts:
+				input_filenames.append(os.path.join(root, filename))
+	return input_filenames
+
+def is_up_to_date(input_filename):
+	try:
+		return os.stat(output_filename(input_filename)).st_mtime_ns >= os.stat(input_filename).st_mtime_ns
+	except OSError:
+		return False
+
+def folder_main(input_dir, num_workers, force, from_csv):
+	jobs = []
+	skipped_count = 0
+	outputs = {}
+	for input_filename in find_inputs(input_dir, from_csv):
+		# e.g. song.fsgmub and song.xmk would both write song.csv
+		output = os.path.normcase(output_filename(input_filename))
+		if output in outputs:
+			print("Warning: skipping {}, {} already converts to {}".format(input_filename, outputs[output], output_filename(input_filename)))
+			continue
+		outputs[output] = input_filename
+		if not force and is_up_to_date(input_filename):
+			skipped_count += 1
+			continue
+		jobs.append(input_filename)
+	print("Converting {} files, {} already up to date".format(len(jobs), skipped_count))
+	
+	failed = []
+	with ProcessPoolExecutor(max_workers=num_workers) as executor:
+		futures = [executor.submit(convert_job, input_filename) for input_filename in jobs]
+		# report in file order
+		for input_filename, future in zip(jobs, futures):
+			try:
+				success, messages = future.result()
+			except Exception as e:
+				success, messages = False, "Error: {}\n".format(e)
+			if not success:
+				print("FAILED: {}".format(input_filename))
+				for message in messages.splitlines():
+					print("\t{}".format(message))
+				failed.append(input_filename)
+	
+	print("Converted {} of {} files, skipped {} up to date".format(len(jobs) - len(failed), len(jobs), skipped_count))
+	if len(failed) > 0:
+		print("Failed:")
+		for input_filename in failed:
+			print("\t{}".format(input_filename))
+		sys.exit(1)
 
 def main():
-	if len(sys.argv) < 2:
+	args = sys.argv[1:]
+	num_workers = None
+	force = False
+	from_csv = False
+	# options come before the folder
+	while len(args) > 0 and args[0] in (JOBS_FLAG, FORCE_FLAG, FROM_CSV_FLAG):
+		option = args.pop(0)
+		if option == JOBS_FLAG:
+			try:
+				num_workers = int(args.pop(0))
+				if num_workers < 1:
+					raise ValueError
+			except (IndexError, ValueError):
+				print("Error: {} requires a positive number of jobs".format(JOBS_FLAG))
+				usage()
+		elif option == FORCE_FLAG:
+			force = True
+		elif option == FROM_CSV_FLAG:
+			from_csv = True
+	if len(args) < 1:
 		usage()
 	
-	input_filename = sys.argv[1]
+	input_filename = args[0]
+	if os.path.isdir(input_filename):
+		folder_main(input_filename, num_workers, force, from_csv)
+		sys.exit(0)
+	if num_workers is not None or force or from_csv:
+		print("Error: {}, {} and {} are only used with a folder".format(JOBS_FLAG, FORCE_FLAG, FROM_CSV_FLAG))
+		usage()
 	input_name, input_ext = os.path.splitext(input_filename)
 	
 	if input_ext.lower() in (FSGMUB_EXTENSION, XMK_EXTENSION):
@@ -22,7 +22,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-# DJ Hero FSGMUB/CSV Converter Alternate v0.3
+# DJ Hero FSGMUB/CSV Converter Alternate v0.32
 # Convert FSGMUB/XMK to CSV, and CSV to FSGMUB (can be renamed to XMK)
 # Credit to pikminguts92 from ScoreHero for documenting the FSGMUB format
 # https://www.scorehero.com/forum/viewtopic.php?p=1827382#1827382
@@ -50,8 +50,9 @@ INT32 - Text Pointer (Usually 0)
 
 import csv
 import os, sys
-import struct
-import binascii
+from array import array
+
+import fsgmub_chart
 
 FSGMUB_EXTENSION = ".fsgmub"
 XMK_EXTENSION = ".xmk"
@@ -62,6 +63,8 @@ ENTRY_SIZE = 16
 ALIGN_SIZE = 32
 
 FLAG_TYPES = (0x0AFFFFFF,0x09FFFFFF,0x0B000002,0x0B000001,0x0B000000,0xFFFFFFFF)
+# flag type -> index into FLAG_TYPES
+FLAG_TYPE_INDEX = {flag_type: flag_i for flag_i, flag_type in enumerate(FLAG_TYPES)}
 
 FLAG_AUTHOR = 0
 FLAG_SECTION = 1
@@ -79,128 +82,72 @@ def fsgmub_to_csv(fsgmub_filename):
 	fsgmub_name, fsgmub_ext = os.path.splitext(fsgmub_filename)
 	csv_filename = fsgmub_name + CSV_EXTENSION
 
-	with open(fsgmub_filename, "rb") as fsgmub_file:
-		with open(csv_filename, "w", newline='') as csv_file:
-			csv_writer = csv.writer(csv_file)
-			
-			# fsgmub header
-			# version, hash, length
-			fsgmub_data = struct.unpack(">IIII", fsgmub_file.read(16))
-			print("Version: {}".format(fsgmub_data[0]))
-			print("Hash: {:x}".format(fsgmub_data[1]))
-			print("Length: {}".format(fsgmub_data[2]))
-			print("String data length: {}".format(fsgmub_data[3]))
-			string_length = fsgmub_data[3] - 1
-			fsgmub_length = fsgmub_data[2]
-			fsgmub_strings = None
-			
-			if string_length > 0:
-				fsgmub_file.seek(ENTRY_SIZE*fsgmub_length+HEADER_SIZE)
-				fsgmub_strings = fsgmub_file.read(string_length)
-				fsgmub_file.seek(HEADER_SIZE)
-			
-			for i in range(fsgmub_length):
-				# note position, note_type=[note_category, note_value], note_length, other
-				position, note_type, note_length = struct.unpack(">fIf", fsgmub_file.read(12))
-				other_data = fsgmub_file.read(4)
-				try:
-					flag_i = FLAG_TYPES.index(note_type)
-				except ValueError:
-					flag_i = -1
-				if flag_i >= 0:
-					if flag_i == FLAG_AUTHOR or flag_i == FLAG_SECTION or flag_i == FLAG_MARKUPEVENT:
-						str_index = struct.unpack(">I",other_data)[0] - ENTRY_SIZE*fsgmub_length
-						other_data = fsgmub_strings[str_index:].split(b"\x00",1)[0].decode("utf-8")
-					elif flag_i == FLAG_CHART_BPM:
-						other_data = struct.unpack(">f",other_data)[0]
-					else:
-						other_data = struct.unpack(">I",other_data)[0]
-				else:
-					other_data = struct.unpack(">I",other_data)[0]
-				note_category = (note_type >> 24) & 0xFF
-				note_value = note_type & 0xFFFFFF
-				if note_value & 0x800000 > 0:
-					note_value -= 0x1000000
-				fsgmub_data = (position, note_category, note_value, note_length, other_data)
-				csv_writer.writerow(fsgmub_data)
+	chart = fsgmub_chart.load_fsgmub(fsgmub_filename)
+	print("Version: {}".format(chart.version))
+	print("Hash: {:x}".format(chart.hash))
+	print("Length: {}".format(chart.num_entries))
+	print("String data length: {}".format(chart.string_size))
+
+	# note position, note_type=[note_category, note_value], note_length, other
+	note_types = chart.types.tolist()
+	other_data = chart.data.tolist()
+	for i, flag_i in chart.find_types(FLAG_TYPES):
+		if flag_i == FLAG_AUTHOR or flag_i == FLAG_SECTION or flag_i == FLAG_MARKUPEVENT:
+			other_data[i] = chart.string_at(other_data[i])
+		elif flag_i == FLAG_CHART_BPM:
+			other_data[i] = float(chart.data_floats[i])
+	note_categories = [(note_type >> 24) & 0xFF for note_type in note_types]
+	note_values = [(note_type & 0xFFFFFF) - 0x1000000 if note_type & 0x800000 else note_type & 0xFFFFFF for note_type in note_types]
+
+	with open(csv_filename, "w", newline='') as csv_file:
+		csv_writer = csv.writer(csv_file)
+		csv_writer.writerows(zip(chart.positions.tolist(), note_categories, note_values, chart.lengths.tolist(), other_data))
 	
 def csv_to_fsgmub(csv_filename):
 	csv_name, csv_ext = os.path.splitext(csv_filename)
 	fsgmub_filename = csv_name + FSGMUB_EXTENSION
 
-	fsgmub_length = 0
-	output_array = []
+	# entry columns, filled in one pass over the csv
+	positions = array("f")
+	note_types = array("I")
+	note_lengths = array("f")
+	other_data = array("I")
+	# text pointers start from the first entry, so they're fixed up once the number of entries is known
+	string_rows = []
 	string_blob = bytearray()
-	string_blob_size = 0
 		
-	with open(csv_filename, "r", newline='') as csv_file:
-		for line in csv_file:
-			fsgmub_length += 1
-
 	with open(csv_filename, "r", newline='') as csv_file:
 		csv_reader = csv.reader(csv_file)
 		for row in csv_reader:
 			note_category = int(row[1]) & 0xFF
 			note_value = int(row[2]) & 0xFFFFFF
 			note_type = (note_category << 24) | note_value
-			other_data = None
-			pack_str = None
-			try:
-				flag_i = FLAG_TYPES.index(note_type)
-			except ValueError:
-				flag_i = -1
+			other = None
+			flag_i = FLAG_TYPE_INDEX.get(note_type, -1)
 			if flag_i >= 0:
 				if flag_i == FLAG_AUTHOR or flag_i == FLAG_SECTION or flag_i == FLAG_MARKUPEVENT:
-					string_index = string_blob_size + ENTRY_SIZE*fsgmub_length
-					new_blob = row[4].encode("utf-8") + b"\x00"
-					string_blob += new_blob
-					string_blob_size += len(new_blob)
-					other_data = string_index
-					pack_str = ">fIfI"
+					string_rows.append(len(note_types))
+					other = len(string_blob)
+					string_blob += row[4].encode("utf-8") + b"\x00"
 				elif flag_i == FLAG_CHART_BPM:
-					pack_str = ">fIff"
-					other_data = float(row[4])
+					other = fsgmub_chart.float_word(float(row[4]))
 				else:
-					pack_str = ">fIfI"
-					other_data = int(row[4])
+					other = int(row[4])
 			else:
-				pack_str = ">fIfI"
-				other_data = int(row[4])
-			output_array.append(struct.pack(pack_str,
-											float(row[0]),
-											note_type,
-											float(row[3]),
-											other_data))
-
+				other = int(row[4])
+			positions.append(float(row[0]))
+			note_types.append(note_type)
+			note_lengths.append(float(row[3]))
+			other_data.append(other)
+
+	string_start = ENTRY_SIZE*len(note_types)
+	for i in string_rows:
+		other_data[i] += string_start
 	
+	# version (2), crc, chart length, string blob size, entries, strings, padding
+	fsgmub_data = fsgmub_chart.pack_fsgmub(2, positions, note_types, note_lengths, other_data, string_blob)
 	with open(fsgmub_filename, "wb") as fsgmub_file:
-		# compute crc
-		# chart length, string blob size (0), chart lines
-		size_bin = struct.pack(">II", fsgmub_length, string_blob_size)
-		crc = binascii.crc32(size_bin)
-		for line in output_array:
-			# note position, note type, note length, text pointer
-			crc = binascii.crc32(line, crc)
-		if string_blob_size > 0:
-			crc = binascii.crc32(string_blob, crc)
-		
-		# fsgmub header
-		# version (2), crc, chart length, string blob size
-		fsgmub_file.write(struct.pack(">II", 2, crc))
-		fsgmub_file.write(size_bin)
-		
-		for line in output_array:
-			# note position, note type, note length, text pointer
-			fsgmub_file.write(line)
-										
-		if string_blob_size > 0:
-			fsgmub_file.write(string_blob)
-		
-		# ensure the chart filesize is a multiple of 32 for some reason
-		file_size = HEADER_SIZE + fsgmub_length*ENTRY_SIZE + string_blob_size
-		size_offset = file_size % ALIGN_SIZE
-		if size_offset != 0:
-			fsgmub_file.write(b"\x00"*(ALIGN_SIZE - size_offset))
+		fsgmub_file.write(fsgmub_data)
 
 def main():
 	if len(sys.argv) < 2:
@@ -0,0 +1,170 @@
+"""
+MIT License
+
+Copyright (c) 2019 shockdude
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# DJ Hero FSGMUB chart loader v0.2
+# Shared FSGMUB/XMK reader and writer for the chart tools
+# Reads and packs the whole entry table at once instead of one struct call per entry
+# Uses numpy if it is installed, otherwise falls back to the array module
+
+import sys
+import struct
+import binascii
+from array import array
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+HEADER_SIZE = 16
+ENTRY_SIZE = 16
+ENTRY_WORDS = 4
+# the chart size is padded to a multiple of this
+ALIGN_SIZE = 32
+
+HEADER_STRUCT = struct.Struct(">IIII")
+HASH_STRUCT = struct.Struct(">I")
+# a float's bits as an int, for float entry data
+FLOAT_STRUCT = struct.Struct("=f")
+FLOAT_WORD_STRUCT = struct.Struct("=I")
+
+# note position, note type, note length, other (int, float or text pointer)
+if np is not None:
+	ENTRY_DTYPE = np.dtype([("position", ">f4"), ("type", ">u4"), ("length", ">f4"), ("data", ">u4")])
+
+class FsgmubChart:
+	def __init__(self, version, hash, num_entries, string_size, table, strings):
+		self.version = version
+		self.hash = hash
+		self.num_entries = num_entries
+		self.string_size = string_size
+		self.strings = strings
+
+		if np is not None:
+			self.entries = np.frombuffer(table, dtype=ENTRY_DTYPE, count=num_entries)
+			self.positions = self.entries["position"]
+			self.types = self.entries["type"]
+			self.lengths = self.entries["length"]
+			self.data = self.entries["data"]
+			# same bytes as data, read as a float (e.g. CHART_BPM)
+			self.data_floats = np.ndarray((num_entries,), dtype=">f4", buffer=table, offset=12, strides=(ENTRY_SIZE,))
+		else:
+			self.entries = None
+			words = array("I")
+			words.frombytes(table)
+			floats = array("f")
+			floats.frombytes(table)
+			if sys.byteorder == "little":
+				words.byteswap()
+				floats.byteswap()
+			self.positions = floats[0::ENTRY_WORDS]
+			self.types = words[1::ENTRY_WORDS]
+			self.lengths = floats[2::ENTRY_WORDS]
+			self.data = words[3::ENTRY_WORDS]
+			self.data_floats = floats[3::ENTRY_WORDS]
+
+	def __len__(self):
+		return self.num_entries
+
+	def find_types(self, note_types):
+		# returns a list of (entry index, index into note_types) for every entry whose type is in note_types
+		if np is not None:
+			note_types = np.asarray(note_types, dtype=np.uint32)
+			order = np.argsort(note_types, kind="stable")
+			sorted_types = note_types[order]
+			found = np.searchsorted(sorted_types, self.types)
+			found[found == len(sorted_types)] = 0
+			rows = np.flatnonzero(sorted_types[found] == self.types)
+			return list(zip(rows.tolist(), order[found[rows]].tolist()))
+		type_lookup = {}
+		for i, note_type in enumerate(note_types):
+			type_lookup.setdefault(note_type, i)
+		return [(row, type_lookup[note_type]) for row, note_type in enumerate(self.types) if note_type in type_lookup]
+
+	def find_masked(self, mask, value):
+		# returns the entry indices where (note type & mask) == value
+		if np is not None:
+			return np.flatnonzero((self.types & mask) == value).tolist()
+		return [row for row, note_type in enumerate(self.types) if note_type & mask == value]
+
+	def string_at(self, pointer):
+		# text pointers are relative to the first entry
+		str_index = pointer - ENTRY_SIZE*self.num_entries
+		str_end = self.strings.find(b"\x00", str_index)
+		if str_end < 0:
+			str_end = len(self.strings)
+		return self.strings[str_index:str_end].decode("utf-8")
+
+def read_fsgmub(fsgmub_data):
+	# fsgmub header
+	# version, hash, length, string blob size
+	version, hash, fsgmub_length, string_size = HEADER_STRUCT.unpack_from(fsgmub_data)
+	table_end = HEADER_SIZE + ENTRY_SIZE*fsgmub_length
+	if len(fsgmub_data) < table_end:
+		raise ValueError("truncated chart, expected {} entries".format(fsgmub_length))
+
+	table = memoryview(fsgmub_data)[HEADER_SIZE:table_end]
+	strings = b""
+	if string_size > 1:
+		# the string blob ends with a null terminator
+		strings = bytes(fsgmub_data[table_end:table_end + string_size - 1])
+	return FsgmubChart(version, hash, fsgmub_length, string_size, table, strings)
+
+def load_fsgmub(fsgmub_filename):
+	with open(fsgmub_filename, "rb") as fsgmub_file:
+		return read_fsgmub(fsgmub_file.read())
+
+def float_word(value):
+	# float data is stored as its bits (e.g. CHART_BPM)
+	return FLOAT_WORD_STRUCT.unpack(FLOAT_STRUCT.pack(value))[0]
+
+def pack_fsgmub(version, positions, types, lengths, data, strings):
+	# builds a whole chart from its columns: array("f") positions & lengths, array("I") types & data
+	# text pointers in data must already point past the entry table
+	num_entries = len(types)
+	table_end = HEADER_SIZE + ENTRY_SIZE*num_entries
+	strings_end = table_end + len(strings)
+	fsgmub_data = bytearray(strings_end + (-strings_end) % ALIGN_SIZE)
+	
+	if np is not None:
+		table = np.ndarray((num_entries,), dtype=ENTRY_DTYPE, buffer=fsgmub_data, offset=HEADER_SIZE)
+		table["position"] = np.frombuffer(positions, dtype=np.float32)
+		table["type"] = np.frombuffer(types, dtype=np.uint32)
+		table["length"] = np.frombuffer(lengths, dtype=np.float32)
+		table["data"] = np.frombuffer(data, dtype=np.uint32)
+	else:
+		words = array("I", bytes(ENTRY_SIZE*num_entries))
+		words[0::ENTRY_WORDS] = array("I", positions.tobytes())
+		words[1::ENTRY_WORDS] = types
+		words[2::ENTRY_WORDS] = array("I", lengths.tobytes())
+		words[3::ENTRY_WORDS] = data
+		if sys.byteorder == "little":
+			words.byteswap()
+		fsgmub_data[HEADER_SIZE:table_end] = words.tobytes()
+	fsgmub_data[table_end:strings_end] = strings
+	
+	# the hash is a crc32 of the entry count, string blob size, entries and strings
+	HEADER_STRUCT.pack_into(fsgmub_data, 0, version, 0, num_entries, len(strings))
+	HASH_STRUCT.pack_into(fsgmub_data, 4, binascii.crc32(memoryview(fsgmub_data)[8:strings_end]))
+	return fsgmub_data
@@ -0,0 +1,241 @@
+"""
+MIT License
+
+Copyright (c) 2019 shockdude
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# DJ Hero chart corpus v0.2
+# Reads every FSGMUB/XMK chart in a song folder tree once into one columnar store,
+# so analyses over a whole library are numpy queries instead of one file parse per chart
+# Entries of all charts are stored back to back in native endian columns,
+# with per chart song/difficulty keys and the offset of each chart's entries
+# Needs numpy
+
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+import fsgmub_chart
+from fsgmub_chart import ENTRY_SIZE
+
+CORPUS_VERSION = 1
+CHART_EXTENSIONS = (".fsgmub", ".xmk")
+
+# per chart keys
+CHART_COLUMNS = ("paths", "songs", "difficulties", "versions", "hashes", "string_sizes", "file_sizes", "file_mtimes")
+# per entry columns
+ENTRY_COLUMNS = ("positions", "types", "lengths", "data")
+
+class CorpusError(Exception):
+	pass
+
+class ChartCorpus:
+	def __init__(self, arrays):
+		# chart i's entries are entry_starts[i]:entry_starts[i + 1], its strings string_starts[i]:string_starts[i + 1]
+		self.paths = arrays["paths"]
+		self.songs = arrays["songs"]
+		self.difficulties = arrays["difficulties"]
+		self.versions = arrays["versions"]
+		self.hashes = arrays["hashes"]
+		self.string_sizes = arrays["string_sizes"]
+		self.file_sizes = arrays["file_sizes"]
+		self.file_mtimes = arrays["file_mtimes"]
+		self.entry_starts = arrays["entry_starts"]
+		self.positions = arrays["positions"]
+		self.types = arrays["types"]
+		self.lengths = arrays["lengths"]
+		self.data = arrays["data"]
+		# same bits as data, read as a float (e.g. CHART_BPM)
+		self.data_floats = self.data.view(np.float32)
+		self.strings = arrays["strings"]
+		self.string_starts = arrays["string_starts"]
+		# chart index of every entry, for grouping entries by chart
+		self.entry_charts = np.repeat(np.arange(len(self.paths), dtype=np.int32), np.diff(self.entry_starts))
+	
+	def __len__(self):
+		return len(self.paths)
+	
+	def num_entries(self):
+		return len(self.types)
+	
+	def select(self, song=None, difficulty=None):
+		# indices of the charts matching the song folder and/or difficulty (e.g. "DJ_Expert")
+		matches = np.ones(len(self.paths), dtype=bool)
+		if song is not None:
+			matches &= self.songs == song
+		if difficulty is not None:
+			matches &= self.difficulties == difficulty
+		return np.flatnonzero(matches)
+	
+	def entry_mask(self, charts):
+		# True for the entries of the given charts
+		return np.isin(self.entry_charts, charts)
+	
+	def entries(self, chart):
+		return slice(int(self.entry_starts[chart]), int(self.entry_starts[chart + 1]))
+	
+	def string_at(self, chart, pointer):
+		# text pointers are relative to the chart's first entry, like FsgmubChart.string_at
+		strings = self.strings[self.string_starts[chart]:self.string_starts[chart + 1]].tobytes()
+		num_entries = int(self.entry_starts[chart + 1] - self.entry_starts[chart])
+		str_index = pointer - ENTRY_SIZE*num_entries
+		str_end = strings.find(b"\x00", str_index)
+		if str_end < 0:
+			str_end = len(strings)
+		return strings[str_index:str_end].decode("utf-8")
+	
+	def chart(self, chart):
+		# the chart as an FsgmubChart, for the tools that work on one chart at a time
+		entries = self.entries(chart)
+		table = np.empty(entries.stop - entries.start, dtype=fsgmub_chart.ENTRY_DTYPE)
+		table["position"] = self.positions[entries]
+		table["type"] = self.types[entries]
+		table["length"] = self.lengths[entries]
+		table["data"] = self.data[entries]
+		strings = self.strings[self.string_starts[chart]:self.string_starts[chart + 1]].tobytes()
+		return fsgmub_chart.FsgmubChart(int(self.versions[chart]), int(self.hashes[chart]), len(table), int(self.string_sizes[chart]), table.tobytes(), strings)
+	
+	def type_counts(self, charts=None):
+		# returns (note types, number of entries of each type, number of charts using each type)
+		# over the given charts, or the whole corpus
+		types = self.types
+		entry_charts = self.entry_charts
+		if charts is not None:
+			mask = self.entry_mask(charts)
+			types = types[mask]
+			entry_charts = entry_charts[mask]
+		note_types, entry_counts = np.unique(types, return_counts=True)
+		# each (type, chart) pair once, packed unsigned so types like CHART_BEGIN (0xFFFFFFFF) keep their order
+		type_charts = np.unique(types.astype(np.uint64) << np.uint64(32) | entry_charts.astype(np.uint64)) >> np.uint64(32)
+		chart_types, chart_counts = np.unique(type_charts, return_counts=True)
+		return note_types, entry_counts, chart_counts
+	
+	def arrays(self):
+		arrays = {name: getattr(self, name) for name in CHART_COLUMNS + ENTRY_COLUMNS}
+		arrays["entry_starts"] = self.entry_starts
+		arrays["strings"] = self.strings
+		arrays["string_starts"] = self.string_starts
+		return arrays
+	
+	def save(self, corpus_filename):
+		# written to a temporary file first, so an interrupted save keeps the old corpus
+		corpus_dir = os.path.dirname(os.path.abspath(corpus_filename))
+		corpus_fd, temp_filename = tempfile.mkstemp(dir=corpus_dir, prefix=".corpus-", suffix=".npz")
+		try:
+			with os.fdopen(corpus_fd, "wb") as corpus_file:
+				np.savez(corpus_file, version=np.uint32(CORPUS_VERSION), **self.arrays())
+			os.replace(temp_filename, corpus_filename)
+		except BaseException:
+			if os.path.isfile(temp_filename):
+				os.remove(temp_filename)
+			raise
+
+def load_corpus(corpus_filename):
+	with np.load(corpus_filename, allow_pickle=False) as corpus_file:
+		if "version" not in corpus_file or int(corpus_file["version"]) != CORPUS_VERSION:
+			raise CorpusError("{} is not a version {} chart corpus".format(corpus_filename, CORPUS_VERSION))
+		return ChartCorpus({name: corpus_file[name] for name in corpus_file.files})
+
+def find_charts(songs_dir):
+	# every FSGMUB/XMK in the tree, in a stable order
+	chart_filenames = []
+	for root, dirs, files in os.walk(songs_dir):
+		dirs.sort()
+		for filename in sorted(files):
+			if os.path.splitext(filename)[1].lower() in CHART_EXTENSIONS:
+				chart_filenames.append(os.path.join(root, filename))
+	return chart_filenames
+
+class CorpusBuilder:
+	def __init__(self):
+		self.charts = {name: [] for name in CHART_COLUMNS}
+		self.entries = {name: [] for name in ENTRY_COLUMNS}
+		self.entry_counts = []
+		self.strings = []
+	
+	def add(self, keys, positions, types, lengths, data, strings):
+		for name in CHART_COLUMNS:
+			self.charts[name].append(keys[name])
+		self.entries["positions"].append(positions)
+		self.entries["types"].append(types)
+		self.entries["lengths"].append(lengths)
+		self.entries["data"].append(data)
+		self.entry_counts.append(len(types))
+		self.strings.append(strings)
+	
+	def corpus(self):
+		arrays = {}
+		arrays["paths"] = np.array(self.charts["paths"], dtype=str)
+		arrays["songs"] = np.array(self.charts["songs"], dtype=str)
+		arrays["difficulties"] = np.array(self.charts["difficulties"], dtype=str)
+		for name in ("versions", "hashes", "string_sizes"):
+			arrays[name] = np.array(self.charts[name], dtype=np.uint32)
+		for name in ("file_sizes", "file_mtimes"):
+			arrays[name] = np.array(self.charts[name], dtype=np.int64)
+		for name, dtype in zip(ENTRY_COLUMNS, (np.float32, np.uint32, np.float32, np.uint32)):
+			arrays[name] = np.concatenate(self.entries[name]).astype(dtype) if self.entries[name] else np.zeros(0, dtype=dtype)
+		arrays["entry_starts"] = np.concatenate(([0], np.cumsum(self.entry_counts, dtype=np.int64))).astype(np.int64)
+		arrays["strings"] = np.concatenate(self.strings).astype(np.uint8) if self.strings else np.zeros(0, dtype=np.uint8)
+		arrays["string_starts"] = np.concatenate(([0], np.cumsum([len(strings) for strings in self.strings], dtype=np.int64))).astype(np.int64)
+		return ChartCorpus(arrays)
+
+def build_corpus(songs_dir, old_corpus=None, log=print):
+	# reads every chart under songs_dir, reusing the columns of charts that haven't changed since old_corpus
+	old_charts = {}
+	if old_corpus is not None:
+		old_charts = {path: i for i, path in enumerate(old_corpus.paths.tolist())}
+	
+	builder = CorpusBuilder()
+	read_count = 0
+	reused_count = 0
+	for chart_filename in find_charts(songs_dir):
+		chart_path = os.path.relpath(chart_filename, songs_dir).replace(os.sep, "/")
+		song, chart_name = os.path.split(chart_path)
+		stat = os.stat(chart_filename)
+		keys = {"paths": chart_path, "songs": song, "difficulties": os.path.splitext(chart_name)[0], "file_sizes": stat.st_size, "file_mtimes": stat.st_mtime_ns}
+		
+		old_i = old_charts.get(chart_path)
+		if old_i is not None and old_corpus.file_sizes[old_i] == stat.st_size and old_corpus.file_mtimes[old_i] == stat.st_mtime_ns:
+			entries = old_corpus.entries(old_i)
+			keys["versions"] = old_corpus.versions[old_i]
+			keys["hashes"] = old_corpus.hashes[old_i]
+			keys["string_sizes"] = old_corpus.string_sizes[old_i]
+			builder.add(keys, old_corpus.positions[entries], old_corpus.types[entries], old_corpus.lengths[entries], old_corpus.data[entries],
+				old_corpus.strings[old_corpus.string_starts[old_i]:old_corpus.string_starts[old_i + 1]])
+			reused_count += 1
+			continue
+		
+		try:
+			chart = fsgmub_chart.load_fsgmub(chart_filename)
+		except (OSError, ValueError, struct.error) as e:
+			log("Warning: skipping chart {}, {}".format(chart_path, e))
+			continue
+		keys["versions"] = chart.version
+		keys["hashes"] = chart.hash
+		keys["string_sizes"] = chart.string_size
+		builder.add(keys, np.asarray(chart.positions), np.asarray(chart.types), np.asarray(chart.lengths), np.asarray(chart.data),
+			np.frombuffer(chart.strings, dtype=np.uint8))
+		read_count += 1
+	
+	log("Read {} charts, reused {} unchanged charts".format(read_count, reused_count))
+	return builder.corpus()
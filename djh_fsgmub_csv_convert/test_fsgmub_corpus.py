@@ -0,0 +1,74 @@
+"""
+MIT License
+
+Copyright (c) 2019 shockdude
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# Tests for fsgmub_corpus
+# Run with: python -m unittest discover djh_fsgmub_csv_convert
+
+import unittest
+
+import numpy as np
+
+from fsgmub_corpus import CHART_COLUMNS, CorpusBuilder
+
+CHART_BEGIN = 0xFFFFFFFF
+CHART_BPM = 0x0B000002
+NOTE_TYPE = 4156
+
+def build_test_corpus(charts_types):
+	builder = CorpusBuilder()
+	for i, types in enumerate(charts_types):
+		keys = {name: 0 for name in CHART_COLUMNS}
+		keys["paths"] = "song{}/DJ_Expert.xmk".format(i)
+		keys["songs"] = "song{}".format(i)
+		keys["difficulties"] = "DJ_Expert"
+		num_entries = len(types)
+		builder.add(keys, np.arange(num_entries, dtype=np.float32), np.array(types, dtype=np.uint32),
+			np.zeros(num_entries, dtype=np.float32), np.zeros(num_entries, dtype=np.uint32), np.zeros(0, dtype=np.uint8))
+	return builder.corpus()
+
+class TypeCountsTest(unittest.TestCase):
+	def test_chart_counts_with_chart_begin(self):
+		# CHART_BEGIN is above 0x7FFFFFFF, and is in every chart
+		corpus = build_test_corpus([
+			[CHART_BEGIN, NOTE_TYPE],
+			[CHART_BEGIN, CHART_BPM, NOTE_TYPE, NOTE_TYPE],
+		])
+		note_types, entry_counts, chart_counts = corpus.type_counts()
+		self.assertEqual(note_types.tolist(), [NOTE_TYPE, CHART_BPM, CHART_BEGIN])
+		self.assertEqual(entry_counts.tolist(), [3, 1, 2])
+		self.assertEqual(chart_counts.tolist(), [2, 1, 2])
+	
+	def test_chart_counts_of_selected_charts(self):
+		corpus = build_test_corpus([
+			[CHART_BEGIN, NOTE_TYPE],
+			[CHART_BEGIN, CHART_BPM],
+			[CHART_BEGIN, CHART_BPM, NOTE_TYPE],
+		])
+		note_types, entry_counts, chart_counts = corpus.type_counts([1, 2])
+		self.assertEqual(note_types.tolist(), [NOTE_TYPE, CHART_BPM, CHART_BEGIN])
+		self.assertEqual(entry_counts.tolist(), [1, 2, 2])
+		self.assertEqual(chart_counts.tolist(), [1, 2, 2])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,139 @@
+"""
+MIT License
+
+Copyright (c) 2019 shockdude
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# DJ Hero FSB inspector v0.1
+# Check FSBs built by djh_mp3_to_fsb.py or djh_fss_to_fsb.py and extract their MP3 streams
+
+import os, sys
+
+from fsb4 import Fsb4File, Fsb4Error
+from mp3_frames import SAMPLES_PER_FRAME
+
+FSB_EXTENSION = ".fsb"
+MP3_EXTENSION = ".mp3"
+
+EXTRACT_FLAG = "-x"
+EXTRACT_ALL = "all"
+
+def usage():
+	print("DJ FSB Inspector Usage: {} input.fsb".format(sys.argv[0]))
+	print("Extract Usage: {} input.fsb {} stream_number [output.mp3]".format(sys.argv[0], EXTRACT_FLAG))
+	print("Extract All Usage: {} input.fsb {} {}".format(sys.argv[0], EXTRACT_FLAG, EXTRACT_ALL))
+	print("Prints the FSB's sample headers and the frame count of each MP3 stream, and checks that they agree.")
+	print("Streams are numbered in file order: for DJ FSBs 0/1/2 are green/blue/red, for guitar FSBs 0/1 are guitar/song,")
+	print("and for FSS FSBs each sample is one stream.")
+	print("Extracted streams are written as-is, without decoding; the default output is input_N.mp3 next to the FSB.")
+	sys.exit(1)
+
+def print_fsb(fsb):
+	# returns the number of problems found
+	problems = 0
+	# index the frames of every MP3 sample
+	fsb.streams()
+	print("FSB4 {}: {} samples, version 0x{:X}, header mode 0x{:X}, data size {}".format(fsb.filename, len(fsb.samples), fsb.version, fsb.header_mode, fsb.data_size))
+	stream_number = 0
+	total_stream_size = 0
+	for i, sample in enumerate(fsb.samples):
+		total_stream_size += sample.stream_size
+		print("Sample {}: {}".format(i, sample.name))
+		print("\tformat {}, {}Hz, {} channels, {} samples ({:.2f}s), stream size {}, mode 0x{:X}".format(sample.format_name(),
+			sample.sample_rate, sample.channels, sample.num_samples, sample.duration(), sample.stream_size, sample.mode))
+		if not sample.is_mp3():
+			continue
+		
+		streams = sample.streams
+		for stream in streams:
+			print("\tstream {}: {} frames, {}kbps".format(stream_number, len(stream), int(stream.bitrate/1000)))
+			stream_number += 1
+		if len(streams) == 0:
+			print("Warning: sample {} has no MP3 frames".format(i))
+			problems += 1
+			continue
+		frame_counts = [len(stream) for stream in streams]
+		if min(frame_counts) != max(frame_counts):
+			print("Warning: sample {} streams have different frame counts {}".format(i, frame_counts))
+			problems += 1
+		if frame_counts[0] * SAMPLES_PER_FRAME != sample.num_samples:
+			print("Warning: sample {} header has {} samples, but its frames hold {}".format(i, sample.num_samples, frame_counts[0] * SAMPLES_PER_FRAME))
+			problems += 1
+	if total_stream_size != fsb.data_size:
+		print("Warning: sample streams add up to {} bytes, but the FSB header has data size {}".format(total_stream_size, fsb.data_size))
+		problems += 1
+	
+	if problems == 0:
+		print("No problems found")
+	else:
+		print("{} problems found".format(problems))
+	return problems
+
+def extract_stream(fsb, stream_number, stream, mp3_outfilename):
+	with open(mp3_outfilename, "wb") as mp3_out:
+		fsb.write_stream(stream, mp3_out)
+	print("Wrote stream {} ({} frames) to {}".format(stream_number, len(stream), mp3_outfilename))
+
+def main():
+	if len(sys.argv) < 2:
+		usage()
+	
+	fsb_filename = sys.argv[1]
+	if os.path.splitext(fsb_filename)[1].lower() != FSB_EXTENSION:
+		print("Error: file {} is not an FSB".format(fsb_filename))
+		usage()
+	
+	try:
+		with Fsb4File(fsb_filename) as fsb:
+			if len(sys.argv) == 2:
+				if print_fsb(fsb) > 0:
+					sys.exit(1)
+				return
+			
+			if sys.argv[2] != EXTRACT_FLAG or len(sys.argv) < 4:
+				usage()
+			streams = fsb.streams()
+			if len(streams) == 0:
+				print("Error: {} has no MP3 streams to extract".format(fsb_filename))
+				usage()
+			fsb_name = os.path.splitext(fsb_filename)[0]
+			if sys.argv[3] == EXTRACT_ALL:
+				for i, stream in enumerate(streams):
+					extract_stream(fsb, i, stream, "{}_{}{}".format(fsb_name, i, MP3_EXTENSION))
+				return
+			
+			try:
+				stream_number = int(sys.argv[3])
+			except ValueError:
+				stream_number = -1
+			if stream_number < 0 or stream_number >= len(streams):
+				print("Error: stream number must be {} or 0 to {}".format(EXTRACT_ALL, len(streams) - 1))
+				usage()
+			mp3_outfilename = "{}_{}{}".format(fsb_name, stream_number, MP3_EXTENSION)
+			if len(sys.argv) >= 5:
+				mp3_outfilename = sys.argv[4]
+			extract_stream(fsb, stream_number, streams[stream_number], mp3_outfilename)
+	except Fsb4Error as e:
+		print("Error: {}".format(e))
+		usage()
+
+if __name__ == "__main__":
+	main()
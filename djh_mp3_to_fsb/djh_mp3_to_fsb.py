@@ -22,12 +22,23 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-# DJ Hero FSB builder v1.0
+# DJ Hero FSB builder v1.6
 # Convert MP3s to FSBs playable in DJ Hero
 
 import os, sys
 import struct
+import mmap
+import csv
 from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+
+import mp3_frames
+import mp3_check
+from mp3_frames import SAMPLES_PER_FRAME
+from fsb_cache import FsbCache
+
+# part of the build cache key, bump along with the version above when the output changes
+FSB_BUILDER = "djh_mp3_to_fsb 1.5"
 
 OUTPUT_FSB = "output.fsb"
 
@@ -35,139 +46,471 @@ FSB_EXTENSION = ".fsb"
 MP3_EXTENSION = ".mp3"
 WAV_EXTENSION = ".wav"
 
-# references
-# http://www.mp3-tech.org/programmer/frame_header.html
-# https://hydrogenaud.io/index.php/topic,85125.0.html
+SAMPLE_RATE_WII = 32000
+SAMPLE_RATE_PS3 = 44100
 
-# tagging
-TAG_PREFIX = b"TAG"
-ID3_PREFIX = b"ID3"
-INFO_TAG_SILENCE = (0,0,0,0,0,0,0,0)
-INFO_TAG_ID = (1868983881, 1735289176) # Info, Xing in little endian
-INFO_TAG_READSIZE = 0x24
+BITRATE_DEFAULT = 160000
 
-# MPEG v1: frame size = 1152 samples/frame * bitrate / samplerate / 8 bits/byte
-#                     = 144 * bitrate / samplerate
-SAMPLES_PER_FRAME = 1152
-MPEG_MAGIC = SAMPLES_PER_FRAME / 8
-MP3_HEADER_SIZE = 4
+# FSB4 header followed by one sample header
+FSB4_HEADER_SIZE = 0x30
+SAMPLE_HEADER_SIZE = 0x50
+FSB_HEADER_SIZE = FSB4_HEADER_SIZE + SAMPLE_HEADER_SIZE
 
-MPEG_VERSION_1 = 1
-MP3_BITRATES = (None, 32000, 40000, 48000, 56000, 64000, 80000, 96000, 112000, 128000, 160000, 192000, 224000, 256000, 320000, None)
-MP3_SAMPLERATES = (44100, 48000, 32000, None)
+# all fsb frames must be 0x10 aligned
+FRAME_ALIGN = 0x10
+FRAME_PADDING = bytes(FRAME_ALIGN)
+# interleaved frames are collected in a buffer of this size before being written
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
 
-SAMPLE_RATE_WII = 32000
-SAMPLE_RATE_PS3 = 44100
+# streaming mode: header is patched after the frames are written
+STREAM_FLAG = "--stream"
+# read an MP3 from stdin when streaming
+STDIN_ARG = "-"
 
-BITRATE_DEFAULT = 160000
+# batch mode
+BATCH_FLAG = "--batch"
+JOBS_FLAG = "-j"
+BATCH_OUTPUT_FSB = "DJ.fsb"
+# MP3 names looked for in each song folder
+DJ_STEMS = ("green", "blue", "red")
+GUITAR_STEMS = ("guitar", "song")
+MANIFEST_COMMENT = "//"
 
-fsb_sample_rate = None
-fsb_bitrate = None
+# build cache: reuse FSBs built from the same MP3s
+CACHE_FLAG = "--cache"
 
-def write_fsb_header(fsb_outfile, mp3_count, wav_filename, num_frames, fsb_size):
-	# credit to vgmstream & fsbext for the fsb documentation
-	
-	header_size = 0x50
-	num_samples = num_frames * SAMPLES_PER_FRAME
-	loop_start = 0
-	loop_end = num_samples - 1
-	stream_size = fsb_size
-	sample_data_size = fsb_size
-	mode = 0x4000200
-	num_channels = mp3_count * 2
-	wav_name = os.path.basename(wav_filename).encode("utf-8")
-	
-	fsb_outfile.write(struct.pack("<4sIII", "FSB4".encode("utf-8"), 1, header_size, sample_data_size))
-	fsb_outfile.write(struct.pack("<IIII", 0x40000, 0x20, 0, 0))
-	fsb_outfile.write(struct.pack("<IIII", 0, 0, 0, 0))
-	fsb_outfile.write(struct.pack("<H30s", header_size, wav_name))
-	fsb_outfile.write(struct.pack("<IIII", num_samples, stream_size, loop_start, loop_end))
-	fsb_outfile.write(struct.pack("<IIHHHH", mode, fsb_sample_rate, 0xFF, 0x80, 0x80, num_channels))
-	fsb_outfile.write(struct.pack("<IIII", 1065353216, 1176256512, 0, 0))
+# check mode: report every bad frame and format change in the MP3s, without building an FSB
+CHECK_FLAG = "--check"
 
-def check_frame_get_size(header, mp3_filename):
-	global fsb_sample_rate
-	global fsb_bitrate
+class FsbBuildError(Exception):
+	pass
+
+class FsbBuild:
+	# everything needed to build one FSB, so that several builds can run in one process
+	def __init__(self, mp3_filenames, fsb_outfilename, log=print):
+		self.mp3_filenames = mp3_filenames
+		self.fsb_outfilename = fsb_outfilename
+		self.log = log
+		self.sample_rate = None
+		self.bitrate = None
+		self.mp3_indexes = []
+		self.num_frames = 0
+		self.fsb_size = 0
 	
-	header_bytes = struct.unpack("BBBB", header)
+	def write_fsb_header(self, fsb_outfile):
+		# credit to vgmstream & fsbext for the fsb documentation
+		
+		header_size = SAMPLE_HEADER_SIZE
+		num_samples = self.num_frames * SAMPLES_PER_FRAME
+		loop_start = 0
+		loop_end = num_samples - 1
+		stream_size = self.fsb_size
+		sample_data_size = self.fsb_size
+		mode = 0x4000200
+		num_channels = len(self.mp3_filenames) * 2
+		wav_name, fsb_outfilename_ext = os.path.splitext(os.path.basename(self.fsb_outfilename))
+		wav_name = (wav_name + WAV_EXTENSION).encode("utf-8")
+		
+		fsb_outfile.write(struct.pack("<4sIII", "FSB4".encode("utf-8"), 1, header_size, sample_data_size))
+		fsb_outfile.write(struct.pack("<IIII", 0x40000, 0x20, 0, 0))
+		fsb_outfile.write(struct.pack("<IIII", 0, 0, 0, 0))
+		fsb_outfile.write(struct.pack("<H30s", header_size, wav_name))
+		fsb_outfile.write(struct.pack("<IIII", num_samples, stream_size, loop_start, loop_end))
+		fsb_outfile.write(struct.pack("<IIHHHH", mode, self.sample_rate, 0xFF, 0x80, 0x80, num_channels))
+		fsb_outfile.write(struct.pack("<IIII", 1065353216, 1176256512, 0, 0))
 	
-	# check frame sync
-	if header_bytes[0] != 0xFF or ((header_bytes[1] >> 4) & 0xF) != 0xF:
-		print("Error: failed to parse MP3 {}, unexpected MP3 frame sync".format(mp3_filename))
-		usage()
+	def log_tags(self, mp3_index):
+		mp3_filename = mp3_index.filename
+		if mp3_index.id3_version == 2:
+			self.log("Note: MP3 file {} has ID3v2 tags, size {}".format(mp3_filename, mp3_index.id3_size))
+		elif mp3_index.id3_version == 1:
+			self.log("Note: MP3 file {} has ID3v1 tags, size {}".format(mp3_filename, mp3_index.id3_size))
+		if mp3_index.info_size > 0:
+			self.log("Note: MP3 file {} has Info tag, size {}".format(mp3_filename, mp3_index.info_size))
 	
-	# check mpeg version is v1
-	if ((header_bytes[1] >> 3) & 0x1) != MPEG_VERSION_1:
-		print("Error: failed to parse MP3 {}, not mpeg v1".format(mp3_filename))
-		usage()
+	def log_truncated(self, mp3_index):
+		if mp3_index.truncated:
+			self.log("Warning: MP3 file {} ends with an incomplete frame, ignoring it".format(mp3_index.filename))
 	
-	# check mpeg layer 3
-	if ((header_bytes[1] >> 1)) & 0x3 != 0x1:
-		print("Error: failed to parse MP3 {}, not layer 3".format(mp3_filename))
-		usage()
+	def index_mp3(self, mp3_filename):
+		# index the MP3's frames and check that it matches the other MP3s
+		try:
+			mp3_index = mp3_frames.index_mp3(mp3_filename)
+		except mp3_frames.Mp3Error as e:
+			raise FsbBuildError(e)
+		
+		self.log_tags(mp3_index)
+		self.log_truncated(mp3_index)
+		if len(mp3_index) > 0:
+			self.check_format(mp3_index)
+		return mp3_index
 	
-	# check bitrate
-	bitrate = MP3_BITRATES[((header_bytes[2] >> 4) & 0xF)]
-	if bitrate == None:
-		print("Error: failed to parse MP3 {}, unsupported bitrate".format(mp3_filename))
-		usage()
-	if bitrate != fsb_bitrate:
-		if fsb_bitrate == None:
-			fsb_bitrate = bitrate
-			print("Got bitrate: {}kbps".format(int(bitrate/1000)))
-			if fsb_bitrate == BITRATE_DEFAULT:
-				print("Note: Same bitrate as Wii/PS3")
-			elif fsb_bitrate > BITRATE_DEFAULT:
-				print("Note: Higher bitrate than Wii/PS3 (160kbps)")
+	def check_format(self, mp3_index):
+		# check bitrate
+		bitrate = mp3_index.bitrate
+		if bitrate != self.bitrate:
+			if self.bitrate == None:
+				self.bitrate = bitrate
+				self.log("Got bitrate: {}kbps".format(int(bitrate/1000)))
+				if self.bitrate == BITRATE_DEFAULT:
+					self.log("Note: Same bitrate as Wii/PS3")
+				elif self.bitrate > BITRATE_DEFAULT:
+					self.log("Note: Higher bitrate than Wii/PS3 (160kbps)")
+				else:
+					self.log("Warning: Lower bitrate than Wii/PS3 (160kbps)")
+			else:
+				raise FsbBuildError("MP3s do not all have the same constant bitrate. Got bitrate {}kbps".format(int(bitrate/1000)))
+			
+		# check sample rate
+		sample_rate = mp3_index.sample_rate
+		if sample_rate != self.sample_rate:
+			if self.sample_rate == None:
+				self.sample_rate = sample_rate
+				self.log("Got sample rate: {}Hz".format(sample_rate))
+				if self.sample_rate == SAMPLE_RATE_WII:
+					self.log("Ideal sample rate for Wii")
+				elif self.sample_rate == SAMPLE_RATE_PS3:
+					self.log("Ideal sample rate for PS3/360")
+				else:
+					self.log("Note: Not an ideal sample rate for either Wii or PS3, but should be ok.")
 			else:
-				print("Warning: Lower bitrate than Wii/PS3 (160kbps)")
+				raise FsbBuildError("MP3s do not all have the same sample rate. Got sample rate {}Hz".format(sample_rate))
+	
+	def scan(self):
+		mp3_count = len(self.mp3_filenames)
+		if mp3_count < 2 or mp3_count > 3:
+			raise FsbBuildError("must specify 2 or 3 MP3s")
+		
+		# index each mp3 once: tags, Info frame and the offset/size of every frame
+		self.mp3_indexes = [self.index_mp3(mp3_filename) for mp3_filename in self.mp3_filenames]
+		frame_sizes = [mp3_index.sizes for mp3_index in self.mp3_indexes]
+		frame_counts = [len(mp3_index) for mp3_index in self.mp3_indexes]
+		
+		# count the number of mp3 frames
+		self.num_frames = min(frame_counts)
+		if self.num_frames == 0:
+			raise FsbBuildError("at least one MP3 file is invalid, 0 mp3 frames detected")
+		if sum(frame_counts) > self.num_frames * mp3_count:
+			self.log("Warning: mp3s are not the same length/do not have the same number of frames")
+			self.log("Frame counts: {}".format(frame_counts))
+			self.log("Using the smallest number of frames: {}".format(self.num_frames))
 		else:
-			print("Error: MP3s do not all have the same constant bitrate. Got bitrate {}kbps".format(int(bitrate/1000)))
-			usage()
+			self.log("Counted {} frames per MP3".format(self.num_frames))
 		
-	# check sample rate
-	sample_rate = MP3_SAMPLERATES[((header_bytes[2] >> 2) & 0x3)]
-	if sample_rate == None:
-		print("Error: failed to parse MP3 {}, unsupported sample rate".format(mp3_filename))
-		usage()
-	if sample_rate != fsb_sample_rate:
-		if fsb_sample_rate == None:
-			fsb_sample_rate = sample_rate
-			print("Got sample rate: {}Hz".format(sample_rate))
-			if fsb_sample_rate == SAMPLE_RATE_WII:
-				print("Ideal sample rate for Wii")
-			elif fsb_sample_rate == SAMPLE_RATE_PS3:
-				print("Ideal sample rate for PS3/360")
+		# compute fsb size by adding up the frame sizes
+		self.fsb_size = 0
+		for i in range(mp3_count):
+			for frame_size in frame_sizes[i][:self.num_frames]:
+				self.fsb_size += frame_size + (-frame_size % FRAME_ALIGN)
+		self.log("Total FSB size: {}".format(self.fsb_size))
+	
+	def write_interleaved_frames(self, fsb_out):
+		# ExitStack for opening a variable number of files
+		with ExitStack() as stack:
+			mp3_views = []
+			for mp3_filename in self.mp3_filenames:
+				mp3_file = stack.enter_context(open(mp3_filename, "rb"))
+				mp3_map = stack.enter_context(mmap.mmap(mp3_file.fileno(), 0, access=mmap.ACCESS_READ))
+				mp3_views.append(stack.enter_context(memoryview(mp3_map)))
+			streams = [(mp3_views[i], self.mp3_indexes[i].offsets, self.mp3_indexes[i].sizes) for i in range(len(mp3_views))]
+			
+			# copy frames from the mapped mp3s into one reusable buffer, and write it out when full
+			buffer = bytearray(WRITE_BUFFER_SIZE)
+			buffer_view = memoryview(buffer)
+			pos = 0
+			for f in range(self.num_frames):
+				for mp3_view, offsets, sizes in streams:
+					frame_offset = offsets[f]
+					frame_size = sizes[f]
+					padding = -frame_size % FRAME_ALIGN
+					if pos + frame_size + padding > WRITE_BUFFER_SIZE:
+						fsb_out.write(buffer_view[:pos])
+						pos = 0
+					buffer[pos:pos + frame_size] = mp3_view[frame_offset:frame_offset + frame_size]
+					pos += frame_size
+					buffer[pos:pos + padding] = FRAME_PADDING[:padding]
+					pos += padding
+			fsb_out.write(buffer_view[:pos])
+			buffer_view.release()
+	
+	def build(self):
+		self.scan()
+		with open(self.fsb_outfilename, "wb") as fsb_out:
+			self.write_fsb_header(fsb_out)
+			self.write_interleaved_frames(fsb_out)
+		self.log("Wrote FSB {}".format(self.fsb_outfilename))
+	
+	def stream_frames(self, fsb_out, readers):
+		# interleave frames as they are read, until the shortest MP3 ends
+		buffer = bytearray()
+		frames = [reader.read_frame() for reader in readers]
+		while None not in frames:
+			for frame in frames:
+				buffer += frame
+				buffer += FRAME_PADDING[:-len(frame) % FRAME_ALIGN]
+			self.num_frames += 1
+			if len(buffer) >= WRITE_BUFFER_SIZE:
+				fsb_out.write(buffer)
+				self.fsb_size += len(buffer)
+				buffer.clear()
+			frames = [reader.read_frame() for reader in readers]
+		fsb_out.write(buffer)
+		self.fsb_size += len(buffer)
+	
+	def build_streaming(self):
+		# write the frames while scanning the MP3s, then go back and fill in the header
+		# the MP3s are only read once in order, so they can be pipes
+		mp3_count = len(self.mp3_filenames)
+		if mp3_count < 2 or mp3_count > 3:
+			raise FsbBuildError("must specify 2 or 3 MP3s")
+		if self.mp3_filenames.count(STDIN_ARG) > 1:
+			raise FsbBuildError("only one MP3 can be read from stdin")
+		
+		self.num_frames = 0
+		self.fsb_size = 0
+		with ExitStack() as stack:
+			readers = []
+			for mp3_filename in self.mp3_filenames:
+				if mp3_filename == STDIN_ARG:
+					mp3_file = sys.stdin.buffer
+				else:
+					mp3_file = stack.enter_context(open(mp3_filename, "rb"))
+				readers.append(mp3_frames.Mp3FrameReader(mp3_file, mp3_filename))
+			
+			fsb_out = stack.enter_context(open(self.fsb_outfilename, "wb"))
+			try:
+				for reader in readers:
+					mp3_index = reader.read_tags()
+					self.log_tags(mp3_index)
+					if mp3_index.bitrate != None:
+						self.check_format(mp3_index)
+				
+				# reserve the header
+				fsb_out.write(bytes(FSB_HEADER_SIZE))
+				self.stream_frames(fsb_out, readers)
+				
+				# read the rest of the longer MP3s, so the frame counts can be reported
+				frame_counts = [reader.drain() for reader in readers]
+				for reader in readers:
+					self.log_truncated(reader.index)
+				if self.num_frames == 0:
+					raise FsbBuildError("at least one MP3 file is invalid, 0 mp3 frames detected")
+			except (mp3_frames.Mp3Error, FsbBuildError) as e:
+				# don't leave an FSB without a header behind
+				fsb_out.close()
+				os.remove(self.fsb_outfilename)
+				raise FsbBuildError(e)
+			
+			if sum(frame_counts) > self.num_frames * mp3_count:
+				self.log("Warning: mp3s are not the same length/do not have the same number of frames")
+				self.log("Frame counts: {}".format(frame_counts))
+				self.log("Using the smallest number of frames: {}".format(self.num_frames))
 			else:
-				print("Note: Not an ideal sample rate for either Wii or PS3, but should be ok.")
+				self.log("Counted {} frames per MP3".format(self.num_frames))
+			self.log("Total FSB size: {}".format(self.fsb_size))
+			
+			fsb_out.seek(0)
+			self.write_fsb_header(fsb_out)
+		self.log("Wrote FSB {}".format(self.fsb_outfilename))
+	
+	def build_cached(self, cache, streaming=False):
+		# returns True if the FSB was taken from the cache instead of being built
+		build_function = self.build
+		if streaming:
+			build_function = self.build_streaming
+		if cache is None:
+			build_function()
+			return False
+		
+		# the output name is part of the key since it's stored in the FSB header
+		key = cache.key(FSB_BUILDER, self.mp3_filenames, [os.path.basename(self.fsb_outfilename)])
+		if key is None:
+			self.log("Note: not caching {}, MP3s that aren't regular files can't be hashed".format(self.fsb_outfilename))
+		if cache.build(key, self.fsb_outfilename, build_function):
+			self.log("MP3s unchanged, using cached FSB for {}".format(self.fsb_outfilename))
+			return True
+		return False
+
+def build_fsb_job(mp3_filenames, fsb_outfilename, streaming, cache_dir):
+	# runs in a batch worker process, returns (success, cached, messages)
+	messages = []
+	build = FsbBuild(mp3_filenames, fsb_outfilename, messages.append)
+	try:
+		cache = None
+		if cache_dir is not None:
+			cache = FsbCache(cache_dir)
+		cached = build.build_cached(cache, streaming)
+	except (FsbBuildError, OSError) as e:
+		messages.append("Error: {}".format(e))
+		return False, False, messages
+	return True, cached, messages
+
+def find_song_folders(songs_dir):
+	# every subfolder with green/blue/red MP3s (or guitar/song MP3s) is one FSB
+	jobs = []
+	for folder_name in sorted(os.listdir(songs_dir)):
+		folder = os.path.join(songs_dir, folder_name)
+		if not os.path.isdir(folder):
+			continue
+		mp3s = {}
+		for filename in os.listdir(folder):
+			name, ext = os.path.splitext(filename)
+			if ext.lower() == MP3_EXTENSION:
+				mp3s[name.lower()] = os.path.join(folder, filename)
+		for stems in (DJ_STEMS, GUITAR_STEMS):
+			if all(stem in mp3s for stem in stems):
+				jobs.append(([mp3s[stem] for stem in stems], os.path.join(folder, BATCH_OUTPUT_FSB)))
+				break
 		else:
-			print("Error: MP3s do not all have the same sample rate. Got sample rate {}Hz".format(sample_rate))
-			usage()
+			print("Note: skipping folder {}, no green/blue/red or guitar/song MP3s".format(folder))
+	return jobs
+
+def read_manifest(manifest_filename):
+	# one FSB per row: green.mp3,blue.mp3,red.mp3[,output.fsb] or guitar.mp3,song.mp3[,output.fsb]
+	# paths are relative to the manifest, rows starting with // are comments
+	jobs = []
+	manifest_dir = os.path.dirname(os.path.abspath(manifest_filename))
+	with open(manifest_filename, "r", newline='') as manifest_file:
+		for row in csv.reader(manifest_file):
+			row = [item.strip() for item in row if item.strip() != ""]
+			if len(row) == 0 or row[0].startswith(MANIFEST_COMMENT):
+				continue
+			paths = [os.path.join(manifest_dir, item) for item in row]
+			if os.path.splitext(paths[-1])[1].lower() == FSB_EXTENSION:
+				jobs.append((paths[:-1], paths[-1]))
+			else:
+				jobs.append((paths, os.path.join(os.path.dirname(paths[0]), BATCH_OUTPUT_FSB)))
+	return jobs
+
+def batch_main(batch_source, num_workers, streaming, cache_dir):
+	if os.path.isdir(batch_source):
+		jobs = find_song_folders(batch_source)
+	else:
+		jobs = read_manifest(batch_source)
+	print("Building {} FSBs".format(len(jobs)))
 	
-	# check padding bit
-	padding = ((header_bytes[2] >> 1) & 0x1)
+	failed = []
+	cached_count = 0
+	with ProcessPoolExecutor(max_workers=num_workers) as executor:
+		futures = [executor.submit(build_fsb_job, mp3_filenames, fsb_outfilename, streaming, cache_dir) for mp3_filenames, fsb_outfilename in jobs]
+		# report in job order
+		for (mp3_filenames, fsb_outfilename), future in zip(jobs, futures):
+			try:
+				success, cached, messages = future.result()
+			except Exception as e:
+				success, cached, messages = False, False, ["Error: {}".format(e)]
+			if success and cached:
+				print("OK (cached): {}".format(fsb_outfilename))
+				cached_count += 1
+			elif success:
+				print("OK: {}".format(fsb_outfilename))
+			else:
+				print("FAILED: {}".format(fsb_outfilename))
+				failed.append(fsb_outfilename)
+			for message in messages:
+				if message.startswith("Warning") or message.startswith("Error"):
+					print("\t{}".format(message))
 	
-	return int(MPEG_MAGIC * bitrate / sample_rate) + padding
+	print("Built {} of {} FSBs ({} from cache)".format(len(jobs) - len(failed), len(jobs), cached_count))
+	if len(failed) > 0:
+		print("Failed:")
+		for fsb_outfilename in failed:
+			print("\t{}".format(fsb_outfilename))
+		sys.exit(1)
+
+def check_main(mp3_filenames, num_workers):
+	print("Checking {} MP3s".format(len(mp3_filenames)))
+	try:
+		reports = mp3_check.check_mp3s(mp3_filenames, num_workers)
+	except OSError as e:
+		print("Error: {}".format(e))
+		usage()
+	
+	failed_count = 0
+	for report in reports:
+		if report.ok():
+			print("OK: {} ({} frames, {}kbps, {}Hz)".format(report.filename, report.frame_count, int(report.bitrate/1000), report.sample_rate))
+		else:
+			print("FAILED: {} ({} problems in {} frames)".format(report.filename, len(report.problems), report.frame_count))
+			for problem in report.problems:
+				print("\t{}".format(report.describe(problem)))
+			failed_count += 1
 	
+	print("{} of {} MP3s OK".format(len(reports) - failed_count, len(reports)))
+	if failed_count > 0:
+		sys.exit(1)
+
 def usage():
 	print("DJ FSB Usage: {} green_track.mp3 blue_track.mp3 red_track.mp3 [output.fsb]".format(sys.argv[0]))
 	print("Guitar FSB Usage: {} guitar.mp3 song.mp3 [output.fsb]".format(sys.argv[0]))
+	print("Streaming Usage: {} {} green_track blue_track red_track [output.fsb]".format(sys.argv[0], STREAM_FLAG))
+	print("Batch Usage: {} {} [{} jobs] [songs_folder or manifest.csv]".format(sys.argv[0], BATCH_FLAG, JOBS_FLAG))
+	print("Check Usage: {} {} [{} jobs] track1.mp3 [track2.mp3 ...]".format(sys.argv[0], CHECK_FLAG, JOBS_FLAG))
+	print("Options can be combined, and {} cache_folder reuses FSBs already built from the same MP3s in any mode.".format(CACHE_FLAG))
 	print("All MP3s must be 32/44.1/48khz, constant bitrate (preferably 160kbps or higher)")
 	print("The default output filename is \"output.fsb\"; specifying a different output filename is optional.")
+	print("Batch mode builds {} in every subfolder of songs_folder that has green/blue/red.mp3 or guitar/song.mp3,".format(BATCH_OUTPUT_FSB))
+	print("or one FSB per row of manifest.csv: green.mp3,blue.mp3,red.mp3[,output.fsb]")
+	print("Streaming mode reads each MP3 once, so the inputs can be pipes; use {} to read one MP3 from stdin.".format(STDIN_ARG))
+	print("Check mode lists every bad frame, bitrate change and sample rate change in the MP3s at once.")
 	sys.exit(1)
 
 def main():
-	if len(sys.argv) < 3:
+	file_args = sys.argv[1:]
+	batch = False
+	streaming = False
+	num_workers = None
+	cache_dir = None
+	check = False
+	# options come before the files
+	while len(file_args) > 0 and file_args[0] in (BATCH_FLAG, STREAM_FLAG, JOBS_FLAG, CACHE_FLAG, CHECK_FLAG):
+		option = file_args.pop(0)
+		if option == BATCH_FLAG:
+			batch = True
+		elif option == STREAM_FLAG:
+			streaming = True
+		elif option == CHECK_FLAG:
+			check = True
+		elif option == JOBS_FLAG:
+			try:
+				num_workers = int(file_args.pop(0))
+				if num_workers < 1:
+					raise ValueError
+			except (IndexError, ValueError):
+				print("Error: {} requires a positive number of jobs".format(JOBS_FLAG))
+				usage()
+		elif option == CACHE_FLAG:
+			if len(file_args) == 0:
+				print("Error: {} requires a cache folder".format(CACHE_FLAG))
+				usage()
+			cache_dir = file_args.pop(0)
+	
+	if check:
+		if len(file_args) < 1:
+			print("Error: {} requires MP3s to check".format(CHECK_FLAG))
+			usage()
+		check_main(file_args, num_workers)
+		return
+	if batch:
+		if len(file_args) < 1:
+			print("Error: {} requires a songs folder or a manifest".format(BATCH_FLAG))
+			usage()
+		batch_main(file_args[0], num_workers, streaming, cache_dir)
+		return
+	if num_workers is not None:
+		print("Error: {} is only used with {} or {}".format(JOBS_FLAG, BATCH_FLAG, CHECK_FLAG))
+		usage()
+	if len(file_args) < 2:
 		print("Error: not enough arguments")
 		usage()
 	
-	file_args = sys.argv[1:]
 	mp3_count = 0
 	mp3_filenames = []
 	fsb_outfilename = OUTPUT_FSB
 	for file_arg in file_args:
 		file_arg_name, file_arg_ext = os.path.splitext(file_arg)
-		if file_arg_ext.lower() == MP3_EXTENSION:
+		# pipes such as /dev/fd/N or stdin have no extension, so anything but an fsb is an input when streaming
+		if file_arg_ext.lower() == MP3_EXTENSION or (streaming and file_arg_ext.lower() != FSB_EXTENSION):
 			if mp3_count == 3:
 				print("Error: too many input MP3s")
 				usage()
@@ -194,113 +537,16 @@ def main():
 	else:
 		print("Invalid MP3 count {}".format(mp3_count))
 		usage()
-
-	mp3_files = []
-	tag_sizes = []
-	frame_sizes = []
-	frame_counts = []
-	mp3_not_done = []
-	for i in range(mp3_count):
-		mp3_files.append(None)
-		tag_sizes.append(0)
-		frame_sizes.append([])
-		frame_counts.append(0)
-		mp3_not_done.append(True)
-	
-	# check for tags so that they can be ignored
-	for i in range(mp3_count):
-		with open(mp3_filenames[i], "rb") as mp3_files[i]:
-			# check for ID3 tags
-			id3_data = mp3_files[i].read(3)
-			if id3_data == ID3_PREFIX: #ID3v2
-				mp3_files[i].read(3)
-				id3_sizebytes = struct.unpack(">BBBB",mp3_files[i].read(4))
-				tag_sizes[i] = (id3_sizebytes[3] & 0x7F) + ((id3_sizebytes[2] & 0x7F) << 7) + ((id3_sizebytes[1] & 0x7F) << 14) + ((id3_sizebytes[0] & 0x7F) << 21) + 10
-				print("Note: MP3 file {} has ID3v2 tags, size {}".format(mp3_filenames[i], tag_sizes[i]))
-			elif id3_data == TAG_PREFIX: #ID3v1
-				tag_sizes[i] = 256
-				print("Note: MP3 file {} has ID3v1 tags, size {}".format(mp3_filenames[i], tag_sizes[i]))
-			
-			# check for the Info tag
-			mp3_files[i].seek(tag_sizes[i])
-			frame_header = mp3_files[i].read(MP3_HEADER_SIZE)
-			if len(frame_header) < MP3_HEADER_SIZE or frame_header[0:3] == TAG_PREFIX:
-				continue
-			frame_size = check_frame_get_size(frame_header, mp3_filenames[i])
-			mp3_info_tag = mp3_files[i].read(INFO_TAG_READSIZE)
-			if len(mp3_info_tag) != INFO_TAG_READSIZE:
-				continue
-			mp3_info_data = struct.unpack("IIIIIIIII", mp3_info_tag)
-			if mp3_info_data[:8] == INFO_TAG_SILENCE and mp3_info_data[8] in INFO_TAG_ID:
-				print("Note: MP3 file {} has Info tag, size {}".format(mp3_filenames[i], frame_size))
-				tag_sizes[i] += frame_size
-	
-	# count frames in mp3s
-	for i in range(mp3_count):
-		with open(mp3_filenames[i], "rb") as mp3_files[i]:
-			mp3_files[i].seek(tag_sizes[i])
-			reading_mp3 = True
-			while reading_mp3:
-				frame_header = mp3_files[i].read(MP3_HEADER_SIZE)
-				# stop at the end of each MP3
-				if len(frame_header) < MP3_HEADER_SIZE or frame_header[0:3] == TAG_PREFIX:
-					reading_mp3 = False
-					continue
-				frame_size = check_frame_get_size(frame_header, mp3_filenames[i])
-				frame_sizes[i].append(frame_size)
-				frame_counts[i] += 1
-				mp3_files[i].seek(frame_size - MP3_HEADER_SIZE, 1)
 	
-	# count the number of mp3 frames
-	num_frames = min(frame_counts)
-	if num_frames == 0:
-		print("Error: at least one MP3 file is invalid, 0 mp3 frames detected")
+	build = FsbBuild(mp3_filenames, fsb_outfilename)
+	try:
+		cache = None
+		if cache_dir is not None:
+			cache = FsbCache(cache_dir)
+		build.build_cached(cache, streaming)
+	except FsbBuildError as e:
+		print("Error: {}".format(e))
 		usage()
-	if sum(frame_counts) > num_frames * mp3_count:
-		print("Warning: mp3s are not the same length/do not have the same number of frames")
-		print("Frame counts: {}".format(frame_counts))
-		print("Using the smallest number of frames: {}".format(num_frames))
-	else:
-		print("Counted {} frames per MP3".format(num_frames))
-
-	# compute fsb size by adding up the frame sizes
-	fsb_size = 0
-	for i in range(mp3_count):
-		for f in range(num_frames):
-			frame_size = frame_sizes[i][f]
-			fsb_size += frame_size
-			# all fsb frames must be 0x10 aligned
-			offset = frame_size % 0x10
-			if offset > 0:
-				fsb_size += 0x10 - offset
-	print("Total FSB size: {}".format(fsb_size))
-	
-	# write fsb
-	wav_name, fsb_outfilename_ext = os.path.splitext(os.path.basename(fsb_outfilename))
-	wav_name += WAV_EXTENSION
-	with open(fsb_outfilename, "wb") as fsb_out:
-		write_fsb_header(fsb_out, mp3_count, wav_name, num_frames, fsb_size)
-		
-		# ExitStack for opening a variable number of files
-		with ExitStack() as stack:
-			for i in range(mp3_count):
-				mp3_files[i] = stack.enter_context(open(mp3_filenames[i], "rb"))
-				# skip tag headers
-				mp3_files[i].seek(tag_sizes[i])
-			
-			# interleave mp3 frames
-			for f in range(num_frames):
-				for i in range(mp3_count):
-					frame_size = frame_sizes[i][f]
-					fsb_out.write(mp3_files[i].read(frame_size))
-					# all fsb frames must be 0x10 aligned
-					offset = frame_size % 0x10
-					if offset > 0:
-						offset = 0x10 - offset
-						for j in range(offset):
-							fsb_out.write(b"\x00")
-					
-	print("Wrote FSB {}".format(fsb_outfilename))
 
 if __name__ == "__main__":
 	main()
\ No newline at end of file
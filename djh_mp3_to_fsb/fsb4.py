@@ -0,0 +1,212 @@
+"""
+MIT License
+
+Copyright (c) 2019 shockdude
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# DJ Hero FSB4 reader v0.1
+# Reads back the FSBs written by djh_mp3_to_fsb.py and misc/djh_fss_to_fsb.py
+# Maps the FSB, decodes the sample headers and indexes the MP3 frames of each stereo stream,
+# so a stream can be copied back out to an MP3 without decoding it
+
+import os
+import struct
+import mmap
+from array import array
+
+import mp3_frames
+from mp3_frames import MP3_HEADER_SIZE, SAMPLES_PER_FRAME
+
+# credit to vgmstream & fsbext for the fsb documentation
+FSB4_MAGIC = b"FSB4"
+FSB4_HEADER_STRUCT = struct.Struct("<4sIIIII")
+FSB4_HEADER_SIZE = 0x30
+SAMPLE_HEADER_STRUCT = struct.Struct("<H30sIIIIIIHHHH")
+
+# sample modes
+FSOUND_8BITS = 0x8
+FSOUND_16BITS = 0x10
+FSOUND_MONO = 0x20
+FSOUND_STEREO = 0x40
+FSOUND_MPEG = 0x200
+# multichannel MPEG: one frame per stereo stream, interleaved
+FSOUND_MULTICHANNEL = 0x4000000
+
+# frames are padded with zeros, at most to 0x10 alignment
+MAX_FRAME_PADDING = 0x10
+# MPEG channel mode bits, 3 = mono
+MPEG_CHANNEL_MODE_MONO = 3
+# extracted frames are collected in a buffer of this size before being written
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+
+class Fsb4Error(Exception):
+	pass
+
+class Fsb4Sample:
+	def __init__(self, header_data, data_offset):
+		(self.header_size, name, self.num_samples, self.stream_size, self.loop_start, self.loop_end,
+			self.mode, self.sample_rate, self.volume, self.pan, self.priority, self.channels) = SAMPLE_HEADER_STRUCT.unpack_from(header_data)
+		self.name = name.split(b"\x00", 1)[0].decode("utf-8", errors="replace")
+		self.data_offset = data_offset
+		# filled in by Fsb4File.index_frames
+		self.streams = None
+	
+	def is_mp3(self):
+		return (self.mode & FSOUND_MPEG) != 0
+	
+	def format_name(self):
+		if self.is_mp3():
+			return "MP3"
+		if self.mode & FSOUND_16BITS:
+			return "PCM16"
+		if self.mode & FSOUND_8BITS:
+			return "PCM8"
+		return "unknown (mode 0x{:X})".format(self.mode)
+	
+	def duration(self):
+		if self.sample_rate == 0:
+			return 0
+		return self.num_samples / self.sample_rate
+
+class Fsb4Stream:
+	# frame offsets/sizes (relative to the start of the file) of one interleaved MP3 stream
+	def __init__(self, sample, number):
+		self.sample = sample
+		self.number = number
+		self.bitrate = None
+		self.offsets = array("I")
+		self.sizes = array("I")
+	
+	def __len__(self):
+		return len(self.offsets)
+	
+	def num_samples(self):
+		return len(self.offsets) * SAMPLES_PER_FRAME
+
+def read_fsb4_header(data, fsb_filename):
+	if len(data) < FSB4_HEADER_SIZE:
+		raise Fsb4Error("{} is too small to be an FSB".format(fsb_filename))
+	magic, num_samples, sample_headers_size, data_size, version, header_mode = FSB4_HEADER_STRUCT.unpack_from(data)
+	if magic != FSB4_MAGIC:
+		raise Fsb4Error("{} is not an FSB4 file".format(fsb_filename))
+	data_offset = FSB4_HEADER_SIZE + sample_headers_size
+	if data_offset > len(data):
+		raise Fsb4Error("{} is truncated, sample headers end at 0x{:X}".format(fsb_filename, data_offset))
+	
+	samples = []
+	header_pos = FSB4_HEADER_SIZE
+	for i in range(num_samples):
+		if header_pos + SAMPLE_HEADER_STRUCT.size > data_offset:
+			raise Fsb4Error("{} has {} samples, but only room for {} sample headers".format(fsb_filename, num_samples, i))
+		sample = Fsb4Sample(data[header_pos:header_pos + SAMPLE_HEADER_STRUCT.size], data_offset)
+		if sample.header_size < SAMPLE_HEADER_STRUCT.size:
+			raise Fsb4Error("{} sample {} has an invalid header size 0x{:X}".format(fsb_filename, i, sample.header_size))
+		samples.append(sample)
+		header_pos += sample.header_size
+		# samples are stored one after the other
+		data_offset += sample.stream_size
+	if data_offset > len(data):
+		raise Fsb4Error("{} is truncated, sample data ends at 0x{:X} but the file is 0x{:X} bytes".format(fsb_filename, data_offset, len(data)))
+	return version, header_mode, data_size, samples
+
+def index_sample_frames(data, sample, fsb_filename):
+	# walk the MP3 frames of a sample and hand them out to the stereo streams in turn
+	pos = sample.data_offset
+	end = pos + sample.stream_size
+	unpack_header = mp3_frames.HEADER_STRUCT.unpack_from
+	streams = None
+	frame_number = 0
+	while pos + MP3_HEADER_SIZE <= end:
+		# skip the padding after the previous frame
+		padding_end = min(pos + MAX_FRAME_PADDING, end)
+		while pos < padding_end and data[pos] == 0:
+			pos += 1
+		if pos + MP3_HEADER_SIZE > end or data[pos] == 0:
+			break
+		header = unpack_header(data, pos)[0]
+		try:
+			bitrate, sample_rate, frame_size = mp3_frames.parse_frame_header(header, fsb_filename)
+		except mp3_frames.Mp3Error as e:
+			raise Fsb4Error("{} at 0x{:X} in sample {}".format(e, pos, sample.name))
+		if pos + frame_size > end:
+			raise Fsb4Error("{}: frame at 0x{:X} runs past the end of sample {}".format(fsb_filename, pos, sample.name))
+		if streams is None:
+			channels_per_stream = 2
+			if ((header >> 6) & 0x3) == MPEG_CHANNEL_MODE_MONO:
+				channels_per_stream = 1
+			num_streams = 1
+			if sample.mode & FSOUND_MULTICHANNEL:
+				num_streams = max(1, sample.channels // channels_per_stream)
+			streams = [Fsb4Stream(sample, i) for i in range(num_streams)]
+		stream = streams[frame_number % len(streams)]
+		if stream.bitrate is None:
+			stream.bitrate = bitrate
+		stream.offsets.append(pos)
+		stream.sizes.append(frame_size)
+		frame_number += 1
+		pos += frame_size
+	sample.streams = streams or []
+	return sample.streams
+
+class Fsb4File:
+	def __init__(self, fsb_filename):
+		self.filename = fsb_filename
+		self.file = open(fsb_filename, "rb")
+		if os.fstat(self.file.fileno()).st_size == 0:
+			self.file.close()
+			raise Fsb4Error("{} is empty".format(fsb_filename))
+		self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			self.version, self.header_mode, self.data_size, self.samples = read_fsb4_header(self.data, fsb_filename)
+		except Fsb4Error:
+			self.close()
+			raise
+	
+	def close(self):
+		self.data.close()
+		self.file.close()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+	
+	def streams(self):
+		# every MP3 stream of every sample, in file order
+		streams = []
+		for sample in self.samples:
+			if sample.is_mp3():
+				if sample.streams is None:
+					index_sample_frames(self.data, sample, self.filename)
+				streams.extend(sample.streams)
+		return streams
+	
+	def write_stream(self, stream, outfile):
+		# copy the frames of one stream straight out of the mapped FSB, without the padding
+		buffer = bytearray()
+		with memoryview(self.data) as data:
+			for offset, size in zip(stream.offsets, stream.sizes):
+				buffer += data[offset:offset + size]
+				if len(buffer) >= WRITE_BUFFER_SIZE:
+					outfile.write(buffer)
+					buffer.clear()
+		outfile.write(buffer)
@@ -0,0 +1,178 @@
+"""
+MIT License
+
+Copyright (c) 2019 shockdude
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# DJ Hero FSB build cache v0.2
+# Shared by djh_mp3_to_fsb.py and misc/djh_fss_to_fsb.py
+# Keeps built FSBs keyed by a hash of the input files, the builder version and its options,
+# so an unchanged song is copied from the cache instead of being rebuilt
+
+import os
+import stat
+import json
+import hashlib
+import tempfile
+
+# bump to invalidate every cached FSB
+CACHE_VERSION = 1
+
+OBJECTS_DIR = "objects"
+INPUTS_DIR = "inputs"
+FSB_EXTENSION = ".fsb"
+# size and sha256 of each cached FSB, checked before it's used
+INFO_EXTENSION = ".json"
+HASH_READ_SIZE = 1024 * 1024
+
+def remove_file(filename):
+	try:
+		os.remove(filename)
+	except FileNotFoundError:
+		pass
+
+class FsbCache:
+	def __init__(self, cache_dir):
+		self.cache_dir = cache_dir
+		self.objects_dir = os.path.join(cache_dir, OBJECTS_DIR)
+		self.inputs_dir = os.path.join(cache_dir, INPUTS_DIR)
+		os.makedirs(self.objects_dir, exist_ok=True)
+		os.makedirs(self.inputs_dir, exist_ok=True)
+	
+	def write_json(self, filename, data):
+		# write to a temp file and rename, so parallel builds never see a partial file
+		fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(filename))
+		with os.fdopen(fd, "w") as temp_file:
+			json.dump(data, temp_file)
+		os.replace(temp_filename, filename)
+	
+	def file_hash(self, filename):
+		# sha256 of the file's bytes
+		# files with the same path, size and mtime as last time reuse the recorded hash
+		path = os.path.abspath(filename)
+		file_stat = os.stat(path)
+		if not stat.S_ISREG(file_stat.st_mode):
+			return None
+		fingerprint_filename = os.path.join(self.inputs_dir, hashlib.sha1(path.encode("utf-8")).hexdigest() + ".json")
+		try:
+			with open(fingerprint_filename, "r") as fingerprint_file:
+				fingerprint = json.load(fingerprint_file)
+			if fingerprint["path"] == path and fingerprint["size"] == file_stat.st_size and fingerprint["mtime_ns"] == file_stat.st_mtime_ns:
+				return fingerprint["sha256"]
+		except (OSError, ValueError, KeyError):
+			pass
+		
+		file_hash = hashlib.sha256()
+		with open(path, "rb") as infile:
+			data = infile.read(HASH_READ_SIZE)
+			while len(data) > 0:
+				file_hash.update(data)
+				data = infile.read(HASH_READ_SIZE)
+		fingerprint = {"path": path, "size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns, "sha256": file_hash.hexdigest()}
+		self.write_json(fingerprint_filename, fingerprint)
+		return fingerprint["sha256"]
+	
+	def key(self, builder, input_filenames, options):
+		# returns None if an input can't be hashed up front, e.g. a pipe
+		key_data = [CACHE_VERSION, builder, list(options)]
+		for input_filename in input_filenames:
+			try:
+				input_hash = self.file_hash(input_filename)
+			except OSError:
+				return None
+			if input_hash is None:
+				return None
+			key_data.append(input_hash)
+		return hashlib.sha256(json.dumps(key_data).encode("utf-8")).hexdigest()
+	
+	def object_filename(self, key):
+		return os.path.join(self.objects_dir, key[:2], key + FSB_EXTENSION)
+	
+	def info_filename(self, key):
+		return os.path.join(self.objects_dir, key[:2], key + INFO_EXTENSION)
+	
+	def discard(self, key):
+		remove_file(self.info_filename(key))
+		remove_file(self.object_filename(key))
+	
+	def copy_hashed(self, src_filename, dst_file):
+		# copies src_filename to dst_file, returns (size, sha256)
+		object_hash = hashlib.sha256()
+		size = 0
+		with open(src_filename, "rb") as src_file:
+			data = src_file.read(HASH_READ_SIZE)
+			while len(data) > 0:
+				object_hash.update(data)
+				dst_file.write(data)
+				size += len(data)
+				data = src_file.read(HASH_READ_SIZE)
+		return size, object_hash.hexdigest()
+	
+	def fetch(self, key, fsb_outfilename):
+		# copy the cached FSB to fsb_outfilename, returns False if it isn't cached
+		# it's a copy, so a later build writing to the output can't change the cache
+		object_filename = self.object_filename(key)
+		try:
+			with open(self.info_filename(key), "r") as info_file:
+				info = json.load(info_file)
+			if os.path.getsize(object_filename) != info["size"]:
+				raise ValueError("size mismatch")
+		except FileNotFoundError:
+			return False
+		except (OSError, ValueError, KeyError):
+			self.discard(key)
+			return False
+		
+		try:
+			with open(fsb_outfilename, "wb") as fsb_out:
+				size, object_hash = self.copy_hashed(object_filename, fsb_out)
+		except BaseException:
+			remove_file(fsb_outfilename)
+			raise
+		if size != info["size"] or object_hash != info["sha256"]:
+			# the cached FSB was changed, build it again
+			remove_file(fsb_outfilename)
+			self.discard(key)
+			return False
+		return True
+	
+	def store(self, key, fsb_outfilename):
+		object_filename = self.object_filename(key)
+		os.makedirs(os.path.dirname(object_filename), exist_ok=True)
+		fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(object_filename))
+		try:
+			with os.fdopen(fd, "wb") as temp_file:
+				size, object_hash = self.copy_hashed(fsb_outfilename, temp_file)
+			os.replace(temp_filename, object_filename)
+		except BaseException:
+			remove_file(temp_filename)
+			raise
+		# the info is written last, an object without it is never used
+		self.write_json(self.info_filename(key), {"size": size, "sha256": object_hash})
+	
+	def build(self, key, fsb_outfilename, build_function):
+		# returns True if the FSB came from the cache, otherwise builds it and adds it to the cache
+		if key is not None and self.fetch(key, fsb_outfilename):
+			return True
+		build_function()
+		if key is not None:
+			self.store(key, fsb_outfilename)
+		return False
@@ -0,0 +1,257 @@
+"""
+MIT License
+
+Copyright (c) 2019 shockdude
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# DJ Hero MP3 frame checker v0.1
+# Used by djh_mp3_to_fsb.py --check
+# Checks every frame header of an MP3 and reports all of its problems in one run:
+# bad frame headers, bitrate and sample rate changes and a cut off last frame
+# Big MP3s are split into segments that are checked in parallel by worker processes
+
+import os
+import mmap
+from concurrent.futures import ProcessPoolExecutor
+
+import mp3_frames
+from mp3_frames import Mp3Error, Mp3FrameIndex, HEADER_STRUCT, MP3_HEADER_SIZE, TAG_HEADER, CBR_HEADER_MASK, PADDING_BIT, SAMPLES_PER_FRAME
+
+# MP3s are split into segments of at least this size, smaller ones are checked in one go
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+# a frame sync only counts as a frame if it starts this many valid frames in a row
+RESYNC_FRAMES = 3
+FRAME_SYNC = b"\xff"
+
+class Mp3Problem:
+	def __init__(self, frame, offset, message):
+		# number of good frames before the problem
+		self.frame = frame
+		self.offset = offset
+		self.message = message
+
+class Mp3Report:
+	def __init__(self, mp3_filename):
+		self.filename = mp3_filename
+		self.tag_size = 0
+		self.frame_count = 0
+		# format of the first frame
+		self.bitrate = None
+		self.sample_rate = None
+		self.problems = []
+	
+	def ok(self):
+		return len(self.problems) == 0
+	
+	def describe(self, problem):
+		position = "?"
+		if self.sample_rate is not None:
+			seconds = problem.frame * SAMPLES_PER_FRAME / self.sample_rate
+			position = "{}:{:04.1f}".format(int(seconds // 60), seconds % 60)
+		return "frame {} ({}) at 0x{:X}: {}".format(problem.frame, position, problem.offset, problem.message)
+
+class SegmentResult:
+	def __init__(self, start):
+		# offset of the first frame checked
+		self.first_pos = None
+		# offset after the last frame checked, where the next segment's first frame should be
+		self.end_pos = start
+		self.first_format = None
+		self.last_format = None
+		self.frame_count = 0
+		# frame numbers are counted from the start of the segment
+		self.problems = []
+		# set if the segment reached the end of the audio
+		self.finished = False
+
+def format_changes(frame, offset, old_format, new_format):
+	problems = []
+	if new_format[0] != old_format[0]:
+		problems.append(Mp3Problem(frame, offset, "bitrate changes from {}kbps to {}kbps".format(int(old_format[0]/1000), int(new_format[0]/1000))))
+	if new_format[1] != old_format[1]:
+		problems.append(Mp3Problem(frame, offset, "sample rate changes from {}Hz to {}Hz".format(old_format[1], new_format[1])))
+	return problems
+
+class FrameChecker:
+	def __init__(self, data, mp3_filename):
+		self.data = data
+		self.size = len(data)
+		self.filename = mp3_filename
+		# header format bits -> (bitrate, sample rate, frame size without padding) or the reason it's bad
+		self.formats = {}
+	
+	def header_at(self, pos):
+		return HEADER_STRUCT.unpack_from(self.data, pos)[0]
+	
+	def frame_format(self, header):
+		key = header & CBR_HEADER_MASK
+		frame_format = self.formats.get(key)
+		if frame_format is None:
+			try:
+				bitrate, sample_rate, frame_size = mp3_frames.parse_frame_header(header, self.filename)
+				frame_format = (bitrate, sample_rate, frame_size - ((header >> PADDING_BIT) & 0x1))
+			except Mp3Error as e:
+				# the reason comes after the filename
+				frame_format = str(e).rsplit(", ", 1)[-1]
+			self.formats[key] = frame_format
+		return frame_format
+	
+	def is_end(self, pos):
+		# end of the audio: an ID3v1 tag or no room for another header
+		return pos + MP3_HEADER_SIZE > self.size or (self.header_at(pos) >> 8) == TAG_HEADER
+	
+	def frames_follow(self, pos):
+		sample_rate = None
+		for i in range(RESYNC_FRAMES):
+			if self.is_end(pos):
+				return i > 0
+			header = self.header_at(pos)
+			frame_format = self.frame_format(header)
+			if isinstance(frame_format, str):
+				return False
+			if sample_rate is not None and frame_format[1] != sample_rate:
+				return False
+			sample_rate = frame_format[1]
+			pos += frame_format[2] + ((header >> PADDING_BIT) & 0x1)
+		return True
+	
+	def find_sync(self, pos):
+		# offset of the next frame at or after pos, -1 if there is none
+		while True:
+			pos = self.data.find(FRAME_SYNC, pos)
+			if pos < 0 or self.frames_follow(pos):
+				return pos
+			pos += 1
+	
+	def check_segment(self, start, end, synced):
+		# checks the frames that start before end
+		# if synced, start is known to be a frame boundary, otherwise the first frame after start is found
+		result = SegmentResult(start)
+		pos = start
+		if not synced:
+			pos = self.find_sync(start)
+			if pos < 0:
+				result.end_pos = self.size
+				result.finished = True
+				return result
+		result.first_pos = pos
+		
+		previous_format = None
+		while pos < end:
+			if self.is_end(pos):
+				result.finished = True
+				break
+			header = self.header_at(pos)
+			frame_format = self.frame_format(header)
+			if isinstance(frame_format, str):
+				next_pos = self.find_sync(pos + 1)
+				if next_pos < 0:
+					result.problems.append(Mp3Problem(result.frame_count, pos, "bad frame header, {}, no frames after it".format(frame_format)))
+					pos = self.size
+					result.finished = True
+					break
+				result.problems.append(Mp3Problem(result.frame_count, pos, "bad frame header, {}, skipped {} bytes".format(frame_format, next_pos - pos)))
+				pos = next_pos
+				continue
+			
+			bitrate, sample_rate, frame_size = frame_format
+			frame_size += (header >> PADDING_BIT) & 0x1
+			if previous_format is None:
+				result.first_format = (bitrate, sample_rate)
+			elif previous_format != (bitrate, sample_rate):
+				result.problems.extend(format_changes(result.frame_count, pos, previous_format, (bitrate, sample_rate)))
+			previous_format = (bitrate, sample_rate)
+			if pos + frame_size > self.size:
+				result.problems.append(Mp3Problem(result.frame_count, pos, "last frame is cut off, {} of {} bytes".format(self.size - pos, frame_size)))
+				result.finished = True
+				break
+			result.frame_count += 1
+			pos += frame_size
+		result.last_format = previous_format
+		result.end_pos = pos
+		return result
+
+def check_segment_job(mp3_filename, start, end, synced):
+	# runs in a worker process
+	with open(mp3_filename, "rb") as mp3_file:
+		with mmap.mmap(mp3_file.fileno(), 0, access=mmap.ACCESS_READ) as mp3_data:
+			return FrameChecker(mp3_data, mp3_filename).check_segment(start, end, synced)
+
+def plan_segments(mp3_filename, report):
+	# returns (start, end, synced) for each segment of the MP3's audio
+	with open(mp3_filename, "rb") as mp3_file:
+		file_size = os.fstat(mp3_file.fileno()).st_size
+		if file_size == 0:
+			report.problems.append(Mp3Problem(0, 0, "file is empty"))
+			return []
+		with mmap.mmap(mp3_file.fileno(), 0, access=mmap.ACCESS_READ) as mp3_data:
+			mp3_index = Mp3FrameIndex(mp3_filename)
+			try:
+				report.tag_size = mp3_frames.read_tag_size(mp3_data, mp3_index)
+			except Mp3Error:
+				# the first frame is bad, it's reported with the others
+				report.tag_size = mp3_index.id3_size
+	
+	audio_size = file_size - report.tag_size
+	num_segments = max(1, audio_size // MIN_SEGMENT_SIZE)
+	bounds = [report.tag_size + audio_size * i // num_segments for i in range(num_segments)] + [file_size]
+	return [(bounds[i], bounds[i + 1], i == 0) for i in range(num_segments)]
+
+def merge_segments(report, segments, results):
+	expected_pos = report.tag_size
+	previous_format = None
+	for (start, end, synced), result in zip(segments, results):
+		if result.first_pos != expected_pos:
+			# the segment synced to a different frame than where the previous one ended, check it again from there
+			result = check_segment_job(report.filename, expected_pos, end, True)
+		if previous_format is not None and result.first_format is not None and previous_format != result.first_format:
+			report.problems.extend(format_changes(report.frame_count, result.first_pos, previous_format, result.first_format))
+		for problem in result.problems:
+			problem.frame += report.frame_count
+			report.problems.append(problem)
+		if report.bitrate is None and result.first_format is not None:
+			report.bitrate, report.sample_rate = result.first_format
+		if result.last_format is not None:
+			previous_format = result.last_format
+		report.frame_count += result.frame_count
+		expected_pos = result.end_pos
+		if result.finished:
+			break
+	if report.frame_count == 0 and report.ok():
+		report.problems.append(Mp3Problem(0, report.tag_size, "no audio frames"))
+
+def check_mp3s(mp3_filenames, num_workers=None):
+	# returns an Mp3Report for each MP3
+	reports = [Mp3Report(mp3_filename) for mp3_filename in mp3_filenames]
+	plans = [plan_segments(report.filename, report) for report in reports]
+	
+	if sum(len(segments) for segments in plans) <= 1:
+		# not worth starting worker processes
+		all_results = [[check_segment_job(report.filename, *segment) for segment in segments] for report, segments in zip(reports, plans)]
+	else:
+		with ProcessPoolExecutor(max_workers=num_workers) as executor:
+			all_futures = [[executor.submit(check_segment_job, report.filename, *segment) for segment in segments] for report, segments in zip(reports, plans)]
+			all_results = [[future.result() for future in futures] for futures in all_futures]
+	
+	for report, segments, results in zip(reports, plans, all_results):
+		if len(segments) > 0:
+			merge_segments(report, segments, results)
+	return reports
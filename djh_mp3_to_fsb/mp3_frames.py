@@ -0,0 +1,297 @@
+"""
+MIT License
+
+Copyright (c) 2019 shockdude
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# DJ Hero MP3 frame indexer v0.4
+# Shared by djh_mp3_to_fsb.py and misc/djh_fss_to_fsb.py
+# Scans an MP3 once and records the offset and size of every frame
+# Mp3FrameReader reads the frames in order from a file object, e.g. a pipe from an encoder
+
+import os
+import struct
+import mmap
+from array import array
+
+# references
+# http://www.mp3-tech.org/programmer/frame_header.html
+# https://hydrogenaud.io/index.php/topic,85125.0.html
+
+# tagging
+TAG_PREFIX = b"TAG"
+ID3_PREFIX = b"ID3"
+INFO_TAG_SILENCE = (0,0,0,0,0,0,0,0)
+INFO_TAG_ID = (1868983881, 1735289176) # Info, Xing in little endian
+INFO_TAG_READSIZE = 0x24
+ID3V1_SIZE = 256
+ID3V2_HEADER_SIZE = 10
+# tags are skipped in reads of this size when streaming
+SKIP_READ_SIZE = 0x10000
+
+# MPEG v1: frame size = 1152 samples/frame * bitrate / samplerate / 8 bits/byte
+#                     = 144 * bitrate / samplerate
+SAMPLES_PER_FRAME = 1152
+MPEG_MAGIC = SAMPLES_PER_FRAME / 8
+MP3_HEADER_SIZE = 4
+
+MPEG_VERSION_1 = 1
+MP3_BITRATES = (None, 32000, 40000, 48000, 56000, 64000, 80000, 96000, 112000, 128000, 160000, 192000, 224000, 256000, 320000, None)
+MP3_SAMPLERATES = (44100, 48000, 32000, None)
+
+# frames of a constant bitrate MP3 only differ in the padding, private & channel bits,
+# so a header that matches the first frame under this mask does not need full validation
+CBR_HEADER_MASK = 0xFFFFFC00
+PADDING_BIT = 9
+TAG_HEADER = int.from_bytes(TAG_PREFIX, "big")
+
+HEADER_STRUCT = struct.Struct(">I")
+INFO_TAG_STRUCT = struct.Struct("<IIIIIIIII")
+
+class Mp3Error(Exception):
+	pass
+
+class Mp3FrameIndex:
+	def __init__(self, mp3_filename):
+		self.filename = mp3_filename
+		self.file_size = 0
+		# 1 or 2 if the MP3 has ID3v1/ID3v2 tags
+		self.id3_version = None
+		self.id3_size = 0
+		# size of the Info/Xing frame, 0 if there is none
+		self.info_size = 0
+		# bytes to skip before the first audio frame
+		self.tag_size = 0
+		self.bitrate = None
+		self.sample_rate = None
+		# header of the first audio frame, e.g. for its channel mode
+		self.first_header = None
+		# set if the last frame was cut off and not indexed
+		self.truncated = False
+		self.offsets = array("I")
+		self.sizes = array("I")
+
+	def __len__(self):
+		return len(self.offsets)
+
+def parse_frame_header(header, mp3_filename):
+	# returns bitrate, sample rate, frame size
+	# check frame sync
+	if (header >> 24) != 0xFF or ((header >> 20) & 0xF) != 0xF:
+		raise Mp3Error("failed to parse MP3 {}, unexpected MP3 frame sync".format(mp3_filename))
+
+	# check mpeg version is v1
+	if ((header >> 19) & 0x1) != MPEG_VERSION_1:
+		raise Mp3Error("failed to parse MP3 {}, not mpeg v1".format(mp3_filename))
+
+	# check mpeg layer 3
+	if ((header >> 17) & 0x3) != 0x1:
+		raise Mp3Error("failed to parse MP3 {}, not layer 3".format(mp3_filename))
+
+	# check bitrate
+	bitrate = MP3_BITRATES[(header >> 12) & 0xF]
+	if bitrate == None:
+		raise Mp3Error("failed to parse MP3 {}, unsupported bitrate".format(mp3_filename))
+
+	# check sample rate
+	sample_rate = MP3_SAMPLERATES[(header >> 10) & 0x3]
+	if sample_rate == None:
+		raise Mp3Error("failed to parse MP3 {}, unsupported sample rate".format(mp3_filename))
+
+	# check padding bit
+	padding = (header >> PADDING_BIT) & 0x1
+
+	return bitrate, sample_rate, int(MPEG_MAGIC * bitrate / sample_rate) + padding
+
+def read_id3_size(data, mp3_index):
+	id3_data = data[0:3]
+	if id3_data == ID3_PREFIX and len(data) >= ID3V2_HEADER_SIZE: #ID3v2
+		id3_sizebytes = struct.unpack(">BBBB", data[6:10])
+		mp3_index.id3_version = 2
+		mp3_index.id3_size = (id3_sizebytes[3] & 0x7F) + ((id3_sizebytes[2] & 0x7F) << 7) + ((id3_sizebytes[1] & 0x7F) << 14) + ((id3_sizebytes[0] & 0x7F) << 21) + 10
+	elif id3_data == TAG_PREFIX: #ID3v1
+		mp3_index.id3_version = 1
+		mp3_index.id3_size = ID3V1_SIZE
+
+def read_tag_size(data, mp3_index):
+	# returns the offset of the first audio frame, after the ID3v2 tags and the Info frame
+	data_size = len(data)
+	read_id3_size(data, mp3_index)
+
+	# check for the Info tag
+	pos = mp3_index.id3_size
+	if pos + MP3_HEADER_SIZE <= data_size and data[pos:pos + 3] != TAG_PREFIX:
+		header = HEADER_STRUCT.unpack_from(data, pos)[0]
+		bitrate, sample_rate, frame_size = parse_frame_header(header, mp3_index.filename)
+		info_pos = pos + MP3_HEADER_SIZE
+		if info_pos + INFO_TAG_READSIZE <= data_size:
+			mp3_info_data = INFO_TAG_STRUCT.unpack_from(data, info_pos)
+			if mp3_info_data[:8] == INFO_TAG_SILENCE and mp3_info_data[8] in INFO_TAG_ID:
+				mp3_index.info_size = frame_size
+				pos += frame_size
+	mp3_index.tag_size = pos
+	return pos
+
+def scan_mp3(data, mp3_index):
+	data_size = len(data)
+	mp3_index.file_size = data_size
+	mp3_filename = mp3_index.filename
+	pos = read_tag_size(data, mp3_index)
+
+	# index the audio frames
+	offsets = mp3_index.offsets
+	sizes = mp3_index.sizes
+	cbr_header = None
+	cbr_frame_size = 0
+	unpack_header = HEADER_STRUCT.unpack_from
+	while pos + MP3_HEADER_SIZE <= data_size:
+		header = unpack_header(data, pos)[0]
+		# stop at the end of each MP3
+		if (header >> 8) == TAG_HEADER:
+			break
+		if (header & CBR_HEADER_MASK) == cbr_header:
+			frame_size = cbr_frame_size + ((header >> PADDING_BIT) & 0x1)
+		else:
+			bitrate, sample_rate, frame_size = parse_frame_header(header, mp3_filename)
+			if cbr_header == None:
+				mp3_index.bitrate = bitrate
+				mp3_index.sample_rate = sample_rate
+				mp3_index.first_header = header
+				cbr_header = header & CBR_HEADER_MASK
+				cbr_frame_size = frame_size - ((header >> PADDING_BIT) & 0x1)
+			elif bitrate != mp3_index.bitrate:
+				raise Mp3Error("MP3 {} is not constant bitrate. Got bitrate {}kbps".format(mp3_filename, int(bitrate/1000)))
+			elif sample_rate != mp3_index.sample_rate:
+				raise Mp3Error("MP3 {} changes sample rate. Got sample rate {}Hz".format(mp3_filename, sample_rate))
+		if pos + frame_size > data_size:
+			mp3_index.truncated = True
+			break
+		offsets.append(pos)
+		sizes.append(frame_size)
+		pos += frame_size
+	return mp3_index
+
+def index_mp3_data(data, mp3_filename):
+	return scan_mp3(data, Mp3FrameIndex(mp3_filename))
+
+def index_mp3(mp3_filename):
+	with open(mp3_filename, "rb") as mp3_file:
+		if os.fstat(mp3_file.fileno()).st_size == 0:
+			return Mp3FrameIndex(mp3_filename)
+		with mmap.mmap(mp3_file.fileno(), 0, access=mmap.ACCESS_READ) as mp3_data:
+			return index_mp3_data(mp3_data, mp3_filename)
+
+class Mp3FrameReader:
+	# reads the audio frames of an MP3 in order, without seeking or mapping the file
+	# the tags, Info frame and format are filled into self.index, but frame offsets/sizes are not kept
+	def __init__(self, mp3_file, mp3_filename):
+		self.file = mp3_file
+		self.index = Mp3FrameIndex(mp3_filename)
+		self.frame_count = 0
+		self.pending = b""
+		self.cbr_header = None
+		self.cbr_frame_size = 0
+		self.done = False
+		self.first_frame = None
+	
+	def read(self, size):
+		data = self.pending[:size]
+		self.pending = self.pending[size:]
+		if len(data) < size:
+			data += self.file.read(size - len(data))
+		return data
+	
+	def skip(self, size):
+		while size > 0:
+			data = self.read(min(size, SKIP_READ_SIZE))
+			if len(data) == 0:
+				break
+			size -= len(data)
+	
+	def read_tags(self):
+		# reads up to the first audio frame, filling in the tag and format info
+		mp3_index = self.index
+		self.pending = self.file.read(ID3V2_HEADER_SIZE)
+		read_id3_size(self.pending, mp3_index)
+		self.skip(mp3_index.id3_size)
+		
+		# check for the Info tag
+		frame = self.read_next_frame()
+		if frame is not None and len(frame) >= MP3_HEADER_SIZE + INFO_TAG_READSIZE:
+			mp3_info_data = INFO_TAG_STRUCT.unpack_from(frame, MP3_HEADER_SIZE)
+			if mp3_info_data[:8] == INFO_TAG_SILENCE and mp3_info_data[8] in INFO_TAG_ID:
+				mp3_index.info_size = len(frame)
+				# take the format from the first audio frame, like scan_mp3
+				self.cbr_header = None
+				frame = self.read_next_frame()
+		mp3_index.tag_size = mp3_index.id3_size + mp3_index.info_size
+		if frame is not None:
+			mp3_index.first_header = HEADER_STRUCT.unpack_from(frame)[0]
+		self.first_frame = frame
+		return mp3_index
+	
+	def read_next_frame(self):
+		if self.done:
+			return None
+		mp3_index = self.index
+		header_data = self.read(MP3_HEADER_SIZE)
+		# stop at the end of each MP3
+		if len(header_data) < MP3_HEADER_SIZE or header_data[:3] == TAG_PREFIX:
+			self.done = True
+			return None
+		header = HEADER_STRUCT.unpack(header_data)[0]
+		if (header & CBR_HEADER_MASK) == self.cbr_header:
+			frame_size = self.cbr_frame_size + ((header >> PADDING_BIT) & 0x1)
+		else:
+			bitrate, sample_rate, frame_size = parse_frame_header(header, mp3_index.filename)
+			if self.cbr_header == None:
+				# the first frame may turn out to be the Info frame, which has the same format
+				mp3_index.bitrate = bitrate
+				mp3_index.sample_rate = sample_rate
+				self.cbr_header = header & CBR_HEADER_MASK
+				self.cbr_frame_size = frame_size - ((header >> PADDING_BIT) & 0x1)
+			elif bitrate != mp3_index.bitrate:
+				raise Mp3Error("MP3 {} is not constant bitrate. Got bitrate {}kbps".format(mp3_index.filename, int(bitrate/1000)))
+			elif sample_rate != mp3_index.sample_rate:
+				raise Mp3Error("MP3 {} changes sample rate. Got sample rate {}Hz".format(mp3_index.filename, sample_rate))
+		frame_data = self.read(frame_size - MP3_HEADER_SIZE)
+		if len(frame_data) < frame_size - MP3_HEADER_SIZE:
+			mp3_index.truncated = True
+			self.done = True
+			return None
+		return header_data + frame_data
+	
+	def read_frame(self):
+		# returns the next audio frame, or None at the end of the MP3
+		if self.first_frame is not None:
+			frame = self.first_frame
+			self.first_frame = None
+		else:
+			frame = self.read_next_frame()
+		if frame is not None:
+			self.frame_count += 1
+		return frame
+	
+	def drain(self):
+		# reads the remaining frames, e.g. to report mismatched lengths, and returns the frame count
+		while self.read_frame() is not None:
+			pass
+		return self.frame_count
@@ -6,16 +6,43 @@
 import os, sys
 import struct
 import time
+import mmap
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from fsg_hash import FSG_HASH_INIT, FSGHashTable
 
 IMG_EXT = ".img"
 PART0_EXT = ".part0"
 PART1_EXT = ".part1"
 
+# initial read size when parsing a folder listing, doubled if the listing is longer
+LISTING_READ_SIZE = 0x1000
+
+# cached filesystem index, saved next to the IMG
+INDEX_EXT = ".index.json"
+INDEX_VERSION = 2
+
+COMMAND_INDEX = "index"
+COMMAND_LS = "ls"
+COMMAND_STAT = "stat"
+COMMAND_EXTRACT = "extract"
+COMMAND_LOOKUP = "lookup"
+COMMANDS = (COMMAND_INDEX, COMMAND_LS, COMMAND_STAT, COMMAND_EXTRACT, COMMAND_LOOKUP)
+
 def usage():
 	filename = os.path.basename(sys.argv[0])
 	print(filename)
-	print("Usage: {} [DISC0.IMG or DISC0.IMG.part0]".format(filename))
+	print("Usage: {} [-j jobs] [DISC0.IMG or DISC0.IMG.part0]".format(filename))
 	print("Or drag-and-drop DISC0.IMG or DISC0.IMG.part0 onto {}".format(filename))
+	print("-j jobs: number of files to write at once (default: based on CPU count, 1 = one at a time)")
+	print("")
+	print("Cached index commands:")
+	print("{} index [IMG]: (re)build the index file {}".format(filename, "DISC0.IMG" + INDEX_EXT))
+	print("{} ls [IMG] [folder]: list a folder".format(filename))
+	print("{} stat [IMG] [path]: show the hash, offset and size of a file or folder".format(filename))
+	print("{} extract [IMG] [path] [output_file]: extract a single file".format(filename))
+	print("{} lookup [IMG] [hash]: find the path of a node hash, e.g. 9b3fa62e".format(filename))
 	time.sleep(3)
 	sys.exit(1)
 
@@ -27,54 +54,144 @@ class FSGFileDescriptor:
 		self.data_offset = 0
 		self.size = 0
 
+class FSGIndex:
+	def __init__(self, image_stats, folders, files, orphans):
+		# image_stats: [filename, size, mtime] of each IMG part, to detect a changed IMG
+		# folders: path -> (filename_hash, list of entry names with their D/F prefix), "" is the root folder
+		# files: path -> (filename_hash, data_offset, size)
+		# orphans: (filename_hash, data_offset, size) of nodes that are not in any folder
+		self.image_stats = image_stats
+		self.folders = folders
+		self.files = files
+		self.orphans = orphans
+		# FSG paths are case insensitive
+		self.folder_lookup = {path.upper(): path for path in folders}
+		self.file_lookup = {path.upper(): path for path in files}
+		self.hash_lookup = {folder_data[0]: path for path, folder_data in folders.items() if path != ""}
+		self.hash_lookup.update((file_data[0], path) for path, file_data in files.items())
+	
+	def find_folder(self, path):
+		return self.folder_lookup.get(normalize_path(path).upper())
+	
+	def find_file(self, path):
+		return self.file_lookup.get(normalize_path(path).upper())
+	
+	def save(self, index_filename):
+		index_data = {
+			"version": INDEX_VERSION,
+			"image": self.image_stats,
+			"folders": self.folders,
+			"files": self.files,
+			"orphans": self.orphans,
+		}
+		with open(index_filename, "w") as index_file:
+			json.dump(index_data, index_file, separators=(",", ":"))
+
+def normalize_path(path):
+	return path.replace("\\", "/").strip("/")
+
+def output_path(output_dir, path):
+	# names come from the IMG, so a corrupt one with "..", an absolute name or a drive must not write outside output_dir
+	output_dir = os.path.abspath(output_dir)
+	names = path.replace("\\", "/").split("/")
+	out_path = os.path.abspath(os.path.join(output_dir, *names))
+	try:
+		inside = os.path.commonpath([output_dir, out_path]) == output_dir
+	except ValueError:
+		# e.g. a different drive on Windows
+		inside = False
+	if not inside or any(name in ("", ".", "..") for name in names):
+		print("Error: {} is outside the output folder {}".format(path, output_dir))
+		usage()
+	return out_path
+
+def load_index(index_filename, image_stats):
+	# returns None if the index is missing, unreadable or out of date
+	try:
+		with open(index_filename, "r") as index_file:
+			index_data = json.load(index_file)
+	except (OSError, ValueError):
+		return None
+	if index_data.get("version") != INDEX_VERSION or index_data.get("image") != image_stats:
+		return None
+	folders = {path: tuple(folder_data) for path, folder_data in index_data["folders"].items()}
+	files = {path: tuple(file_data) for path, file_data in index_data["files"].items()}
+	orphans = [tuple(orphan) for orphan in index_data["orphans"]]
+	return FSGIndex(image_stats, folders, files, orphans)
+
 class ImgFile:
 	def __init__(self, img_file_0, img_file_1):
 		self.img_filename = img_file_0
-		self.img_0 = None
-		self.img_1 = None
-		self.img_0_size = 0
-		self.img_1_size = 0
+		self.img_part_filenames = []
+		self.img_files = []
+		# (start offset, size, mmap) for .part0 and .part1
+		self.img_parts = []
+		self.img_size = 0
 		self.seekpos = 0
 	
-		self.img_0 = open(img_file_0, "rb")
-		self.img_0.seek(0,2)
-		self.img_0_size = self.img_0.tell()
-		self.img_0.seek(0)
+		self.open_part(img_file_0)
 		if img_file_1 != None:
-			self.img_1 = open(img_file_1, "rb")
-			self.img_1.seek(0,2)
-			self.img_1_size = self.img_1.tell()
-			self.img_1.seek(0)
-		
+			self.open_part(img_file_1)
+	
+	def open_part(self, img_part_filename):
+		img_part = open(img_part_filename, "rb")
+		self.img_part_filenames.append(img_part_filename)
+		self.img_files.append(img_part)
+		img_part_size = os.fstat(img_part.fileno()).st_size
+		if img_part_size > 0:
+			img_part_map = mmap.mmap(img_part.fileno(), 0, access=mmap.ACCESS_READ)
+			self.img_parts.append((self.img_size, img_part_size, img_part_map))
+			self.img_size += img_part_size
+	
+	def views(self, offset, count):
+		# the split image is treated as one address space
+		# yields zero-copy memoryviews of each part covering [offset, offset + count)
+		end = min(offset + count, self.img_size)
+		for part_start, part_size, part_map in self.img_parts:
+			part_end = part_start + part_size
+			if offset < part_end and end > part_start:
+				view = memoryview(part_map)[max(offset, part_start) - part_start:min(end, part_end) - part_start]
+				try:
+					yield view
+				finally:
+					view.release()
+	
 	def read(self, count):
+		data = b"".join([bytes(view) for view in self.views(self.seekpos, count)])
 		self.seekpos += count
-		if self.seekpos - count < self.img_0_size:
-			if self.img_1 != None and self.seekpos >= self.img_0_size:
-				data = self.img_0.read()
-				self.img_1.seek(0)
-				data += self.img_1.read(self.seekpos - self.img_0_size)
-				return data
-			else:
-				return self.img_0.read(count)
-		else:
-			return self.img_1.read(count)
+		return data
+	
+	def write_file(self, offset, size, outfile):
+		for view in self.views(offset, size):
+			outfile.write(view)
 			
-	def read_string(self):
-		data = self.read(1)
-		bytestring = b''
-		while data != b'\x00':
-			bytestring += data
-			data = self.read(1)
-		return bytestring.decode("utf-8")
+	def read_listing(self, offset):
+		# a directory listing is a run of null-terminated names, ending with an empty name
+		# parse the whole listing from bulk reads instead of one byte at a time
+		names = []
+		self.seek(offset)
+		data = b""
+		read_size = LISTING_READ_SIZE
+		start = 0
+		while True:
+			end = data.find(b"\x00", start)
+			if end < 0:
+				chunk = self.read(read_size)
+				if len(chunk) == 0:
+					print("Error: unterminated folder listing at offset {}".format(offset))
+					usage()
+				data += chunk
+				read_size *= 2
+				continue
+			if end == start:
+				return names
+			names.append(data[start:end].decode("utf-8"))
+			start = end + 1
 			
 	def seek(self, pos):
 		self.seekpos = pos
-		if pos >= self.img_0_size:
-			self.img_1.seek(pos - self.img_0_size)
-		else:
-			self.img_0.seek(pos)
 			
-	def dump_files(self):
+	def read_nodes(self):
 		MAGIC_STR = b'FSG-FILE-SYSTEM\x00'
 		MAGIC_STR_LEN = 16
 		try:
@@ -111,88 +228,224 @@ class ImgFile:
 			offset = struct.unpack(">I", self.read(4))[0]
 			node.data_offset = (offset << 10) + base_offset
 			node.size = struct.unpack(">I", self.read(4))[0]
-		self.recursively_get_files(None, "/", base_offset, "", nodes)
-	
-	def hash(self, str):
-		if str[0] == "/":
-			str = str[1:]
-		str = str.upper()
-		hash = 2166136261
-		for i in range(len(str)):
-			hash = (1677619 * hash) & 0xFFFFFFFF
-			hash ^= ord(str[i])
-		return hash
-	
-	def recursively_get_files(self, parent, name, base_offset, path_acc, nodes):
-		self.seek(base_offset)
-		filename = ""
-		
-		filename = self.read_string()
-		while (filename != ""):
-			pos = self.seekpos
-			real_name = filename[1:]
-			if path_acc == "":
-				next_path = real_name
-			else:
-				next_path = "{}/{}".format(path_acc, real_name)
-			desc = nodes[self.hash(next_path)]
+		return base_offset, nodes
+	
+	def get_manifest(self, base_offset, nodes):
+		# walk the directory tree without touching the output folder
+		# folders are listed parent first as (path, filename_hash, entry names), starting with the root folder ""
+		# files are listed as (path, filename_hash, data_offset, size)
+		# hash_table maps every hash in the tree back to its path
+		folders = []
+		files = []
+		hash_table = FSGHashTable()
+		self.recursively_get_files(base_offset, "", FSG_HASH_INIT, nodes, hash_table, folders, files)
+		return folders, files, hash_table
+	
+	def recursively_get_files(self, list_offset, path_acc, path_hash, nodes, hash_table, folders, files):
+		filenames = self.read_listing(list_offset)
+		folders.append((path_acc, path_hash, filenames))
+		for filename in filenames:
+			next_path, next_hash = hash_table.child(path_acc, path_hash, filename[1:])
+			desc = nodes[next_hash]
 			if filename[0] == "D":
-				if os.path.exists(real_name):
-					if not os.path.isdir(real_name):
-						print("Error: {} exists and is not a folder".format(real_name))
-						usage()
-				else:
-					os.mkdir(real_name)
-				os.chdir(real_name)
-				self.recursively_get_files(None, real_name, desc.data_offset, next_path, nodes)
-				os.chdir("..")
-				self.seek(pos)
+				self.recursively_get_files(desc.data_offset, next_path, next_hash, nodes, hash_table, folders, files)
 			elif filename[0] == "F":
-				if os.path.exists(real_name):
-					if not os.path.isfile(real_name):
-						print("Error: {} exists and is not a file".format(real_name))
-						usage()
-				self.seek(desc.data_offset)
-				with open(real_name, "wb") as outfile:
-					outfile.write(self.read(desc.size))
-				self.seek(pos)
+				files.append((next_path, next_hash, desc.data_offset, desc.size))
 			else:
 				print("Error: invalid filename prefix for {}".format(filename))
 				usage()
-				
-			filename = self.read_string()
+	
+	def extract_file(self, out_path, data_offset, size):
+		with open(out_path, "wb") as outfile:
+			self.write_file(data_offset, size, outfile)
+	
+	def dump_files(self, output_dir, num_workers=None):
+		base_offset, nodes = self.read_nodes()
+		folders, files, hash_table = self.get_manifest(base_offset, nodes)
+		
+		# every name is checked before anything is written
+		folder_paths = [output_path(output_dir, folder) for folder, folder_hash, filenames in folders if folder != ""]
+		jobs = [(output_path(output_dir, path), data_offset, size) for path, filename_hash, data_offset, size in files]
+		
+		for out_path in folder_paths:
+			if os.path.exists(out_path):
+				if not os.path.isdir(out_path):
+					print("Error: {} exists and is not a folder".format(out_path))
+					usage()
+			else:
+				os.mkdir(out_path)
+		
+		for out_path, data_offset, size in jobs:
+			if os.path.exists(out_path):
+				if not os.path.isfile(out_path):
+					print("Error: {} exists and is not a file".format(out_path))
+					usage()
+		
+		# extraction is I/O bound and the maps are shared, so threads are enough
+		if num_workers == 1:
+			for job in jobs:
+				self.extract_file(*job)
+		else:
+			with ThreadPoolExecutor(max_workers=num_workers) as executor:
+				futures = [executor.submit(self.extract_file, *job) for job in jobs]
+				for future in futures:
+					future.result()
+		return len(jobs)
+	
+	def get_image_stats(self):
+		image_stats = []
+		for img_part_filename, img_part in zip(self.img_part_filenames, self.img_files):
+			part_stat = os.fstat(img_part.fileno())
+			image_stats.append([os.path.basename(img_part_filename), part_stat.st_size, part_stat.st_mtime_ns])
+		return image_stats
+	
+	def get_index(self, rebuild=False):
+		# load the cached index, or walk the IMG once and save a new one
+		index_filename = self.img_filename + INDEX_EXT
+		image_stats = self.get_image_stats()
+		index = None
+		if not rebuild:
+			index = load_index(index_filename, image_stats)
+		if index == None:
+			base_offset, nodes = self.read_nodes()
+			folders, files, hash_table = self.get_manifest(base_offset, nodes)
+			orphans = [(hash, nodes[hash].data_offset, nodes[hash].size) for hash in hash_table.orphans(nodes)]
+			index = FSGIndex(image_stats, {folder[0]: folder[1:] for folder in folders}, {file[0]: file[1:] for file in files}, orphans)
+			try:
+				index.save(index_filename)
+			except OSError as e:
+				print("Warning: could not save index {}: {}".format(index_filename, e))
+		return index
 		
 	def close(self):
-		if self.img_0 != None:
-			self.img_0.close()
-		if self.img_1 != None:
-			self.img_1.close()
+		for part_start, part_size, part_map in self.img_parts:
+			part_map.close()
+		for img_part in self.img_files:
+			img_part.close()
+		self.img_parts = []
+		self.img_files = []
+
+def get_img_files(img_file_0):
+	img_file_1 = None
+	img_filename, img_fileext = os.path.splitext(img_file_0)
+	if img_fileext.lower() == PART0_EXT:
+		img_file_1 = img_filename + PART1_EXT
+	elif img_fileext.lower() != IMG_EXT:
+		print("Error: {} is not an IMG file".format(img_file_0))
+		usage()
+	return img_file_0, img_file_1
+
+def index_command(command, args):
+	if len(args) < 1:
+		print("Error: {} requires an IMG file".format(command))
+		usage()
+	img = ImgFile(*get_img_files(args[0]))
+	index = img.get_index(command == COMMAND_INDEX)
+	
+	if command == COMMAND_INDEX:
+		print("Indexed {} folders and {} files to {}".format(len(index.folders), len(index.files), img.img_filename + INDEX_EXT))
+		if len(index.orphans) > 0:
+			print("Note: {} orphaned nodes are not in any folder".format(len(index.orphans)))
+	elif command == COMMAND_LS:
+		folder = index.find_folder(args[1] if len(args) >= 2 else "")
+		if folder == None:
+			print("Error: folder {} not found".format(args[1]))
+			usage()
+		for filename in index.folders[folder][1]:
+			real_name = filename[1:]
+			if filename[0] == "D":
+				print("{:>12} {}/".format("<DIR>", real_name))
+			else:
+				path = real_name if folder == "" else "{}/{}".format(folder, real_name)
+				print("{:>12} {}".format(index.files[path][2], real_name))
+	elif command == COMMAND_STAT:
+		if len(args) < 2:
+			print("Error: stat requires a path")
+			usage()
+		path = index.find_file(args[1])
+		if path != None:
+			filename_hash, data_offset, size = index.files[path]
+			print("Path: {}".format(path))
+			print("Type: file")
+			print("Hash: {:08x}".format(filename_hash))
+			print("Offset: {:#x}".format(data_offset))
+			print("Size: {}".format(size))
+		else:
+			path = index.find_folder(args[1])
+			if path == None:
+				print("Error: {} not found".format(args[1]))
+				usage()
+			print("Path: {}".format(path))
+			print("Type: folder")
+			if path != "":
+				print("Hash: {:08x}".format(index.folders[path][0]))
+			print("Entries: {}".format(len(index.folders[path][1])))
+	elif command == COMMAND_EXTRACT:
+		if len(args) < 2:
+			print("Error: extract requires a path")
+			usage()
+		path = index.find_file(args[1])
+		if path == None:
+			print("Error: file {} not found".format(args[1]))
+			usage()
+		if len(args) >= 3:
+			out_path = args[2]
+		else:
+			out_path = output_path(os.getcwd(), path.replace("\\", "/").split("/")[-1])
+		filename_hash, data_offset, size = index.files[path]
+		img.extract_file(out_path, data_offset, size)
+		print("Extracted {} to {}".format(path, out_path))
+	elif command == COMMAND_LOOKUP:
+		try:
+			filename_hash = int(args[1], 16)
+		except (IndexError, ValueError):
+			print("Error: lookup requires a hexadecimal hash")
+			usage()
+		path = index.hash_lookup.get(filename_hash)
+		if path != None:
+			print(path)
+		else:
+			orphan = [orphan for orphan in index.orphans if orphan[0] == filename_hash]
+			if len(orphan) == 0:
+				print("Error: no node with hash {:08x}".format(filename_hash))
+				usage()
+			print("Orphaned node {:08x}, offset {:#x}, size {}".format(*orphan[0]))
+	img.close()
 
 def main():
 	noargs = False
 	img_file_0 = None
-	img_file_1 = None
-	if len(sys.argv) < 2:
+	num_workers = None
+	args = sys.argv[1:]
+	if len(args) >= 1 and args[0] in COMMANDS:
+		index_command(args[0], args[1:])
+		return
+	if len(args) >= 1 and args[0] == "-j":
+		try:
+			num_workers = int(args[1])
+			if num_workers < 1:
+				raise ValueError
+		except (IndexError, ValueError):
+			print("Error: -j requires a positive number of jobs")
+			usage()
+		args = args[2:]
+	if len(args) < 1:
 		noargs = True
 		if os.path.isfile("DISC0.IMG.part0"):
 			img_file_0 = "DISC0.IMG.part0"
 		elif os.path.isfile("DISC0.IMG"):
 			img_file_0 = "DISC0.IMG"
 	else:
-		img_file_0 = sys.argv[1]
+		img_file_0 = args[0]
 	
-	img_filename, img_fileext = os.path.splitext(img_file_0)
-	if img_fileext.lower() == PART0_EXT:
-		img_file_1 = img_filename + PART1_EXT
-	elif img_fileext.lower() != IMG_EXT:
-		print("Error: {} is not an IMG file".format(img_file_0))
-		usage()
+	img_file_0, img_file_1 = get_img_files(img_file_0)
 	
 	print("Opening {}...".format(img_file_0))
 	img = ImgFile(img_file_0, img_file_1)
 	print("Extracting files...")
-	img.dump_files()
+	file_count = img.dump_files(os.getcwd(), num_workers)
 	img.close()
+	print("Extracted {} files".format(file_count))
 	
 	if noargs:
 		if os.path.isfile("DISC0.IMG.part0"):
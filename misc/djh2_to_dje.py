@@ -22,41 +22,70 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-# DJ Hero 2 to DJ Engine Converter v0.62
+# DJ Hero 2 to DJ Engine Converter v0.73
 
 import os, sys
 import xml.etree.ElementTree as ET
 import json
-import csv
+import hashlib
+import tempfile
 import subprocess
 import shutil
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+from trac_strings import TracError, open_trac_text, open_trac_csv
 
 SLEEP_TIME = 3
 
-trac_dict = {}
+# DJ.fsb stems can be copied out directly with the FSB reader from djh_mp3_to_fsb
+FSB4_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "djh_mp3_to_fsb")
+
+# demux DJ.fsb's MP3 stems instead of decoding the whole FSB with vgmstream
+DEMUX_FLAG = "--demux"
+DJ_STEMS = ("green", "blue", "red")
+
+# number of tracks converted at once, defaults to the number of cores
+JOBS_FLAG = "-j"
+
+# the manifest in the output folder records what each track was converted from,
+# so unchanged song.json, charts and audio aren't redone on the next run
+MANIFEST_FILENAME = "dje_manifest.json"
+MANIFEST_VERSION = 1
+FORCE_FLAG = "--force"
+# seconds between manifest saves while tracks are drained, so an interrupted run keeps what it finished
+MANIFEST_SAVE_INTERVAL = 10
+
+# TrackListing.xml is read in chunks of this size
+XML_READ_SIZE = 0x10000
+TRACKLIST_ROOT = "TrackList"
+
 output_dir = "songs"
 
+# tracks that share an output folder are converted one at a time
+# keyed case-insensitively, since Windows folder names are
+output_folder_locks = {}
+output_folder_locks_lock = threading.Lock()
+
 def usage():
 	basename = os.path.basename(sys.argv[0])
 	print()
-	print("DJH2 to DJ Engine Converter v0.62")
+	print("DJH2 to DJ Engine Converter v0.73")
 	print("Convert DJH2 audiotracks folder or DJH2 custom charts to a songs folder compatible with DJ Engine Alpha v1.5p1")
 	print()
 	print("Usage: Drag-and-drop DJ Hero 2's AUDIO\Audiotracks folder onto {}".format(basename))
 	print("or drag-and-drop a custom song's folder (or its DJH2 folder) onto {}.".format(basename))
 	print("You can drag-and-drop multiple custom songs and the script will attempt to convert them all")
-	print("Or use the commandline: {} [folder_path]".format(basename))
+	print("Or use the commandline: {} [{}] [{} jobs] [folder_path]".format(basename, DEMUX_FLAG, JOBS_FLAG))
+	print("Tracks are converted {} at a time, one per core by default.".format(JOBS_FLAG))
+	print("Unchanged tracks from an earlier run are skipped, use {} to convert everything again.".format(FORCE_FLAG))
+	print("{} copies the green/blue/red MP3s straight out of DJ.fsb for sox, instead of decoding it with vgmstream.".format(DEMUX_FLAG))
+	print("This needs a sox build with MP3 support; vgmstream is used as a fallback if it's available.")
 	print()
 	time.sleep(SLEEP_TIME)
 	sys.exit(1)
 
-def get_from_trac(key):
-	trac_key = key.upper()
-	if trac_key in trac_dict:
-		return trac_dict[trac_key]
-	return key
-
 def add_to_json(song_json, json_path, value):
 	current_root = song_json
 	for json_entry in json_path[:-1]:
@@ -65,123 +94,401 @@ def add_to_json(song_json, json_path, value):
 		current_root = current_root[json_entry]
 	current_root[json_path[-1]] = value
 
-def build_json(track):
+def index_track(track):
+	# one pass over the Track's children: tag -> elements in file order
+	elems_by_tag = {}
+	for elem in track:
+		elems_by_tag.setdefault(elem.tag, []).append(elem)
+	return elems_by_tag
+
+def first_text(elems_by_tag, tag):
+	if tag not in elems_by_tag:
+		return None
+	return elems_by_tag[tag][0].text
+
+def text_value(text, bpm, trac_table):
+	return text
+
+def trac_value(text, bpm, trac_table):
+	return trac_table.get(text)
+
+def seconds_value(text, bpm, trac_table):
+	# seconds to ms
+	return int(text) * 1000
+
+def int_value(text, bpm, trac_table):
+	return int(text)
+
+def float_value(text, bpm, trac_table):
+	return float(text)
+
+def bar_value(text, bpm, trac_table):
+	# bar number to ms
+	bar = float(text)
+	return int(round(240000.0*(bar-1)/bpm))
+
+# how a field uses the Track's elements with its tag
+FIELD_FIRST = 0 # the first element
+FIELD_SECOND = 1 # the second element, if there is one
+FIELD_FLAG = 2 # True if the first element is "1"
+FIELD_LIST = 3 # every element, as a list
+FIELD_DIFFICULTY = 4 # every element, keyed by its Difficulty attribute
+
+DECK_SPEED_KEYS = {"0": "deckspeed_beginner", "1": "deckspeed_easy", "2": "deckspeed_medium", "3": "deckspeed_hard", "4": "deckspeed_expert"}
+
+# song.json fields, in the order they're added
+# tag, use, json path, value converter
+JSON_FIELDS = (
+	("MixName", FIELD_FIRST, ["song", "first", "name"], trac_value),
+	("MixName", FIELD_FIRST, ["extra", "id", "id_name"], text_value),
+	("MixName", FIELD_SECOND, ["song", "second", "name"], trac_value),
+	("MixName", FIELD_SECOND, ["extra", "id", "id_name2"], text_value),
+	("MixArtist", FIELD_FIRST, ["song", "first", "artist"], trac_value),
+	("MixArtist", FIELD_FIRST, ["extra", "id", "id_artist"], text_value),
+	("MixArtist", FIELD_SECOND, ["song", "second", "artist"], trac_value),
+	("MixArtist", FIELD_SECOND, ["extra", "id", "id_artist2"], text_value),
+	("MixHeadlineDJName", FIELD_FIRST, ["song", "dj"], trac_value),
+	("TrackDuration", FIELD_FIRST, ["song", "song_length"], seconds_value),
+	("BPM", FIELD_FIRST, ["difficulty", "bpm"], float_value),
+	("PreviewLoopPointStartInBars", FIELD_FIRST, ["song", "preview_start_time"], bar_value),
+	("PreviewLoopPointEndInBars", FIELD_FIRST, ["song", "preview_end_time"], bar_value),
+	("DeckSpeedMultiplier", FIELD_DIFFICULTY, ["difficulty", "deck_speed"], float_value),
+	("TrackComplexity", FIELD_FIRST, ["difficulty", "complexity", "track_complexity"], int_value),
+	("TapComplexity", FIELD_FIRST, ["difficulty", "complexity", "tap_complexity"], int_value),
+	("CrossfadeComplexity", FIELD_FIRST, ["difficulty", "complexity", "cross_complexity"], int_value),
+	("ScratchComplexity", FIELD_FIRST, ["difficulty", "complexity", "scratch_complexity"], int_value),
+	("IsMegamixBridge", FIELD_FLAG, ["extra", "megamix", "megamix_transitions"], None),
+	("HasExtendedIntro", FIELD_FLAG, ["extra", "megamix", "megamix_has_intro"], None),
+	("HighwayRevealBarOffset", FIELD_FIRST, ["extra", "megamix_highway_offset"], bar_value),
+	("SortArtist", FIELD_LIST, ["extra", "sort_artists"], trac_value),
+	("EnvironmentIntroStartBar", FIELD_FIRST, ["extra", "env_start_time"], bar_value),
+	("IsADMCTrack", FIELD_FLAG, ["extra", "battle_music"], None),
+	("IsMenuMusic", FIELD_FLAG, ["extra", "menu_music"], None),
+)
+
+def build_json(elems_by_tag, trac_table):
 	song_json = {}
+	# bar times need the BPM, wherever it is in the Track
 	bpm = 0
+	if "BPM" in elems_by_tag:
+		bpm = float(elems_by_tag["BPM"][0].text)
 	
-	elems = track.findall("MixName")
-	if len(elems) > 0:
-		add_to_json(song_json, ["song", "first", "name"], get_from_trac(elems[0].text))
-		add_to_json(song_json, ["extra", "id", "id_name"], elems[0].text)
-		if len(elems) > 1:
-			add_to_json(song_json, ["song", "second", "name"], get_from_trac(elems[1].text))
-			add_to_json(song_json, ["extra", "id", "id_name2"], elems[1].text)
-		
-	elems = track.findall("MixArtist")
-	if len(elems) > 0:
-		add_to_json(song_json, ["song", "first", "artist"], get_from_trac(elems[0].text))
-		add_to_json(song_json, ["extra", "id", "id_artist"], elems[0].text)
-		if len(elems) > 1:
-			add_to_json(song_json, ["song", "second", "artist"], get_from_trac(elems[1].text))
-			add_to_json(song_json, ["extra", "id", "id_artist2"], elems[1].text)
+	for tag, use, json_path, convert in JSON_FIELDS:
+		elems = elems_by_tag.get(tag)
+		if elems is None:
+			continue
+		if use == FIELD_FIRST:
+			add_to_json(song_json, json_path, convert(elems[0].text, bpm, trac_table))
+		elif use == FIELD_SECOND:
+			if len(elems) > 1:
+				add_to_json(song_json, json_path, convert(elems[1].text, bpm, trac_table))
+		elif use == FIELD_FLAG:
+			if elems[0].text == "1":
+				add_to_json(song_json, json_path, True)
+		elif use == FIELD_LIST:
+			add_to_json(song_json, json_path, [convert(elem.text, bpm, trac_table) for elem in elems])
+		elif use == FIELD_DIFFICULTY:
+			for elem in elems:
+				difficulty_key = DECK_SPEED_KEYS.get(elem.attrib["Difficulty"])
+				if difficulty_key is not None:
+					add_to_json(song_json, json_path + [difficulty_key], convert(elem.text, bpm, trac_table))
 	
-	elem = track.find("MixHeadlineDJName")
-	if elem != None:
-		add_to_json(song_json, ["song", "dj"], get_from_trac(elem.text))
-		
-	elem = track.find("TrackDuration")
-	if elem != None:
-		add_to_json(song_json, ["song", "song_length"], int(elem.text) * 1000)
-
-	elem = track.find("BPM")
-	if elem != None:
-		bpm = float(elem.text)
-		add_to_json(song_json, ["difficulty", "bpm"], bpm)
+	return song_json
+
+def convert_fsb_vgmstream(vgms_path, sox_path, fsb_filename, output_track_dir, idtag, log):
+	# decode DJ.fsb to a 6 channel wav, then mix each stereo pair to an ogg stem
+	# returns the number of errors
+	error_count = 0
+	temp_wav = None
+	try:
+		temp_fd, temp_wav = tempfile.mkstemp(suffix=".wav", prefix="temp", dir=output_track_dir)
+		os.close(temp_fd)
+		vgm_out = subprocess.run([vgms_path, "-i", fsb_filename, "-o", temp_wav], stdout=subprocess.DEVNULL)
+		if vgm_out.returncode != 0:
+			log("Error: Failed to extract DJ.fsb for song.ogg for {}, skipping".format(idtag))
+			error_count += 1
+		else:
+			sox_out0 = subprocess.Popen([sox_path, temp_wav, 
+										"-C", "8", "{}/green.ogg".format(output_track_dir), "-D",
+										"remix", "-m", "1", "2",
+										"rate", "-v", "44100"])
+			sox_out1 = subprocess.Popen([sox_path, temp_wav, 
+										"-C", "8", "{}/blue.ogg".format(output_track_dir), "-D",
+										"remix", "-m", "3", "4",
+										"rate", "-v", "44100"])
+			sox_out2 = subprocess.Popen([sox_path, temp_wav, 
+										"-C", "8", "{}/red.ogg".format(output_track_dir), "-D",
+										"remix", "-m", "5", "6",
+										"rate", "-v", "44100"])
+			sox_out0.wait()
+			sox_out1.wait()
+			sox_out2.wait()
+			if sox_out0.returncode != 0 or sox_out1.returncode != 0 or sox_out2.returncode != 0:
+				log("Error: Failed to mix DJ.fsb to ogg stems for {}, skipping".format(idtag))
+				error_count += 1
+	except Exception as e:
+		log("Error: Failed to convert DJ.ogg to ogg stems for {}, skipping".format(idtag))
+		log(str(e))
+		error_count += 1
+	if temp_wav is not None and os.path.isfile(temp_wav):
+		os.remove(temp_wav)
+	return error_count
+
+def load_fsb4():
+	# only --demux needs fsb4, so the default vgmstream path works without the djh_mp3_to_fsb folder
+	if FSB4_DIR not in sys.path:
+		sys.path.append(FSB4_DIR)
+	import fsb4
+	return fsb4
+
+def convert_fsb_demux(sox_path, fsb_filename, output_track_dir, idtag, log):
+	# copy each stem's MP3 frames out of DJ.fsb and transcode them to ogg, without a temp wav
+	# returns the number of errors, or None if the FSB couldn't be demuxed so vgmstream can be tried instead
+	fsb4 = load_fsb4()
+	stem_filenames = []
+	try:
+		with fsb4.Fsb4File(fsb_filename) as fsb:
+			streams = fsb.streams()
+			if len(streams) != len(DJ_STEMS):
+				raise fsb4.Fsb4Error("expected {} MP3 stems, found {}".format(len(DJ_STEMS), len(streams)))
+			for stem, stream in zip(DJ_STEMS, streams):
+				stem_filename = "{}/temp_{}.mp3".format(output_track_dir, stem)
+				stem_filenames.append(stem_filename)
+				with open(stem_filename, "wb") as stem_file:
+					fsb.write_stream(stream, stem_file)
+	except (fsb4.Fsb4Error, OSError) as e:
+		log("Warning: Failed to demux DJ.fsb for {}".format(idtag))
+		log(str(e))
+		remove_files(stem_filenames)
+		return None
 	
-	elem = track.find("PreviewLoopPointStartInBars")
-	if elem != None:
-		bar = float(elem.text)
-		add_to_json(song_json, ["song", "preview_start_time"], int(round(240000.0*(bar-1)/bpm)))
-
-	elem = track.find("PreviewLoopPointEndInBars")
-	if elem != None:
-		bar = float(elem.text)
-		add_to_json(song_json, ["song", "preview_end_time"], int(round(240000.0*(bar-1)/bpm)))
-
-	elems = track.findall("DeckSpeedMultiplier")
-	for elem in elems:
-		elem_diff = elem.attrib["Difficulty"]
-		if elem_diff == "0":
-			add_to_json(song_json, ["difficulty", "deck_speed", "deckspeed_beginner"], float(elem.text))
-		elif elem_diff == "1":
-			add_to_json(song_json, ["difficulty", "deck_speed", "deckspeed_easy"], float(elem.text))
-		elif elem_diff == "2":
-			add_to_json(song_json, ["difficulty", "deck_speed", "deckspeed_medium"], float(elem.text))
-		elif elem_diff == "3":
-			add_to_json(song_json, ["difficulty", "deck_speed", "deckspeed_hard"], float(elem.text))
-		elif elem_diff == "4":
-			add_to_json(song_json, ["difficulty", "deck_speed", "deckspeed_expert"], float(elem.text))
-			
-	elem = track.find("TrackComplexity")
-	if elem != None:
-		add_to_json(song_json, ["difficulty", "complexity", "track_complexity"], int(elem.text))
-		
-	elem = track.find("TapComplexity")
-	if elem != None:
-		add_to_json(song_json, ["difficulty", "complexity", "tap_complexity"], int(elem.text))
-			
-	elem = track.find("CrossfadeComplexity")
-	if elem != None:
-		add_to_json(song_json, ["difficulty", "complexity", "cross_complexity"], int(elem.text))
-			
-	elem = track.find("ScratchComplexity")
-	if elem != None:
-		add_to_json(song_json, ["difficulty", "complexity", "scratch_complexity"], int(elem.text))
-			
-	elem = track.find("IsMegamixBridge")
-	if elem != None:
-		if elem.text == "1":
-			add_to_json(song_json, ["extra", "megamix", "megamix_transitions"], True)
-
-	elem = track.find("HasExtendedIntro")
-	if elem != None:
-		if elem.text == "1":
-			add_to_json(song_json, ["extra", "megamix", "megamix_has_intro"], True)
-
-	elem = track.find("HighwayRevealBarOffset")
-	if elem != None:
-		bar = float(elem.text)
-		add_to_json(song_json, ["extra", "megamix_highway_offset"], int(round(240000.0*(bar-1)/bpm)))
+	error_count = 0
+	try:
+		sox_outs = []
+		for stem, stem_filename in zip(DJ_STEMS, stem_filenames):
+			sox_outs.append(subprocess.Popen([sox_path, stem_filename,
+											"-C", "8", "{}/{}.ogg".format(output_track_dir, stem), "-D",
+											"rate", "-v", "44100"]))
+		for sox_out in sox_outs:
+			sox_out.wait()
+		if any(sox_out.returncode != 0 for sox_out in sox_outs):
+			log("Error: Failed to transcode DJ.fsb stems to ogg for {}, skipping".format(idtag))
+			log("Note: sox needs MP3 support (libmad) to read the demuxed stems")
+			error_count += 1
+	except Exception as e:
+		log("Error: Failed to convert DJ.fsb stems to ogg for {}, skipping".format(idtag))
+		log(str(e))
+		error_count += 1
+	remove_files(stem_filenames)
+	return error_count
+
+def remove_files(filenames):
+	for filename in filenames:
+		if os.path.isfile(filename):
+			os.remove(filename)
+
+class AudioTools:
+	# the external tools used to convert DJ.fsb to ogg stems
+	def __init__(self, vgms_path, sox_path, demux_fsb, has_vgmstream):
+		self.vgms_path = vgms_path
+		self.sox_path = sox_path
+		self.demux_fsb = demux_fsb
+		self.has_vgmstream = has_vgmstream
+	
+	def mode(self):
+		# stored in the manifest, so switching modes converts the audio again
+		if self.demux_fsb:
+			return "demux"
+		return "vgmstream"
+	
+	def convert_fsb(self, fsb_filename, output_track_dir, idtag, log):
+		# returns the number of errors
+		if not self.demux_fsb:
+			return convert_fsb_vgmstream(self.vgms_path, self.sox_path, fsb_filename, output_track_dir, idtag, log)
+		stem_errors = convert_fsb_demux(self.sox_path, fsb_filename, output_track_dir, idtag, log)
+		if stem_errors is None and self.has_vgmstream:
+			log("Falling back to vgmstream for {}".format(idtag))
+			stem_errors = convert_fsb_vgmstream(self.vgms_path, self.sox_path, fsb_filename, output_track_dir, idtag, log)
+		elif stem_errors is None:
+			stem_errors = 1
+		return stem_errors
+
+def file_fingerprint(filename):
+	file_stat = os.stat(filename)
+	return [file_stat.st_size, file_stat.st_mtime_ns]
+
+def load_manifest():
+	# returns {output track folder: {part: fingerprint}}
+	try:
+		with open("{}/{}".format(output_dir, MANIFEST_FILENAME), "r") as manifest_file:
+			manifest = json.load(manifest_file)
+		if manifest.get("version") == MANIFEST_VERSION:
+			return manifest["tracks"]
+	except (OSError, ValueError, KeyError):
+		pass
+	return {}
+
+def save_manifest(manifest_tracks):
+	# write to a temp file and rename, so an interrupted run can't leave a broken manifest
+	fd, temp_filename = tempfile.mkstemp(dir=output_dir)
+	with os.fdopen(fd, "w") as manifest_file:
+		json.dump({"version": MANIFEST_VERSION, "tracks": manifest_tracks}, manifest_file, indent=1, sort_keys=True)
+	os.replace(temp_filename, "{}/{}".format(output_dir, MANIFEST_FILENAME))
+
+def output_folder_lock(track_folder):
+	with output_folder_locks_lock:
+		return output_folder_locks.setdefault(track_folder.lower(), threading.Lock())
+
+def convert_track(idtag, folder_location, song_json, chart_path, is_audiotracks_folder, audio_tools, manifest_tracks):
+	# one whole track: output folder, song.json, charts and audio
+	# runs on a worker thread, so messages are collected and printed in track order by main()
+	# parts whose inputs match manifest_tracks are skipped
+	# returns (converted, error count, IDTag, messages, output track folder, manifest entry)
+	messages = []
+	log = messages.append
+	error_count = 0
+	track_folder = None
+	manifest_entry = {}
 	
-	elems = track.findall("SortArtist")
-	sort_artists = []
-	for elem in elems:
-		sort_artists.append(get_from_trac(elem.text))
-	if len(sort_artists) > 0:
-		add_to_json(song_json, ["extra", "sort_artists"], sort_artists)
-
-	elem = track.find("EnvironmentIntroStartBar")
-	if elem != None:
-		bar = float(elem.text)
-		add_to_json(song_json, ["extra", "env_start_time"], int(round(240000.0*(bar-1)/bpm)))
+	if idtag == None:
+		log("Error: found Track without IDTag, skipping")
+		return False, 1, None, messages, track_folder, manifest_entry
 	
-	elem = track.find("IsADMCTrack")
-	if elem != None:
-		if elem.text == "1":
-			add_to_json(song_json, ["extra", "battle_music"], True)
+	if folder_location == None:
+		log("Error: {} has no FolderLocation, skipping".format(idtag))
+		return False, 1, idtag, messages, track_folder, manifest_entry
+	loc = folder_location.replace("\\", "/")
+	loc_track_folder = loc.split("/")[-1]
 	
-	elem = track.find("IsMenuMusic")
-	if elem != None:
-		if elem.text == "1":
-			add_to_json(song_json, ["extra", "menu_music"], True)
+	log("Converting {}".format(idtag))
 	
-	return song_json
+	if is_audiotracks_folder:
+		loc = "{}/../../{}".format(chart_path, loc)
+	else:
+		loc = "{}/{}".format(chart_path, loc_track_folder)
+	
+	if not os.path.isdir(loc):
+		log("Error: folder for {} does not exist, skipping".format(idtag))
+		return False, 1, idtag, messages, track_folder, manifest_entry
+	
+	with output_folder_lock(loc_track_folder):
+		# make output track directory
+		track_folder = loc_track_folder
+		old_entry = manifest_tracks.get(track_folder, {})
+		changed = False
+		output_track_dir = "{}/{}".format(output_dir, loc_track_folder)
+		try:
+			os.makedirs(output_track_dir, exist_ok=True)
+		except Exception as e:
+			log("Error: Failed to make output folder for {}, skipping".format(idtag))
+			log(str(e))
+			return False, 1, idtag, messages, track_folder, manifest_entry
+		
+		# write song.json
+		# it only depends on the TrackListing entry and TRAC strings, so its own text is the fingerprint
+		json_text = json.dumps(song_json, sort_keys=False, indent=4)
+		json_hash = hashlib.sha1(json_text.encode("utf-8")).hexdigest()
+		json_filename = "{}/song.json".format(output_track_dir)
+		if old_entry.get("json") == json_hash and os.path.isfile(json_filename):
+			manifest_entry["json"] = json_hash
+		else:
+			changed = True
+			try:
+				with open(json_filename, "w") as json_file:
+					print(json_text, file=json_file)
+				manifest_entry["json"] = json_hash
+			except Exception as e:
+				log("Error: Failed to write song.json for {}, skipping".format(idtag))
+				log(str(e))
+				error_count += 1
+		
+		# copy DJ_Expert.xmk to chart.xmk
+		chart_diffs = ("DJ_Beginner.xmk", "DJ_Easy.xmk", "DJ_Medium.xmk", "DJ_Hard.xmk", "DJ_Expert.xmk")
+		chart_copied = False
+		old_charts = old_entry.get("charts", {})
+		manifest_entry["charts"] = {}
+		for chart_xmk in chart_diffs:
+			try:
+				chart_filepath = "{}/{}".format(loc, chart_xmk)
+				if os.path.isfile(chart_filepath):
+					chart_fingerprint = file_fingerprint(chart_filepath)
+					chart_outpath = "{}/{}".format(output_track_dir, chart_xmk)
+					if old_charts.get(chart_xmk) != chart_fingerprint or not os.path.isfile(chart_outpath):
+						changed = True
+						shutil.copyfile(chart_filepath, chart_outpath)
+					manifest_entry["charts"][chart_xmk] = chart_fingerprint
+					chart_copied = True
+			except Exception as e:
+				log("Error: Failed to copy {} for {}, skipping".format(chart_xmk, idtag))
+				log(str(e))
+				error_count += 1
+		if not chart_copied:
+			log("Error: No chart copied for {}".format(idtag))
+			error_count += 1
+		
+		# convert DJ.fsb to song.ogg
+		if audio_tools is not None:
+			fsb_filename = "{}/DJ.fsb".format(loc)
+			audio_fingerprint = None
+			if os.path.isfile(fsb_filename):
+				audio_fingerprint = file_fingerprint(fsb_filename) + [audio_tools.mode()]
+			stems_exist = all(os.path.isfile("{}/{}.ogg".format(output_track_dir, stem)) for stem in DJ_STEMS)
+			if audio_fingerprint is not None and old_entry.get("audio") == audio_fingerprint and stems_exist:
+				manifest_entry["audio"] = audio_fingerprint
+			else:
+				changed = True
+				stem_errors = audio_tools.convert_fsb(fsb_filename, output_track_dir, idtag, log)
+				if stem_errors == 0 and audio_fingerprint is not None:
+					manifest_entry["audio"] = audio_fingerprint
+				error_count += stem_errors
+		
+		if not changed:
+			log("{} is unchanged, skipped".format(idtag))
+		return True, error_count, idtag, messages, track_folder, manifest_entry
+
+def strip_xml_declaration(text):
+	# the declaration can't come after the wrapper root that iter_tracks adds
+	text = text.lstrip("\ufeff \t\r\n")
+	if text.startswith("<?xml"):
+		declaration_end = text.find("?>")
+		if declaration_end >= 0:
+			text = text[declaration_end + 2:]
+	return text
+
+def iter_tracks(tracklisting_filename):
+	# yields each listed Track element as soon as it's parsed, then clears it to keep memory flat
+	# TrackListing.xml has a root element, but 'Info for TrackListing.xml' is usually just a list of Tracks,
+	# so the file is parsed inside one more root and Tracks are taken from either of the top two levels
+	parser = ET.XMLPullParser(events=("start", "end"))
+	parser.feed("<{}>".format(TRACKLIST_ROOT))
+	parents = []
+	with open(tracklisting_filename, "r") as tracklisting_file:
+		text = strip_xml_declaration(tracklisting_file.read(XML_READ_SIZE))
+		while True:
+			if len(text) > 0:
+				parser.feed(text)
+			else:
+				parser.feed("</{}>".format(TRACKLIST_ROOT))
+				parser.close()
+			for event, elem in parser.read_events():
+				if event == "start":
+					parents.append(elem)
+					continue
+				parents.pop()
+				# a Track directly in the wrapper, or in the file's own root
+				if elem.tag == "Track" and (len(parents) == 1 or (len(parents) == 2 and parents[1].tag != "Track")):
+					yield elem
+					elem.clear()
+					parents[-1].remove(elem)
+			if len(text) == 0:
+				break
+			text = tracklisting_file.read(XML_READ_SIZE)
 
 def main():
-	convert_audio = True
 	is_audiotracks_folder = True
 	converted_count = 0
 	error_count = 0
+	failed_tracks = []
 	
 	# hack to ensure working directory is the script directory
 	# for some reason this isn't guaranteed with the exe
@@ -191,202 +498,159 @@ def main():
 	vgms_path = "vgmstream/test.exe"
 	sox_path = "sox/sox.exe"
 	
-	if not os.path.isfile(vgms_path) or not os.path.isfile(sox_path):
+	args = sys.argv[1:]
+	demux_fsb = False
+	force = False
+	num_workers = os.cpu_count()
+	# options come before the folders
+	while len(args) > 0 and args[0] in (DEMUX_FLAG, JOBS_FLAG, FORCE_FLAG):
+		option = args.pop(0)
+		if option == DEMUX_FLAG:
+			try:
+				load_fsb4()
+			except ImportError as e:
+				print("Error: {} needs fsb4.py from the djh_mp3_to_fsb folder".format(DEMUX_FLAG))
+				print(e)
+				usage()
+			demux_fsb = True
+		elif option == FORCE_FLAG:
+			force = True
+		elif option == JOBS_FLAG:
+			try:
+				num_workers = int(args.pop(0))
+				if num_workers < 1:
+					raise ValueError
+			except (IndexError, ValueError):
+				print("Error: {} requires a positive number of jobs".format(JOBS_FLAG))
+				usage()
+	
+	audio_tools = None
+	has_vgmstream = os.path.isfile(vgms_path)
+	if not os.path.isfile(sox_path) or (not has_vgmstream and not demux_fsb):
 		print("Error: vgmstream or sox not found, skipping audio conversion")
-		convert_audio = False
 		error_count += 1
+	else:
+		audio_tools = AudioTools(vgms_path, sox_path, demux_fsb, has_vgmstream)
 	
 	chart_paths = None
-	if len(sys.argv) > 1:
-		chart_paths = sys.argv[1:]
+	if len(args) > 0:
+		chart_paths = args
 	else:
 		chart_paths = [os.getcwd(),]
 	
-	for chart_path in chart_paths:
-		# detect a DJH2 folder in a custom song folder
-		chart_path_basename = os.path.basename(chart_path).upper()
-		if chart_path_basename != "AUDIOTRACKS" and chart_path_basename != "DJH2":
-			if os.path.isdir("{}/DJH2".format(chart_path)):
-				print("Located custom song {}'s DJH2 folder".format(chart_path_basename))
-				chart_path = "{}/DJH2".format(chart_path)
-
-		# look for tracklisting
-		tracklisting_filename = "{}/TrackListing.xml".format(chart_path)
-		if os.path.isfile(tracklisting_filename):
-			print("Found 'TrackListing.xml', assuming audiotracks folder")
-		else:
-			print("Did not find 'TrackListing.xml', assuming customs folder")
-			is_audiotracks_folder = False
-			tracklisting_filename = "{}/Info for TrackListing.xml".format(chart_path)
-			if os.path.isfile(tracklisting_filename):
-				print("Found 'Info for TrackListing.xml'")
-			else:
-				print("Error: Did not find 'Info for TrackListing.xml' in {}".format(chart_path))
-				usage()
-		
+	manifest_tracks = {}
+	if not force:
+		manifest_tracks = load_manifest()
+	new_manifest_tracks = dict(manifest_tracks)
+	
+	# make output "songs" directory
+	try:
+		if not os.path.isdir(output_dir):
+			os.mkdir(output_dir)
+	except Exception as e:
+		print("Error: Failed to make output folder {}".format(output_dir))
+		print(e)
+		usage()
+	
+	# convert whole tracks in parallel, but print each track's log in order
+	# a bad chart path is counted as an error and skipped, so tracks already submitted still finish
+	futures = []
+	with ThreadPoolExecutor(max_workers=num_workers) as executor:
+		manifest_save_time = time.monotonic()
 		try:
-			if is_audiotracks_folder:
-				# build trac string dict from text strings
-				with open("{}/../../Text/TRAC/TRACID.txt".format(chart_path), "r") as tracid_file:
-					with open ("{}/../../Text/TRAC/TRACE.txt".format(chart_path), "rb") as trace_file:
-						tracids = tracid_file.read().split("\n")
-						traces = trace_file.read().split(b"\x00")
-						num_tracs = len(tracids)
-
-						if num_tracs != len(traces):
-							print("Error: mismatched number of trac IDs and trac strings: {}, {}".format(len(tracids), len(traces)))
-							usage()
-							
-						for i in range(num_tracs):
-							trac_dict[tracids[i].upper()] = traces[i].decode("utf-8")
-			else:
-				# build trac string dict from Info for TRAC.csv
-				with open("{}/Info for TRAC.csv".format(chart_path), "r", encoding="utf_8_sig", newline="") as trac_file:
-					trac_csv = csv.reader(trac_file, dialect="excel")
-					for row in trac_csv:
-						if len(row) > 0: # ignore blank lines
-							if row[0][0:2] == "//": # ignore commented lines
-								continue
-							trac_dict[row[0]] = row[-1]
-		except Exception as e:
-			print("Warning: failed to use TRAC files, using IDs as strings instead")
-			print(e)
+			for chart_path in chart_paths:
+				# detect a DJH2 folder in a custom song folder
+				chart_path_basename = os.path.basename(chart_path).upper()
+				if chart_path_basename != "AUDIOTRACKS" and chart_path_basename != "DJH2":
+					if os.path.isdir("{}/DJH2".format(chart_path)):
+						print("Located custom song {}'s DJH2 folder".format(chart_path_basename))
+						chart_path = "{}/DJH2".format(chart_path)
 
-		# make output "songs" directory
-		try:
-			if not os.path.isdir(output_dir):
-				os.mkdir(output_dir)
-		except Exception as e:
-			print("Error: Failed to make output folder {}".format(output_dir))
-			print(e)
-			usage()
-		
-		# parse tracklisting.xml
-		tracklisting_text = None
-		with open(tracklisting_filename, "r") as tracklisting_file:
-			tracklisting_text = tracklisting_file.read()
-		try:
-			tracklist = ET.fromstring(tracklisting_text)
-			if tracklist.tag == "Track":
-				raise ET.ParseError
-		except Exception as e:
-			try:
-				tracklisting_text = "<TrackList>" + tracklisting_text + "</TrackList>"
-				tracklist = ET.fromstring(tracklisting_text)
-			except Exception as e:
-				print("Failed to process xml file {}".format(tracklisting_filename))
-				print(e)
-				usage()
-			
-		tracks = tracklist.findall("Track")
-		if len(tracks) <= 0:
-			print("Error: no Tracks found in {}".format(tracklisting_filename))
-			usage()
-
-		for track in tracklist.findall("Track"):
-			idtag_tag = track.find("IDTag")
-			if idtag_tag == None:
-				print("Error: found Track without IDTag, skipping")
-				error_count += 1
-				continue
-			idtag = idtag_tag.text
-			
-			loc_tag = track.find("FolderLocation")
-			if loc_tag == None:
-				print("Error: {} has no FolderLocation, skipping".format(idtag))
-				error_count += 1
-				continue
-			loc = loc_tag.text.replace("\\", "/")
-			loc_track_folder = loc.split("/")[-1]
-			
-			print("Converting {}".format(idtag))
-			
-			if is_audiotracks_folder:
-				loc = "{}/../../{}".format(chart_path, loc)
-			else:
-				loc = "{}/{}".format(chart_path, loc_track_folder)
-			
-			if not os.path.isdir(loc):
-				print("Error: folder for {} does not exist, skipping".format(idtag))
-				error_count += 1
-				continue
-			
-			# make output track directory
-			output_track_dir = "{}/{}".format(output_dir, loc_track_folder)
-			try:
-				if not os.path.isdir(output_track_dir):
-					os.mkdir(output_track_dir)
-			except Exception as e:
-				print("Error: Failed to make output folder for {}, skipping".format(idtag))
-				print(e)
-				error_count += 1
-				continue
-			
-			# build song.json
-			song_json = build_json(track)
-			try:
-				with open("{}/song.json".format(output_track_dir), "w") as json_file:
-					print(json.dumps(song_json, sort_keys=False, indent=4), file=json_file)
-			except Exception as e:
-				print("Error: Failed to write song.json for {}, skipping".format(idtag))
-				print(e)
-				error_count += 1
+				# look for tracklisting
+				tracklisting_filename = "{}/TrackListing.xml".format(chart_path)
+				if os.path.isfile(tracklisting_filename):
+					print("Found 'TrackListing.xml', assuming audiotracks folder")
+				else:
+					print("Did not find 'TrackListing.xml', assuming customs folder")
+					is_audiotracks_folder = False
+					tracklisting_filename = "{}/Info for TrackListing.xml".format(chart_path)
+					if os.path.isfile(tracklisting_filename):
+						print("Found 'Info for TrackListing.xml'")
+					else:
+						print("Error: Did not find 'Info for TrackListing.xml' in {}, skipping".format(chart_path))
+						error_count += 1
+						continue
 			
-			# copy DJ_Expert.xmk to chart.xmk
-			chart_diffs = ("DJ_Beginner.xmk", "DJ_Easy.xmk", "DJ_Medium.xmk", "DJ_Hard.xmk", "DJ_Expert.xmk")
-			chart_copied = False
-			for chart_xmk in chart_diffs:
+				# TRAC strings for this chart path, read when the first track needs them
+				if is_audiotracks_folder:
+					trac_table = open_trac_text("{}/../../Text/TRAC".format(chart_path))
+				else:
+					trac_table = open_trac_csv("{}/Info for TRAC.csv".format(chart_path))
+
+				# parse tracklisting.xml, converting each Track as soon as it's read
+				track_count = 0
 				try:
-					chart_filepath = "{}/{}".format(loc, chart_xmk)
-					if os.path.isfile(chart_filepath):
-						shutil.copyfile(chart_filepath, "{}/{}".format(output_track_dir, chart_xmk))
-						chart_copied = True
-				except Exception as e:
-					print("Error: Failed to copy {} for {}, skipping".format(chart_xmk, idtag))
+					for track in iter_tracks(tracklisting_filename):
+						track_count += 1
+						# song.json is built now, with this chart path's strings
+						elems_by_tag = index_track(track)
+						song_json = build_json(elems_by_tag, trac_table)
+						futures.append(executor.submit(convert_track, first_text(elems_by_tag, "IDTag"), first_text(elems_by_tag, "FolderLocation"),
+							song_json, chart_path, is_audiotracks_folder, audio_tools, manifest_tracks))
+				except TracError as e:
+					# the strings are read for the first track, so no later track of this chart path can be built
+					print("Error: {}".format(e))
+					print("Error: skipping the rest of {}".format(chart_path))
+					error_count += 1
+					continue
+				except ET.ParseError as e:
+					print("Failed to process xml file {}".format(tracklisting_filename))
 					print(e)
 					error_count += 1
-			if not chart_copied:
-				print("Error: No chart copied for {}".format(idtag))
-				error_count += 1
+					if track_count == 0:
+						print("Error: no Tracks read from {}, skipping".format(tracklisting_filename))
+						continue
+					print("Error: skipping the rest of {}".format(tracklisting_filename))
 			
-			# convert DJ.fsb to song.ogg
-			if convert_audio:
-				try:
-					temp_wav = "{}/temp.wav".format(output_track_dir)
-					vgm_out = subprocess.run([vgms_path, "-i", "{}/DJ.fsb".format(loc), "-o", temp_wav], stdout=subprocess.DEVNULL)
-					if vgm_out.returncode != 0:
-						print("Error: Failed to extract DJ.fsb for song.ogg for {}, skipping".format(idtag))
-						error_count += 1
-					else:
-						sox_out0 = subprocess.Popen([sox_path, temp_wav, 
-													"-C", "8", "{}/green.ogg".format(output_track_dir), "-D",
-													"remix", "-m", "1", "2",
-													"rate", "-v", "44100"])
-						sox_out1 = subprocess.Popen([sox_path, temp_wav, 
-													"-C", "8", "{}/blue.ogg".format(output_track_dir), "-D",
-													"remix", "-m", "3", "4",
-													"rate", "-v", "44100"])
-						sox_out2 = subprocess.Popen([sox_path, temp_wav, 
-													"-C", "8", "{}/red.ogg".format(output_track_dir), "-D",
-													"remix", "-m", "5", "6",
-													"rate", "-v", "44100"])
-						sox_out0.wait()
-						sox_out1.wait()
-						sox_out2.wait()
-						if sox_out0.returncode != 0 or sox_out1.returncode != 0 or sox_out2.returncode != 0:
-							print("Error: Failed to mix DJ.fsb to ogg stems for {}, skipping".format(idtag))
-							error_count += 1
-					if os.path.isfile(temp_wav):
-						os.remove(temp_wav)
-				except Exception as e:
-					print("Error: Failed to convert DJ.ogg to ogg stems for {}, skipping".format(idtag))
-					print(e)
+				if track_count <= 0:
+					print("Error: no Tracks found in {}, skipping".format(tracklisting_filename))
 					error_count += 1
 			
-			converted_count += 1
+			for future in futures:
+				try:
+					converted, track_errors, track_name, messages, track_folder, manifest_entry = future.result()
+				except Exception as e:
+					converted, track_errors, track_name, messages, track_folder, manifest_entry = False, 1, None, ["Error: Failed to convert track", str(e)], None, {}
+				for message in messages:
+					print(message)
+				if track_folder is not None:
+					new_manifest_tracks[track_folder] = manifest_entry
+					if time.monotonic() - manifest_save_time >= MANIFEST_SAVE_INTERVAL:
+						try:
+							save_manifest(new_manifest_tracks)
+						except Exception:
+							# reported by the final save
+							pass
+						manifest_save_time = time.monotonic()
+				if converted:
+					converted_count += 1
+				if track_errors > 0:
+					error_count += track_errors
+					failed_tracks.append(track_name or "(unknown track)")
+		finally:
+			# on an interrupt, don't start queued tracks, and keep the tracks drained so far
+			for future in futures:
+				future.cancel()
+			try:
+				save_manifest(new_manifest_tracks)
+			except Exception as e:
+				print("Warning: failed to write {}, the next run will convert everything again".format(MANIFEST_FILENAME))
+				print(e)
 	
 	print("{} chart(s) processed".format(converted_count))
 	print("{} error(s)".format(error_count))
+	if len(failed_tracks) > 0:
+		print("Tracks with errors: {}".format(", ".join(failed_tracks)))
 	time.sleep(SLEEP_TIME)
 
 if __name__ == "__main__":
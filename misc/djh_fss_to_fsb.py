@@ -22,47 +22,39 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-# DJ Hero Freestyle Sample (FSS) FSB builder v0.3
+# DJ Hero Freestyle Sample (FSS) FSB builder v0.34
 # Convert sample WAVs/MP3s to FSS FSBs playable in DJ Hero
 
 import os, sys
 import struct
 
+# the MP3 frame indexer is shared with djh_mp3_to_fsb
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "djh_mp3_to_fsb"))
+import mp3_frames
+from mp3_frames import SAMPLES_PER_FRAME
+from fsb_cache import FsbCache
+from wav_chunks import WavFile, WavError, WAV_FORMAT_PCM, write_swapped_pcm16
+
+# part of the build cache key, bump along with the version above when the output changes
+FSB_BUILDER = "djh_fss_to_fsb 0.34"
+
 OUTPUT_FSB = "FSS.fsb"
 
+# build cache: reuse FSBs built from the same samples
+CACHE_FLAG = "--cache"
+
 FSB_EXTENSION = ".fsb"
 MP3_EXTENSION = ".mp3"
 WAV_EXTENSION = ".wav"
 
-# references
-# http://www.mp3-tech.org/programmer/frame_header.html
-# https://hydrogenaud.io/index.php/topic,85125.0.html
-# http://www.topherlee.com/software/pcm-tut-wavformat.html
-
-# tagging
-TAG_PREFIX = b"TAG"
-ID3_PREFIX = b"ID3"
-INFO_TAG_SILENCE = (0,0,0,0,0,0,0,0)
-INFO_TAG_ID = (1868983881, 1735289176) # Info, Xing in little endian
-INFO_TAG_READSIZE = 0x24
-
-# MPEG v1: frame size = 1152 samples/frame * bitrate / samplerate / 8 bits/byte
-#                     = 144 * bitrate / samplerate
-SAMPLES_PER_FRAME = 1152
-MPEG_MAGIC = SAMPLES_PER_FRAME / 8
-MP3_HEADER_SIZE = 4
-
-MPEG_VERSION_1 = 1
-MP3_BITRATES = (None, 32000, 40000, 48000, 56000, 64000, 80000, 96000, 112000, 128000, 160000, 192000, 224000, 256000, 320000, None)
-MP3_SAMPLERATES = (44100, 48000, 32000, None)
-
 SAMPLE_RATE_WII = 32000
 SAMPLE_RATE_PS3 = 44100
 SAMPLE_RATE_48 = 48000
 
 BITRATE_DEFAULT = 160000
 
-WAV_HEADER_SIZE = 44
+# MP3 channel mode of a mono frame, the FSB is written as stereo
+CHANNEL_MODE_MONO = 3
 
 fsb_sample_rate = None
 fsb_bitrate = None
@@ -99,32 +91,30 @@ def write_fsb_header(fsb_outfile, fsb_format, audio_count, audio_filenames, samp
 		fsb_outfile.write(struct.pack("<IIHHHH", mode, fsb_sample_rate, 0xFF, 0x80, 0x80, num_channels))
 		fsb_outfile.write(struct.pack("<IIII", 1065353216, 1176256512, 0, 0))
 
-def check_frame_get_size(header, mp3_filename):
+def index_mp3(mp3_filename):
+	# index the MP3's frames and check that it matches the other MP3s
 	global fsb_sample_rate
 	global fsb_bitrate
 	
-	header_bytes = struct.unpack("BBBB", header)
-	
-	# check frame sync
-	if header_bytes[0] != 0xFF or ((header_bytes[1] >> 4) & 0xF) != 0xF:
-		print("Error: failed to parse MP3 {}, unexpected MP3 frame sync".format(mp3_filename))
+	try:
+		mp3_index = mp3_frames.index_mp3(mp3_filename)
+	except mp3_frames.Mp3Error as e:
+		print("Error: {}".format(e))
 		usage()
 	
-	# check mpeg version is v1
-	if ((header_bytes[1] >> 3) & 0x1) != MPEG_VERSION_1:
-		print("Error: failed to parse MP3 {}, not mpeg v1".format(mp3_filename))
-		usage()
-	
-	# check mpeg layer 3
-	if ((header_bytes[1] >> 1)) & 0x3 != 0x1:
-		print("Error: failed to parse MP3 {}, not layer 3".format(mp3_filename))
-		usage()
+	if mp3_index.id3_version == 2:
+		print("Note: MP3 file {} has ID3v2 tags, size {}".format(mp3_filename, mp3_index.id3_size))
+	elif mp3_index.id3_version == 1:
+		print("Note: MP3 file {} has ID3v1 tags, size {}".format(mp3_filename, mp3_index.id3_size))
+	if mp3_index.info_size > 0:
+		print("Note: MP3 file {} has Info tag, size {}".format(mp3_filename, mp3_index.info_size))
+	if mp3_index.truncated:
+		print("Warning: MP3 file {} ends with an incomplete frame, ignoring it".format(mp3_filename))
+	if len(mp3_index) == 0:
+		return mp3_index
 	
 	# check bitrate
-	bitrate = MP3_BITRATES[((header_bytes[2] >> 4) & 0xF)]
-	if bitrate == None:
-		print("Error: failed to parse MP3 {}, unsupported bitrate".format(mp3_filename))
-		usage()
+	bitrate = mp3_index.bitrate
 	if bitrate != fsb_bitrate:
 		if fsb_bitrate == None:
 			fsb_bitrate = bitrate
@@ -140,10 +130,7 @@ def check_frame_get_size(header, mp3_filename):
 			usage()
 		
 	# check sample rate
-	sample_rate = MP3_SAMPLERATES[((header_bytes[2] >> 2) & 0x3)]
-	if sample_rate == None:
-		print("Error: failed to parse MP3 {}, unsupported sample rate".format(mp3_filename))
-		usage()
+	sample_rate = mp3_index.sample_rate
 	if sample_rate != fsb_sample_rate:
 		if fsb_sample_rate == None:
 			fsb_sample_rate = sample_rate
@@ -158,22 +145,20 @@ def check_frame_get_size(header, mp3_filename):
 			print("Error: MP3s do not all have the same sample rate. Got sample rate {}Hz".format(sample_rate))
 			usage()
 	
-	# check padding bit
-	padding = ((header_bytes[2] >> 1) & 0x1)
-	
 	# check if stereo
-	channel_mode = ((header_bytes[3] >> 6) & 0x3)
-	if channel_mode & 0x10 != 0x00:
-		print("Error: failed to parse MP3, not stereo or joint stereo")
+	channel_mode = (mp3_index.first_header >> 6) & 0x3
+	if channel_mode == CHANNEL_MODE_MONO:
+		print("Error: failed to parse MP3 {}, not stereo or joint stereo".format(mp3_filename))
 		usage()
 	
-	return int(MPEG_MAGIC * bitrate / sample_rate) + padding
+	return mp3_index
 	
 def usage():
-	print("DJ FSS FSB Usage: {} sample1.mp3 sample2.mp3 sample3.mp3 ... [output.fsb]".format(sys.argv[0]))
+	print("DJ FSS FSB Usage: {} [{} cache_folder] sample1.mp3 sample2.mp3 sample3.mp3 ... [output.fsb]".format(sys.argv[0], CACHE_FLAG))
 	print("Any number of sample MP3s is allowed; however DJ Hero 1 only supports FSBs with 5 samples.")
 	print("All MP3s must be 32/44.1/48khz, constant bitrate (preferably 160kbps or higher)")
 	print("The default output filename is \"{}\"; specifying a different output filename is optional.".format(OUTPUT_FSB))
+	print("With {}, FSBs already built from the same samples are reused from cache_folder.".format(CACHE_FLAG))
 	sys.exit(1)
 
 def main():
@@ -182,6 +167,12 @@ def main():
 		usage()
 	
 	file_args = sys.argv[1:]
+	cache = None
+	if file_args[0] == CACHE_FLAG:
+		if len(file_args) < 3:
+			usage()
+		cache = FsbCache(file_args[1])
+		file_args = file_args[2:]
 	audio_count = 0
 	audio_filenames = []
 	fsb_outfilename = OUTPUT_FSB
@@ -226,63 +217,25 @@ def main():
 		usage()
 	if audio_count != 5:
 		print("Warning: DJH1 requires 5 samples")
+	
+	cache_key = None
+	if cache is not None:
+		# sample names are stored in the FSB header, so they're part of the key
+		cache_key = cache.key(FSB_BUILDER, audio_filenames, [os.path.basename(audio_filename) for audio_filename in audio_filenames])
+		if cache_key is not None and cache.fetch(cache_key, fsb_outfilename):
+			print("Samples unchanged, using cached FSB for {}".format(fsb_outfilename))
+			return
 
 	fsb_sizes = []
 	offsets = []
 	sample_counts = []
 	if fsb_format == FORMAT_MP3:
-		tag_sizes = []
-		frame_sizes = []
-		frame_counts = []
-		
-		# check for tags so that they can be ignored
-		for i in range(audio_count):
-			tag_sizes.append(0)
-			with open(audio_filenames[i], "rb") as mp3_file:
-				# check for ID3 tags
-				id3_data = mp3_file.read(3)
-				if id3_data == ID3_PREFIX: #ID3v2
-					mp3_file.read(3)
-					id3_sizebytes = struct.unpack(">BBBB",mp3_file.read(4))
-					tag_sizes[i] = (id3_sizebytes[3] & 0x7F) + ((id3_sizebytes[2] & 0x7F) << 7) + ((id3_sizebytes[1] & 0x7F) << 14) + ((id3_sizebytes[0] & 0x7F) << 21) + 10
-					print("Note: MP3 file {} has ID3v2 tags, size {}".format(audio_filenames[i], tag_sizes[i]))
-				elif id3_data == TAG_PREFIX: #ID3v1
-					tag_sizes[i] = 256
-					print("Note: MP3 file {} has ID3v1 tags, size {}".format(audio_filenames[i], tag_sizes[i]))
-				
-				# check for the Info tag
-				mp3_file.seek(tag_sizes[i])
-				frame_header = mp3_file.read(MP3_HEADER_SIZE)
-				if len(frame_header) < MP3_HEADER_SIZE or frame_header[0:3] == TAG_PREFIX:
-					continue
-				frame_size = check_frame_get_size(frame_header, audio_filenames[i])
-				mp3_info_tag = mp3_file.read(INFO_TAG_READSIZE)
-				if len(mp3_info_tag) != INFO_TAG_READSIZE:
-					continue
-				mp3_info_data = struct.unpack("IIIIIIIII", mp3_info_tag)
-				if mp3_info_data[:8] == INFO_TAG_SILENCE and mp3_info_data[8] in INFO_TAG_ID:
-					print("Note: MP3 file {} has Info tag, size {}".format(audio_filenames[i], frame_size))
-					tag_sizes[i] += frame_size
-		
-		# count frames in mp3s
-		for i in range(audio_count):
-			frame_sizes.append([])
-			frame_counts.append(0)
-			sample_counts.append(0)
-			with open(audio_filenames[i], "rb") as mp3_file:
-				mp3_file.seek(tag_sizes[i])
-				reading_mp3 = True
-				while reading_mp3:
-					frame_header = mp3_file.read(MP3_HEADER_SIZE)
-					# stop at the end of each MP3
-					if len(frame_header) < MP3_HEADER_SIZE or frame_header[0:3] == TAG_PREFIX:
-						reading_mp3 = False
-						continue
-					frame_size = check_frame_get_size(frame_header, audio_filenames[i])
-					frame_sizes[i].append(frame_size)
-					frame_counts[i] += 1
-					sample_counts[i] += SAMPLES_PER_FRAME
-					mp3_file.seek(frame_size - MP3_HEADER_SIZE, 1)
+		# index each mp3 once: tags, Info frame and the offset/size of every frame
+		mp3_indexes = [index_mp3(audio_filename) for audio_filename in audio_filenames]
+		tag_sizes = [mp3_index.tag_size for mp3_index in mp3_indexes]
+		frame_sizes = [mp3_index.sizes for mp3_index in mp3_indexes]
+		frame_counts = [len(mp3_index) for mp3_index in mp3_indexes]
+		sample_counts = [frame_count * SAMPLES_PER_FRAME for frame_count in frame_counts]
 		
 		# compute fsb sizes by adding up the frame sizes
 		for i in range(audio_count):
@@ -321,78 +274,56 @@ def main():
 					fsb_out.write(b"\x00"*offsets[i])
 			
 	elif fsb_format == FORMAT_WAV:
-		RIFF_MAGIC = b"RIFF"
-		WAV_MAGIC = b"WAVEfmt "
-		DATA_MAGIC = b"data"
+		# map each WAV and read its chunk table, the data chunk is written straight from the map
+		wav_files = []
 		for i in range(audio_count):
-			with open(audio_filenames[i], "rb") as wav_file:
-				data = struct.unpack("<4sI8s",wav_file.read(16)) # RIFF magic, file size, WAVEFmt magic
-				if data[0] != RIFF_MAGIC:
-					print("Error: failed to parse WAV, no RIFF header")
-					usage()
-				if data[2] != WAV_MAGIC:
-					print("Error: failed to parse WAV, no WAVEfmt header")
-					usage()
-				data = struct.unpack("<IHHII",wav_file.read(16)) # format data length, format type, channels, sample rate, unneeded math
-				if data[1] != 1:
-					print("Error: failed to parse WAV, format type not PCM")
-					usage()
-				if data[2] != 2:
-					print("Error: failed to parse WAV, not stereo")
-					usage()
-				sample_rate = data[3]
-				if sample_rate != fsb_sample_rate:
-					if fsb_sample_rate == None:
-						fsb_sample_rate = sample_rate
-						print("Got sample rate: {}Hz".format(sample_rate))
-						if fsb_sample_rate == SAMPLE_RATE_WII:
-							print("Ideal sample rate for Wii")
-						elif fsb_sample_rate == SAMPLE_RATE_PS3 or fsb_sample_rate == SAMPLE_RATE_48:
-							print("Warning: may be unstable on Wii")
-						else:
-							print("Warning: unusual sample rate")
-					else:
-						print("Error: WAVs do not all have the same sample rate. Got sample rate {}Hz".format(sample_rate))
-						usage()
-				data = struct.unpack("<HH",wav_file.read(4)) # unneeded math, bits per sample
-				if data[1] != 16:
-					print("Error: failed to parse WAV, only 16-bit WAV is supported")
-					usage()
-				data_bytes = wav_file.read(4)
-				chunk_name = struct.unpack("<4s",data_bytes)[0] # data chunk header or some other header
-				while len(data_bytes) == 4 and chunk_name != DATA_MAGIC:
-					# some other chunk that's not data
-					# read its length and then skip it
-					chunk_length = struct.unpack("<I",wav_file.read(4))[0] # chunk length
-					print("skipping chunk {} with length {}".format(chunk_name.decode("utf-8"), chunk_length))
-					wav_file.seek(chunk_length, 1)
-					data_bytes = wav_file.read(4)
-					if len(data_bytes) == 4:
-						chunk_name = struct.unpack("<4s",data_bytes)[0] # maybe this is data chunk header?
+			try:
+				wav_file = WavFile(audio_filenames[i])
+			except WavError as e:
+				print("Error: failed to parse WAV {}, {}".format(audio_filenames[i], e))
+				usage()
+			wav_files.append(wav_file)
+			if wav_file.format_type != WAV_FORMAT_PCM:
+				print("Error: failed to parse WAV, format type not PCM")
+				usage()
+			if wav_file.channels != 2:
+				print("Error: failed to parse WAV, not stereo")
+				usage()
+			sample_rate = wav_file.sample_rate
+			if sample_rate != fsb_sample_rate:
+				if fsb_sample_rate == None:
+					fsb_sample_rate = sample_rate
+					print("Got sample rate: {}Hz".format(sample_rate))
+					if fsb_sample_rate == SAMPLE_RATE_WII:
+						print("Ideal sample rate for Wii")
+					elif fsb_sample_rate == SAMPLE_RATE_PS3 or fsb_sample_rate == SAMPLE_RATE_48:
+						print("Warning: may be unstable on Wii")
 					else:
-						chunk_name = None
-				if chunk_name != DATA_MAGIC:
-					print("Error: failed to parse WAV, no data chunk header")
+						print("Warning: unusual sample rate")
+				else:
+					print("Error: WAVs do not all have the same sample rate. Got sample rate {}Hz".format(sample_rate))
 					usage()
-				data = struct.unpack("<I",wav_file.read(4)) # payload size
-				payload_size = data[0]
-				fsb_sizes.append(payload_size)
-				sample_counts.append(int(payload_size / 4)) # 2 channels of 16-bit samples
+			if wav_file.bits_per_sample != 16:
+				print("Error: failed to parse WAV, only 16-bit WAV is supported")
+				usage()
+			for chunk in wav_file.other_chunks():
+				print("skipping chunk {} with length {}".format(chunk.name.decode("utf-8", errors="replace"), chunk.size))
+			if wav_file.truncated:
+				print("Warning: WAV file {} ends before its data chunk does, using the {} bytes present".format(audio_filenames[i], wav_file.data_size))
+			payload_size = wav_file.data_size
+			fsb_sizes.append(payload_size)
+			sample_counts.append(int(payload_size / 4)) # 2 channels of 16-bit samples
 		
 		with open(fsb_outfilename, "wb") as fsb_out:
 			write_fsb_header(fsb_out, fsb_format, audio_count, audio_filenames, sample_counts, fsb_sizes)
 
-			for i in range(audio_count):
-				with open(audio_filenames[i], "rb") as wav_file:
-					# skip headers
-					wav_file.seek(WAV_HEADER_SIZE)
-					for f in range(0, fsb_sizes[i], 2):
-						# swap endianness of each 16-bit sample
-						byte0 = wav_file.read(1)
-						byte1 = wav_file.read(1)
-						fsb_out.write(byte1)
-						fsb_out.write(byte0)
+			for wav_file in wav_files:
+				# FSS PCM is big endian
+				write_swapped_pcm16(wav_file.data, fsb_out)
+				wav_file.close()
 					
+	if cache_key is not None:
+		cache.store(cache_key, fsb_outfilename)
 	print("Wrote {}".format(fsb_outfilename))
 
 if __name__ == "__main__":
@@ -22,29 +22,164 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-# DJ Hero IMG Byteswap v0.1
+# DJ Hero IMG Byteswap v0.4
 # Swap the bytes of DJH IMG files.
 # E.g. convert from PS3 IMG to 360 IMG
 # E.g. convert 360 IMG so that the DXT1/DXT5 data is viewable on PC
 
-import sys, os, struct
+import sys, os
+import mmap
+import json
+import zlib
+from array import array
+
+IMG_EXT = ".img"
+ENDSWAP_SUFFIX = "_endswap"
+
+# the header is copied as-is, the rest of the file is swapped as 16-bit words
+HEADER_SIZE = 20
+# swap in large blocks instead of one word at a time, must be a multiple of 2
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# in-place mode keeps its progress here, so an interrupted run can be resumed
+PROGRESS_EXT = ".swap_progress"
+# and a copy of the block being swapped, so a block torn by a crash can be put back
+JOURNAL_EXT = ".swap_journal"
+IN_PLACE_FLAG = "-i"
+
+def usage():
+	print("Usage: {} [-i] [input.img]".format(sys.argv[0]))
+	print("Swaps the byte order of a DJ Hero IMG file, writing input_endswap.img")
+	print("-i: swap input.img in place instead of writing a copy.")
+	print("    If interrupted, run the same command again to resume.")
+	sys.exit(1)
+
+def byteswap_img(input_img, output_img, chunk_size=CHUNK_SIZE):
+	output_img.write(input_img.read(HEADER_SIZE))
+	data = input_img.read(chunk_size)
+	while len(data) >= 2:
+		# a trailing odd byte is dropped
+		words = array("H")
+		words.frombytes(data[:len(data) & ~1])
+		words.byteswap()
+		words.tofile(output_img)
+		data = input_img.read(chunk_size)
+
+def read_progress(progress_filename, file_size):
+	try:
+		with open(progress_filename, "r") as progress_file:
+			progress = json.load(progress_file)
+	except FileNotFoundError:
+		return None
+	if progress["size"] != file_size:
+		print("Error: {} does not match the IMG file size, delete it to start over".format(progress_filename))
+		usage()
+	return progress
+
+def write_progress(progress_filename, progress):
+	# replace the progress file atomically so it is never half-written
+	temp_filename = progress_filename + ".tmp"
+	with open(temp_filename, "w") as progress_file:
+		json.dump(progress, progress_file)
+		progress_file.flush()
+		os.fsync(progress_file.fileno())
+	os.replace(temp_filename, progress_filename)
+
+def write_journal(journal_filename, data):
+	with open(journal_filename, "wb") as journal_file:
+		journal_file.write(data)
+		journal_file.flush()
+		os.fsync(journal_file.fileno())
+
+def read_journal(journal_filename, block_start, block_size, crc_before):
+	# the original block, checked against the crc recorded with it
+	try:
+		with open(journal_filename, "rb") as journal_file:
+			data = journal_file.read()
+	except FileNotFoundError:
+		data = b""
+	if len(data) != block_size or zlib.crc32(data) != crc_before:
+		print("Error: the block at offset {} was only partly swapped and {} can't restore it, cannot resume".format(block_start, journal_filename))
+		usage()
+	return data
+
+def byteswap_img_in_place(img_filename, chunk_size=CHUNK_SIZE):
+	# each block is copied to the journal, then recorded as pending (with the crc before and after swapping) before it is swapped
+	# on resume, the crc of a pending block tells whether it was already swapped,
+	# and a partly swapped block is restored from the journal and swapped again
+	progress_filename = img_filename + PROGRESS_EXT
+	journal_filename = img_filename + JOURNAL_EXT
+	with open(img_filename, "r+b") as img:
+		file_size = os.fstat(img.fileno()).st_size
+		# a trailing odd byte is left as-is
+		swap_end = HEADER_SIZE + ((file_size - HEADER_SIZE) & ~1)
+		if swap_end <= HEADER_SIZE:
+			return
+		
+		offset = HEADER_SIZE
+		with mmap.mmap(img.fileno(), 0) as img_map:
+			progress = read_progress(progress_filename, file_size)
+			if progress != None:
+				offset = progress["offset"]
+				if progress["pending"] != None:
+					block_start, block_end, crc_before, crc_after = progress["pending"]
+					crc = zlib.crc32(img_map[block_start:block_end])
+					if crc == crc_after:
+						offset = block_end
+					elif crc == crc_before:
+						offset = block_start
+					else:
+						original = read_journal(journal_filename, block_start, block_end - block_start, crc_before)
+						print("Restoring the partly swapped block at offset {}".format(block_start))
+						img_map[block_start:block_end] = original
+						img_map.flush()
+						offset = block_start
+				print("Resuming at offset {} of {}".format(offset, file_size))
+			
+			while offset < swap_end:
+				block_end = min(offset + chunk_size, swap_end)
+				words = array("H")
+				words.frombytes(img_map[offset:block_end])
+				crc_before = zlib.crc32(words)
+				write_journal(journal_filename, words)
+				words.byteswap()
+				crc_after = zlib.crc32(words)
+				write_progress(progress_filename, {"size": file_size, "offset": offset, "pending": [offset, block_end, crc_before, crc_after]})
+				img_map[offset:block_end] = words
+				img_map.flush()
+				offset = block_end
+				write_progress(progress_filename, {"size": file_size, "offset": offset, "pending": None})
+	os.remove(progress_filename)
+	if os.path.isfile(journal_filename):
+		os.remove(journal_filename)
 
 def main():
 	if len(sys.argv) < 2:
 		usage()
 	
+	in_place = False
 	input_filename = sys.argv[1]
+	if input_filename == IN_PLACE_FLAG:
+		if len(sys.argv) < 3:
+			usage()
+		in_place = True
+		input_filename = sys.argv[2]
 	input_name, input_ext = os.path.splitext(input_filename)
 	
-	if input_ext.lower() == ".img":
-		with open(input_filename, "rb") as input_img, open(input_name + "_endswap" + input_ext, "wb") as output_img:
-			output_img.write(input_img.read(20))
-			data = input_img.read(2)
-			while len(data) == 2:
-				short_data = struct.unpack("<H",data)[0]
-				output_img.write(struct.pack(">H",short_data))
-				data = input_img.read(2)
+	if input_ext.lower() == IMG_EXT and in_place:
+		try:
+			byteswap_img_in_place(input_filename)
+		except KeyboardInterrupt:
+			print("Interrupted, run the same command again to resume")
+			sys.exit(1)
+		return 0
+	if input_ext.lower() == IMG_EXT:
+		with open(input_filename, "rb") as input_img, open(input_name + ENDSWAP_SUFFIX + input_ext, "wb") as output_img:
+			byteswap_img(input_img, output_img)
 			return 0
+	
+	print("Error: input file {} does not have extension {}".format(input_filename, IMG_EXT))
+	usage()
 
 if __name__ == "__main__":
 	main()
\ No newline at end of file
@@ -0,0 +1,35 @@
+# DJ Hero 2 FSG path hashing
+# Used by djh2_disc0_extract.py, keep it in the same folder
+# Original hash from ArchiveExplorer by maxton
+# https://github.com/maxton/GameArchives/
+
+# FSG-FILE-SYSTEM nodes are keyed by a 32-bit multiplicative hash of the upper-case path
+# the hash is computed one character at a time, so a child's hash continues from its parent's
+FSG_HASH_INIT = 2166136261
+FSG_HASH_PRIME = 1677619
+
+def hash_extend(hash, str):
+	for c in str.upper():
+		hash = (FSG_HASH_PRIME * hash) & 0xFFFFFFFF
+		hash ^= ord(c)
+	return hash
+
+class FSGHashTable:
+	# hash -> path for every path hashed through child(), to resolve node hashes back to names
+	def __init__(self):
+		self.paths = {}
+
+	def child(self, parent_path, parent_hash, name):
+		# only hashes the new name instead of the whole path
+		if parent_path == "":
+			path = name
+			hash = hash_extend(parent_hash, name)
+		else:
+			path = "{}/{}".format(parent_path, name)
+			hash = hash_extend(parent_hash, "/" + name)
+		self.paths[hash] = path
+		return path, hash
+
+	def orphans(self, node_hashes):
+		# nodes that no path in the folder tree hashes to
+		return sorted(hash for hash in node_hashes if hash not in self.paths)
@@ -0,0 +1,147 @@
+# DJ Hero TRAC string tables
+# Used by djh2_to_dje.py, keep it in the same folder
+# TRAC IDs map to localized strings, from the game's Text/TRAC/TRACID.txt and TRACE.txt
+# or from a custom song's "Info for TRAC.csv"
+
+import os
+import csv
+import json
+import struct
+import tempfile
+
+# a table is read on its first lookup, and an index of it is saved next to its sources
+# the index is used until a source's size or mtime changes
+TRAC_CACHE_FILENAME = "TRAC.cache"
+TRAC_CACHE_MAGIC = b"TRCI"
+TRAC_CACHE_VERSION = 1
+
+# magic, version, number of strings, fingerprint size, ID blob size
+# then the JSON fingerprint, the null-separated IDs and the null-separated strings
+TRAC_CACHE_HEADER = struct.Struct(">4sIIII")
+
+class TracError(Exception):
+	pass
+
+def read_trac_text(tracid_filename, trace_filename):
+	with open(tracid_filename, "r") as tracid_file:
+		tracids = tracid_file.read().split("\n")
+	with open(trace_filename, "rb") as trace_file:
+		traces = trace_file.read().split(b"\x00")
+	if len(tracids) != len(traces):
+		raise TracError("mismatched number of trac IDs and trac strings: {}, {}".format(len(tracids), len(traces)))
+	
+	strings = {}
+	for tracid, trace in zip(tracids, traces):
+		strings[tracid.upper()] = trace.decode("utf-8")
+	return strings
+
+def read_trac_csv(csv_filename):
+	strings = {}
+	with open(csv_filename, "r", encoding="utf_8_sig", newline="") as trac_file:
+		trac_csv = csv.reader(trac_file, dialect="excel")
+		for row in trac_csv:
+			if len(row) > 0: # ignore blank lines
+				if row[0][0:2] == "//": # ignore commented lines
+					continue
+				strings[row[0]] = row[-1]
+	return strings
+
+def source_fingerprint(filenames):
+	fingerprint = []
+	for filename in filenames:
+		stat = os.stat(filename)
+		fingerprint.append([os.path.basename(filename), stat.st_size, stat.st_mtime_ns])
+	return fingerprint
+
+class TracTable:
+	# TRAC strings for one chart path, reader is called with the source filenames
+	def __init__(self, sources, reader, log=print):
+		self.sources = sources
+		self.reader = reader
+		self.log = log
+		self.strings = None
+		self.cache_filename = os.path.join(os.path.dirname(sources[0]), TRAC_CACHE_FILENAME)
+	
+	def load_cache(self, fingerprint):
+		try:
+			with open(self.cache_filename, "rb") as cache_file:
+				cache_data = cache_file.read()
+		except OSError:
+			return None
+		if len(cache_data) < TRAC_CACHE_HEADER.size:
+			return None
+		magic, version, num_strings, fingerprint_size, ids_size = TRAC_CACHE_HEADER.unpack_from(cache_data)
+		if magic != TRAC_CACHE_MAGIC or version != TRAC_CACHE_VERSION:
+			return None
+		
+		offset = TRAC_CACHE_HEADER.size
+		try:
+			cache_fingerprint = json.loads(cache_data[offset:offset + fingerprint_size].decode("utf-8"))
+		except ValueError:
+			return None
+		if cache_fingerprint != fingerprint:
+			return None
+		if num_strings == 0:
+			return {}
+		
+		offset += fingerprint_size
+		try:
+			tracids = cache_data[offset:offset + ids_size].decode("utf-8").split("\x00")
+			traces = cache_data[offset + ids_size:].decode("utf-8").split("\x00")
+		except UnicodeDecodeError:
+			return None
+		if len(tracids) != num_strings or len(traces) != num_strings:
+			return None
+		return dict(zip(tracids, traces))
+	
+	def save_cache(self, fingerprint, strings):
+		tracids = list(strings.keys())
+		traces = list(strings.values())
+		# nulls separate the entries, so a table containing them isn't cached
+		if any("\x00" in s for s in tracids) or any("\x00" in s for s in traces):
+			return
+		
+		fingerprint_data = json.dumps(fingerprint).encode("utf-8")
+		ids_data = "\x00".join(tracids).encode("utf-8")
+		cache_data = b"".join((TRAC_CACHE_HEADER.pack(TRAC_CACHE_MAGIC, TRAC_CACHE_VERSION, len(strings), len(fingerprint_data), len(ids_data)),
+			fingerprint_data, ids_data, "\x00".join(traces).encode("utf-8")))
+		
+		temp_filename = None
+		try:
+			cache_fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(self.cache_filename), prefix=".trac-")
+			with os.fdopen(cache_fd, "wb") as cache_file:
+				cache_file.write(cache_data)
+			os.replace(temp_filename, self.cache_filename)
+		except OSError:
+			# e.g. a read-only game folder, the strings are just read again next time
+			if temp_filename is not None and os.path.isfile(temp_filename):
+				os.remove(temp_filename)
+	
+	def load(self):
+		if self.strings is not None:
+			return self.strings
+		self.strings = {}
+		try:
+			fingerprint = source_fingerprint(self.sources)
+			strings = self.load_cache(fingerprint)
+			if strings is None:
+				strings = self.reader(*self.sources)
+				self.save_cache(fingerprint, strings)
+			self.strings = strings
+		except TracError:
+			raise
+		except Exception as e:
+			self.log("Warning: failed to use TRAC files, using IDs as strings instead")
+			self.log(e)
+		return self.strings
+	
+	def get(self, key):
+		# unknown IDs are used as the string
+		strings = self.load()
+		return strings.get(key.upper(), key)
+
+def open_trac_text(trac_dir, log=print):
+	return TracTable([os.path.join(trac_dir, "TRACID.txt"), os.path.join(trac_dir, "TRACE.txt")], read_trac_text, log)
+
+def open_trac_csv(csv_filename, log=print):
+	return TracTable([csv_filename], read_trac_csv, log)
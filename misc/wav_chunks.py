@@ -0,0 +1,124 @@
+# RIFF WAV chunk table reader
+# Used by djh_fss_to_fsb.py, keep it in the same folder
+# Maps the WAV and reads its whole chunk table at once, so the data chunk can be used in place
+# references
+# http://www.topherlee.com/software/pcm-tut-wavformat.html
+
+import os
+import struct
+import mmap
+from array import array
+
+RIFF_MAGIC = b"RIFF"
+WAVE_MAGIC = b"WAVE"
+FMT_MAGIC = b"fmt "
+DATA_MAGIC = b"data"
+
+# RIFF magic, file size, WAVE magic
+RIFF_HEADER_STRUCT = struct.Struct("<4sI4s")
+# chunk name, chunk length
+CHUNK_HEADER_STRUCT = struct.Struct("<4sI")
+# format type, channels, sample rate, byte rate, block align, bits per sample
+FMT_STRUCT = struct.Struct("<HHIIHH")
+
+WAV_FORMAT_PCM = 1
+
+# PCM is byteswapped in blocks of this size
+SWAP_BLOCK_SIZE = 4 * 1024 * 1024
+
+class WavError(Exception):
+	pass
+
+class WavChunk:
+	def __init__(self, name, offset, size):
+		self.name = name
+		# offset of the chunk's data, after its header
+		self.offset = offset
+		self.size = size
+
+def read_chunk_table(data):
+	# every chunk in the RIFF, in file order
+	if len(data) < RIFF_HEADER_STRUCT.size:
+		raise WavError("no RIFF header")
+	riff_magic, riff_size, wave_magic = RIFF_HEADER_STRUCT.unpack_from(data)
+	if riff_magic != RIFF_MAGIC:
+		raise WavError("no RIFF header")
+	if wave_magic != WAVE_MAGIC:
+		raise WavError("no WAVE header")
+	
+	chunks = []
+	offset = RIFF_HEADER_STRUCT.size
+	while offset + CHUNK_HEADER_STRUCT.size <= len(data):
+		name, size = CHUNK_HEADER_STRUCT.unpack_from(data, offset)
+		offset += CHUNK_HEADER_STRUCT.size
+		chunks.append(WavChunk(name, offset, size))
+		# odd sized chunks are followed by a pad byte
+		offset += size + (size & 1)
+	return chunks
+
+class WavFile:
+	def __init__(self, wav_filename):
+		self.filename = wav_filename
+		self.file = open(wav_filename, "rb")
+		if os.fstat(self.file.fileno()).st_size == 0:
+			self.file.close()
+			raise WavError("{} is empty".format(wav_filename))
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		self.data = None
+		try:
+			self.read_chunks()
+		except WavError:
+			self.close()
+			raise
+	
+	def read_chunks(self):
+		self.chunks = read_chunk_table(self.map)
+		fmt_chunk = None
+		data_chunk = None
+		for chunk in self.chunks:
+			if chunk.name == FMT_MAGIC and fmt_chunk is None:
+				fmt_chunk = chunk
+			elif chunk.name == DATA_MAGIC and data_chunk is None:
+				data_chunk = chunk
+		
+		if fmt_chunk is None or fmt_chunk.size < FMT_STRUCT.size or fmt_chunk.offset + FMT_STRUCT.size > len(self.map):
+			raise WavError("no fmt chunk")
+		(self.format_type, self.channels, self.sample_rate, self.byte_rate,
+			self.block_align, self.bits_per_sample) = FMT_STRUCT.unpack_from(self.map, fmt_chunk.offset)
+		
+		if data_chunk is None:
+			raise WavError("no data chunk")
+		# a data chunk that runs past the end of the file is cut short
+		self.truncated = data_chunk.offset + data_chunk.size > len(self.map)
+		data_end = min(data_chunk.offset + data_chunk.size, len(self.map))
+		self.data_offset = data_chunk.offset
+		self.data_size = data_end - data_chunk.offset
+		self.data = memoryview(self.map)[self.data_offset:data_end]
+	
+	def other_chunks(self):
+		# chunks that aren't needed for the FSB, e.g. LIST and fact
+		return [chunk for chunk in self.chunks if chunk.name != FMT_MAGIC and chunk.name != DATA_MAGIC]
+	
+	def close(self):
+		if self.data is not None:
+			self.data.release()
+			self.data = None
+		self.map.close()
+		self.file.close()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+def write_swapped_pcm16(data, outfile):
+	# swap the endianness of each 16-bit sample, a block at a time
+	even_size = len(data) & ~1
+	for start in range(0, even_size, SWAP_BLOCK_SIZE):
+		samples = array("H")
+		samples.frombytes(data[start:min(start + SWAP_BLOCK_SIZE, even_size)])
+		samples.byteswap()
+		outfile.write(samples)
+	if even_size < len(data):
+		outfile.write(data[even_size:])